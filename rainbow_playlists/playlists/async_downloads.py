@@ -0,0 +1,99 @@
+"""
+Asynchronous album art downloads for the async views of the Rainbow Playlists
+application.
+
+The counterpart of the downloads module for code running on an event loop: covers
+are fetched with a pooled httpx AsyncClient instead of on a thread pool, with the
+same limit on concurrent downloads from any one host. Concurrent jobs on the loop
+wanting the same cover share a single download of it. Covers are kept in the same
+on-disk image cache, whose file operations (and any eviction they set off) run on
+a thread so they never hold up the loop.
+"""
+
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import httpx
+from django.conf import settings
+
+from . import image_cache, metrics
+from .async_spotify import TIMEOUT, loop_local
+from .downloads import (DEFAULT_PER_HOST, DownloadResult, finish_download, get_worker_count,
+                        read_cached)
+
+
+def get_client():
+    """
+    Get the pooled httpx client used for every image download on the running event
+    loop.
+
+    :return: httpx.AsyncClient object
+    """
+    pool_size = get_worker_count()
+    return loop_local('images', lambda: httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(TIMEOUT, pool=None)))
+
+
+def get_host_limit(url):
+    """
+    Get the semaphore limiting concurrent downloads from the host of a URL.
+
+    :param url: URL of the image
+    :return: asyncio.Semaphore shared by all downloads from that host on the loop
+    """
+    host_limits = loop_local('image_host_limits', dict)
+    host = urlsplit(url).netloc
+    if host not in host_limits:
+        per_host = getattr(settings, 'RAINBOW_DOWNLOAD_PER_HOST', DEFAULT_PER_HOST)
+        host_limits[host] = asyncio.Semaphore(per_host)
+    return host_limits[host]
+
+
+async def fetch_image(image_url):
+    """
+    Get a single image into memory, from the image cache or by downloading it.
+
+    As with downloads.fetch_image, a stale cached copy is revalidated rather than
+    downloaded again, and failures are captured in the result rather than raised.
+
+    :param image_url: URL of the image
+    :return: DownloadResult for the image
+    """
+    start = time.perf_counter()
+    cached, content = await asyncio.to_thread(read_cached, image_url)
+    if content is not None and image_cache.is_fresh(cached):
+        metrics.increment('image_cache_hits')
+        return DownloadResult(image_url, content, time.perf_counter() - start, None)
+    try:
+        async with get_host_limit(image_url):
+            # only a copy still on disk can be revalidated
+            response = await get_client().get(
+                image_url,
+                headers=image_cache.get_validators(cached) if content is not None else None)
+        if response.status_code != 304 or content is None:
+            response.raise_for_status()
+            content = response.content
+    except httpx.HTTPError as error:
+        metrics.increment('image_download_failures')
+        return DownloadResult(image_url, None, time.perf_counter() - start, error)
+    return await asyncio.to_thread(finish_download, image_url, start, cached, content,
+                                   response)
+
+
+def get_image(image_url):
+    """
+    Start getting an image, or join a download of it already running on the loop.
+
+    :param image_url: URL of the image
+    :return: asyncio.Task resolving to the image's DownloadResult
+    """
+    in_flight = loop_local('images_in_flight', dict)
+    if image_url in in_flight:
+        metrics.increment('image_downloads_shared')
+        return in_flight[image_url]
+    task = asyncio.ensure_future(fetch_image(image_url))
+    in_flight[image_url] = task
+    task.add_done_callback(lambda _: in_flight.pop(image_url, None))
+    return task
@@ -0,0 +1,137 @@
+"""
+Asynchronous Spotify Web API client for the async views of the Rainbow Playlists
+application.
+
+AsyncSpotifyClient is the counterpart of SpotifyClient for code running on an event
+loop. Requests go through an httpx AsyncClient, so one loop can keep many of them in
+flight while it waits, but they draw on the same process-wide token bucket, follow
+the same retry policy and are counted in the same metrics as the synchronous client.
+httpx clients, like asyncio's locks and semaphores, belong to the event loop they
+were created on, so each loop has its own.
+"""
+
+import asyncio
+import weakref
+
+import httpx
+
+from . import metrics
+from .spotify import (MAX_ATTEMPTS, SpotifyError, can_retry, get_api_url, get_rate_limiter,
+                      plan_retry)
+
+POOL_SIZE = 32
+TIMEOUT = 10    # seconds
+
+# per event loop: name -> value
+_loop_values = weakref.WeakKeyDictionary()
+
+
+def loop_local(name, factory):
+    """
+    Get a value belonging to the running event loop, creating it on first use.
+
+    :param name: Name of the value
+    :param factory: Callable creating the value
+    :return: The running loop's value
+    """
+    values = _loop_values.setdefault(asyncio.get_running_loop(), {})
+    if name not in values:
+        values[name] = factory()
+    return values[name]
+
+
+def get_client():
+    """
+    Get the pooled httpx client shared by every async Spotify client on the running
+    event loop.
+
+    :return: httpx.AsyncClient object
+    """
+    # requests queue for a free connection rather than timing out while they wait
+    return loop_local('spotify', lambda: httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+        timeout=httpx.Timeout(TIMEOUT, pool=None)))
+
+
+class AsyncSpotifyClient:
+    """
+    Asynchronous client for the Spotify Web API, authenticated with a user's access
+    token.
+
+    The token may be a fixed string, or a callable returning a current access token,
+    such as a UserToken. A callable is run on a thread, since a refresh may have to
+    wait for one another process is making.
+    """
+
+    def __init__(self, access_token=None):
+        self.access_token = access_token
+
+    async def get_access_token(self):
+        """
+        Get the access token to send with the next request.
+
+        :return: Access token string, or None to send none
+        """
+        if callable(self.access_token):
+            return await asyncio.to_thread(self.access_token)
+        return self.access_token
+
+    async def request(self, method, url, **kwargs):
+        """
+        Send a request to Spotify, retrying rate-limited and transient failures.
+
+        :param method: HTTP method
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to httpx
+        :return: Decoded JSON body of the response, or None if it has no body
+        """
+        if url.startswith('/'):
+            url = get_api_url(url)
+        headers = kwargs.pop('headers', {})
+        access_token = await self.get_access_token()
+        if access_token:
+            headers['Authorization'] = f"Bearer {access_token}"
+
+        limiter = get_rate_limiter()
+        with metrics.span('spotify_request', method=method, url=url):
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                await limiter.aacquire()
+                metrics.increment('spotify_requests')
+                try:
+                    response = await get_client().request(method, url, headers=headers,
+                                                          **kwargs)
+                except httpx.RequestError as error:
+                    sent = not isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+                    if attempt == MAX_ATTEMPTS or not can_retry(method, sent=sent):
+                        raise SpotifyError(f"{method} {url} failed: {error}") from error
+                    await asyncio.sleep(plan_retry(method, url, attempt, error=error))
+                    continue
+
+                if attempt == MAX_ATTEMPTS or not can_retry(method, response.status_code):
+                    break
+                await asyncio.sleep(plan_retry(method, url, attempt, response))
+
+        if response.is_error:
+            raise SpotifyError(f"{method} {url} failed with status {response.status_code}: "
+                               f"{response.text}", response.status_code)
+        return response.json() if response.content else None
+
+    async def get(self, url, **kwargs):
+        """
+        Send a GET request to Spotify.
+
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to httpx
+        :return: Decoded JSON body of the response
+        """
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        """
+        Send a POST request to Spotify.
+
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to httpx
+        :return: Decoded JSON body of the response
+        """
+        return await self.request('POST', url, **kwargs)
@@ -0,0 +1,547 @@
+"""
+Async versions of the playlists and rainbowify views, for serving under ASGI.
+
+They behave as the views of the same names in the views module, but every Spotify
+API and album art request is made with an async HTTP client, so a single worker
+process waits on many users' requests at once rather than tying up a thread for
+each. A rainbowify job runs as a task on the server's event loop: the pages of a
+playlist are fetched together with ``asyncio.gather``, each page's covers start
+downloading as soon as it arrives, and color extraction, which is CPU-bound, runs
+in an executor. Database and cache access goes through Django's async interfaces,
+or ``sync_to_async`` where there is none. Only the I/O is done here: the cache
+keys, requests and playlist changes are worked out by the rainbow module, and the
+tracks sorted by the views module, just as for the synchronous views.
+
+Set RAINBOW_ASYNC_VIEWS to route the playlists and rainbowify URLs here.
+"""
+
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.shortcuts import render, redirect
+
+from .async_downloads import get_image
+from .async_spotify import AsyncSpotifyClient
+from .auth import UserToken
+from .extraction import get_batch_size, palette_color, run_extraction
+from .jobs import submit_async_job
+from .metrics import increment, span
+from .models import DominantColor, RainbowPlaylist
+from .rainbow import (PAGE_SIZE, PLAYLIST_NAME, TRACKS_CACHE_TIMEOUT, check_following_error,
+                      find_new_tracks, find_uncolored, get_batches, get_insert_runs,
+                      get_page_params, get_playlist_data, get_playlists_cache_timeout,
+                      get_removal_data, get_tracks_cache_key, get_tracks_path,
+                      get_user_playlists_cache_key, plan_rainbow_changes, report_population)
+from .spotify import SpotifyError
+from .tracks import parse_tracks
+from .views import (get_track_palettes, playlists_error_response, report_downloads,
+                    schedule_library_index, sort_tracks)
+
+logger = logging.getLogger(__name__)
+
+
+async def playlists(request):
+    """
+    Display the user's Spotify playlists.
+
+    :param request: HttpRequest object
+    :return: HttpResponse object rendering 'playlists.html' with the user's playlists
+    """
+    token = await UserToken.afrom_session(request.session)
+    if not token:
+        return redirect('login')
+    try:
+        client = AsyncSpotifyClient(token)
+        user_id = await get_session_user_id(request, client)
+        json_result = await get_user_playlists(client, user_id)
+    except SpotifyError as error:
+        return playlists_error_response(error)
+    finally:
+        # keep any refreshed token for the user's next request
+        await token.asave(request.session)
+    # keep the user's library index fresh, so a whole-library rainbow is quick
+    await sync_to_async(schedule_library_index)(token, user_id)
+    return render(request, 'playlists.html', {'playlists': json_result})
+
+
+async def rainbowify(request):
+    """
+    Start creating a new playlist with tracks sorted by the dominant colors of their
+    album art.
+
+    The work runs as a task on the event loop; the loading page polls its status
+    until done.
+
+    :param request: HttpRequest object
+    :return: HttpResponse object rendering 'loading.html' for the started job
+    """
+    playlist_id = request.POST.get('playlist_id')
+    # the job refreshes the token itself if it runs past its expiry
+    token = await UserToken.afrom_session(request.session)
+    if not token:
+        return redirect('login')
+    user_id = await request.session.aget('user_id')
+
+    job_id = await submit_async_job(rainbowify_playlist, playlist_id, token, user_id)
+    return render(request, 'loading.html', {'job_id': job_id})
+
+
+async def rainbowify_playlist(playlist_id, access_token, user_id=None, progress=None):
+    """
+    Make or bring up to date the rainbow playlist for one of the user's playlists.
+
+    As in the views module, the playlist's snapshot ID is looked up from Spotify when
+    the job runs.
+
+    :param playlist_id: ID of the playlist to rainbowify
+    :param access_token: Spotify access token, or a callable such as a UserToken
+        returning a current one
+    :param user_id: Spotify user ID, if already known
+    :param progress: Optional coroutine function taking a stage name and percent
+        complete
+    :return: Number of tracks processed
+    """
+    async def ignore_progress(stage, percent):  # pylint: disable=unused-argument
+        pass
+
+    progress = progress or ignore_progress
+    client = AsyncSpotifyClient(access_token)
+    user_id = user_id or await get_user_name(client)
+
+    with span('rainbowify', playlist=playlist_id):
+        previous = await RainbowPlaylist.objects.filter(
+            user_id=user_id, source_playlist_id=playlist_id).afirst()
+        # a rainbow playlist the user has since removed from their library is not reused
+        if previous and await is_following_playlist(client, previous.rainbow_playlist_id,
+                                                    user_id):
+            tracks = await update_rainbow_playlist(client, previous, progress)
+        else:
+            snapshot_id = await get_playlist_snapshot_id(client, playlist_id)
+            tracks = await create_rainbow_from_playlist(client, playlist_id, user_id,
+                                                        snapshot_id, progress)
+    logger.info("Rainbowified playlist %s for %s: %d tracks", playlist_id, user_id, tracks)
+    return tracks
+
+
+async def create_rainbow_from_playlist(client, playlist_id, user_id, snapshot_id, progress):
+    """
+    Create a new playlist with tracks sorted by the dominant colors of their album art.
+
+    The new playlist is created while the tracks are fetched and their covers
+    colored.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist to rainbowify
+    :param user_id: Spotify user ID
+    :param snapshot_id: Snapshot ID of the playlist
+    :param progress: Coroutine function taking a stage name and percent complete
+    :return: Number of tracks in the new playlist
+    """
+    # the new playlist does not depend on the tracks, so create it straight away
+    playlist_task = asyncio.ensure_future(create_rainbow_playlist(client, user_id))
+    try:
+        await progress('processing tracks', 0)
+        tracks, colors = await stream_track_colors(playlist_id, client, snapshot_id)
+
+        # order the tracks by the colour of their album art
+        await progress('sorting', 80)
+        sorted_tracks = await sync_to_async(sort_tracks)(tracks, colors)
+    except Exception:
+        await discard_playlist(client, playlist_task)
+        raise
+    await progress('creating playlist', 85)
+    user_id, new_playlist_id = await playlist_task
+
+    # the user's playlist listing now includes the new playlist
+    await cache.adelete(get_user_playlists_cache_key(user_id))
+
+    await progress('adding tracks', 90)
+    if await populate_rainbow_playlist(client, new_playlist_id,
+                                       [uri for uri, _ in sorted_tracks]):
+        await RainbowPlaylist.objects.aupdate_or_create(
+            user_id=user_id, source_playlist_id=playlist_id,
+            defaults={'rainbow_playlist_id': new_playlist_id, 'snapshot_id': snapshot_id,
+                      'tracks': sorted_tracks})
+    return len(sorted_tracks)
+
+
+async def update_rainbow_playlist(client, rainbow, progress):
+    """
+    Bring an existing rainbow playlist up to date with its source playlist.
+
+    Only the tracks added to the source since the last run are colored and inserted,
+    and the tracks that have gone are removed, counting copies of a track. Nothing is
+    done if the source's current snapshot ID, fetched from Spotify, is the one last
+    recorded.
+
+    :param client: AsyncSpotifyClient object
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param progress: Coroutine function taking a stage name and percent complete
+    :return: Number of tracks added
+    """
+    snapshot_id = await get_playlist_snapshot_id(client, rainbow.source_playlist_id)
+    if snapshot_id == rainbow.snapshot_id:
+        return 0
+
+    await progress('fetching tracks', 0)
+    tracks = await get_playlist_tracks(rainbow.source_playlist_id, client, snapshot_id)
+    new_tracks = find_new_tracks(rainbow, tracks)
+
+    await progress('processing new tracks', 10)
+    added = await sync_to_async(sort_tracks)(new_tracks, await get_track_colors(new_tracks))
+
+    await progress('updating playlist', 80)
+    changes = plan_rainbow_changes(rainbow, [track.uri for track in tracks], added,
+                                   await sync_to_async(get_track_palettes)(tracks))
+    await apply_rainbow_changes(client, rainbow, snapshot_id, changes)
+    return len(added)
+
+
+async def apply_rainbow_changes(client, rainbow, snapshot_id, changes):
+    """
+    Remove the tracks that have gone from a rainbow playlist and insert new ones at
+    their places in the rainbow, then record the result.
+
+    :param client: AsyncSpotifyClient object
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param snapshot_id: Snapshot ID of the source the playlist is now up to date with
+    :param changes: Tuple of the tracks the playlist will have, the URIs to remove and
+        the tracks to insert, as plan_rainbow_changes returns it
+    """
+    merged, removed, inserted = changes
+    with span('playlist_update', playlist=rainbow.rainbow_playlist_id):
+        await remove_playlist_tracks(client, rainbow.rainbow_playlist_id, removed)
+        await insert_playlist_tracks(client, rainbow.rainbow_playlist_id, merged, inserted)
+
+    rainbow.snapshot_id = snapshot_id
+    rainbow.tracks = merged
+    await rainbow.asave()
+
+
+async def get_playlist_tracks(playlist_id, client, snapshot_id=None, on_page=None):
+    """
+    Retrieve all the tracks of a given playlist that have album art to sort by.
+
+    The first page gives the playlist's total, after which the remaining pages are
+    fetched together, up to RAINBOW_PAGE_WORKERS at a time. When the playlist's
+    snapshot ID is given, the tracks are cached against it, as in the views module.
+
+    :param playlist_id: ID of the playlist
+    :param client: AsyncSpotifyClient object
+    :param snapshot_id: Snapshot ID of the playlist, or None to skip the cache
+    :param on_page: Optional callable given the offset and tracks of each page as
+        soon as it arrives
+    :return: List of Track objects, in playlist order
+    """
+    on_page = on_page or (lambda offset, page: None)
+    cache_key = get_tracks_cache_key(playlist_id, snapshot_id)
+    if snapshot_id:
+        cached_tracks = await cache.aget(cache_key)
+        if cached_tracks is not None:
+            increment('track_cache_hits')
+            on_page(0, cached_tracks)
+            return cached_tracks
+
+    url = get_tracks_path(playlist_id)
+    limit = asyncio.Semaphore(getattr(settings, 'RAINBOW_PAGE_WORKERS', 4))
+
+    async def get_page(offset):
+        async with limit:
+            with span('track_fetch', playlist=playlist_id, offset=offset):
+                page = await client.get(url, params=get_page_params(offset))
+        page_tracks = parse_tracks(page["items"])
+        on_page(offset, page_tracks)
+        return page["total"], page_tracks
+
+    total, tracks = await get_page(0)
+    pages = await asyncio.gather(*(get_page(offset)
+                                   for offset in range(PAGE_SIZE, total, PAGE_SIZE)))
+    tracks = tracks + [track for _, page in pages for track in page]
+
+    if snapshot_id:
+        await cache.aset(cache_key, tracks, TRACKS_CACHE_TIMEOUT)
+    return tracks
+
+
+async def stream_track_colors(playlist_id, client, snapshot_id=None):
+    """
+    Fetch a playlist's tracks and the dominant colors of their album images together.
+
+    Each page's covers are looked up, downloaded and extracted as soon as the page
+    arrives, while the other pages are still being fetched.
+
+    :param playlist_id: ID of the playlist
+    :param client: AsyncSpotifyClient object
+    :param snapshot_id: Snapshot ID of the playlist, or None to skip the tracks cache
+    :return: Tuple of the list of Track objects, and the list of their dominant
+        colors in the same order, with None for any track whose cover could not be
+        colored
+    """
+    requested = {}
+    page_tasks = {}
+
+    def on_page(offset, page):
+        page_tasks[offset] = asyncio.ensure_future(get_track_colors(page, requested))
+
+    try:
+        tracks = await get_playlist_tracks(playlist_id, client, snapshot_id, on_page)
+        # in playlist order, whichever page finished first
+        page_colors = await asyncio.gather(*(page_tasks[offset]
+                                             for offset in sorted(page_tasks)))
+    except Exception:
+        for task in page_tasks.values():
+            task.cancel()
+        raise
+    return tracks, [color for colors in page_colors for color in colors]
+
+
+async def get_track_colors(tracks, requested=None):
+    """
+    Get the dominant colors of the album images for the given tracks.
+
+    Colors are looked up in the persistent color cache first, and only the covers
+    that miss are downloaded and extracted.
+
+    :param tracks: List of Track objects
+    :param requested: Optional dictionary, shared between calls, mapping the image
+        URLs already being colored to the tasks coloring them, so that covers wanted
+        by several pages are only colored once
+    :return: List of the tracks' dominant colors, in the same order, with None for
+        any track whose cover could not be colored
+    """
+    requested = {} if requested is None else requested
+    image_urls = [track.image_url for track in tracks]
+    url_colors = await sync_to_async(DominantColor.objects.lookup)(image_urls)
+    missing = find_uncolored(image_urls, url_colors, requested)
+    increment('color_cache_hits', len(url_colors))
+    increment('color_cache_misses', len(missing))
+    if missing:
+        requested.update(dict.fromkeys(missing, asyncio.ensure_future(color_images(missing))))
+
+    tasks = {requested[url] for url in image_urls if url not in url_colors}
+    for palettes in await asyncio.gather(*tasks):
+        url_colors.update((url, palette_color(palette)) for url, palette in palettes.items())
+    return [url_colors.get(image_url) for image_url in image_urls]
+
+
+async def color_images(image_urls):
+    """
+    Download album images and extract their weighted palettes, adding them to the
+    color cache.
+
+    Covers are sent for extraction in batches of RAINBOW_EXTRACTION_BATCH_SIZE in the
+    order their downloads finish, so extraction overlaps with the downloads still in
+    flight. Covers that fail to download or decode are reported and skipped.
+
+    :param image_urls: List of distinct album image URLs
+    :return: Dictionary mapping image URLs to palettes
+    """
+    batch_size = get_batch_size()
+    results = {}
+    batch = []
+    extractions = []
+    for download in asyncio.as_completed([get_image(url) for url in image_urls]):
+        result = await download
+        results[result.url] = result
+        if result.error is None:
+            batch.append(result)
+        if batch and (len(batch) == batch_size or len(results) == len(image_urls)):
+            extractions.append(asyncio.ensure_future(extract_palettes(batch)))
+            batch = []
+    report_downloads(results)
+
+    palettes = {}
+    for batch_palettes in await asyncio.gather(*extractions):
+        palettes.update(batch_palettes)
+    await sync_to_async(DominantColor.objects.remember)(palettes)
+    return palettes
+
+
+async def extract_palettes(results):
+    """
+    Extract the weighted palettes of a batch of downloaded album images.
+
+    :param results: List of successful DownloadResults
+    :return: Dictionary mapping image URLs to palettes
+    """
+    palettes = {}
+    extracted = await run_extraction([result.content for result in results])
+    for result, palette in zip(results, extracted):
+        if palette is None:
+            increment('color_extraction_failures')
+            logger.warning("Color extraction failed: %s (image could not be decoded)",
+                           result.url)
+        else:
+            palettes[result.url] = palette
+    return palettes
+
+
+async def get_session_user_id(request, client):
+    """
+    Get the Spotify user ID of the logged in user, looking it up only once per login.
+
+    :param request: HttpRequest object
+    :param client: AsyncSpotifyClient object
+    :return: User ID of the authenticated user
+    """
+    user_id = await request.session.aget('user_id')
+    if user_id is None:
+        user_id = await get_user_name(client)
+        await request.session.aset('user_id', user_id)
+    return user_id
+
+
+async def get_user_playlists(client, user_id):
+    """
+    Get the user's playlists, from the cache if they were listed recently.
+
+    :param client: AsyncSpotifyClient object
+    :param user_id: Spotify user ID
+    :return: JSON result of the playlists
+    """
+    cache_key = get_user_playlists_cache_key(user_id)
+    json_result = await cache.aget(cache_key)
+    if json_result is None:
+        json_result = (await client.get("/me/playlists"))["items"]
+        await cache.aset(cache_key, json_result, get_playlists_cache_timeout())
+    return json_result
+
+
+async def get_user_name(client):
+    """
+    Get the Spotify user ID of the authenticated user.
+
+    :param client: AsyncSpotifyClient object
+    :return: User ID of the authenticated user
+    """
+    return (await client.get("/me"))["id"]
+
+
+async def discard_playlist(client, playlist_task):
+    """
+    Remove a playlist created for a rainbowify run that then failed.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_task: Task resolving to the (user ID, playlist ID) tuple returned
+        by create_rainbow_playlist
+    """
+    try:
+        _, playlist_id = await playlist_task
+    except Exception:  # pylint: disable=broad-exception-caught
+        return
+    try:
+        await client.request('DELETE', f"/playlists/{playlist_id}/followers")
+    except SpotifyError as error:
+        logger.warning("Could not remove playlist %s: %s", playlist_id, error)
+
+
+async def create_rainbow_playlist(client, user_id=None, name=PLAYLIST_NAME):
+    """
+    Create the new, 'rainbowified' playlist for the user.
+
+    :param client: AsyncSpotifyClient object
+    :param user_id: Spotify user ID, looked up if not known
+    :param name: Name of the playlist
+    :return: Tuple of the user ID and the ID of the created playlist
+    """
+    user_id = user_id or await get_user_name(client)
+    try:
+        with span('playlist_create', user=user_id):
+            result = await client.post(f"/users/{user_id}/playlists",
+                                       json=get_playlist_data(name))
+    except SpotifyError as error:
+        logger.error("Playlist creation error. Code: %s, Response: %s",
+                     error.status_code, error)
+        raise RuntimeError("The rainbow playlist could not be created") from error
+    logger.info("Playlist %s created for %s", result["id"], user_id)
+    return user_id, result["id"]
+
+
+async def populate_rainbow_playlist(client, playlist_id, uris):
+    """
+    Populate the playlist with the given URIs.
+
+    The batches are sent one after another, rather than together, so the playlist
+    keeps the given order, and adding stops at the first failed batch.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist to populate
+    :param uris: List of track URIs to add to the playlist
+    :return: True if every track was added
+    """
+    with span('playlist_populate', playlist=playlist_id, tracks=len(uris)):
+        for batch in get_batches(uris):
+            try:
+                await client.post(get_tracks_path(playlist_id), json={"uris": batch})
+            except SpotifyError as error:
+                return report_population(playlist_id, uris, error)
+    return report_population(playlist_id, uris)
+
+
+async def insert_playlist_tracks(client, playlist_id, tracks, inserted):
+    """
+    Insert new tracks into a playlist at their positions in the given order.
+
+    Runs are inserted one after another, from the start of the playlist, so that
+    every position is already final when it is used.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param tracks: List of [track URI, color] pairs in the playlist's intended order,
+        of which every track not marked as inserted is already in the playlist
+    :param inserted: List of booleans, True for each of the tracks to insert
+    """
+    for position, run in get_insert_runs(tracks, inserted):
+        await client.post(get_tracks_path(playlist_id),
+                          json={"uris": run, "position": position})
+    logger.info("%d tracks inserted into playlist %s", sum(inserted), playlist_id)
+
+
+async def remove_playlist_tracks(client, playlist_id, uris):
+    """
+    Remove every occurrence of the given tracks from a playlist.
+
+    Removals do not depend on each other's positions, so the batches are sent
+    together.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param uris: List of track URIs to remove
+    """
+    url = get_tracks_path(playlist_id)
+    await asyncio.gather(*(client.request('DELETE', url, json=get_removal_data(batch))
+                           for batch in get_batches(uris)))
+    if uris:
+        logger.info("%d tracks removed from playlist %s", len(uris), playlist_id)
+
+
+async def get_playlist_snapshot_id(client, playlist_id):
+    """
+    Get the current snapshot ID of a playlist.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist
+    :return: Snapshot ID of the playlist
+    """
+    result = await client.get(f"/playlists/{playlist_id}", params={"fields": "snapshot_id"})
+    return result["snapshot_id"]
+
+
+async def is_following_playlist(client, playlist_id, user_id):
+    """
+    Check whether a playlist is still in the user's library.
+
+    :param client: AsyncSpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param user_id: Spotify user ID
+    :return: True if the user follows the playlist
+    """
+    url = f"/playlists/{playlist_id}/followers/contains"
+    try:
+        result = await client.get(url, params={"ids": user_id})
+    except SpotifyError as error:
+        return check_following_error(error)
+    return bool(result and result[0])
@@ -0,0 +1,234 @@
+"""
+Spotify OAuth tokens for the Rainbow Playlists application.
+
+Access tokens last an hour. A UserToken tracks when its access token expires and
+swaps it for a new one, using the refresh token, shortly before it does, so neither
+a page view nor a long rainbowify job ever sends an expired token.
+
+Refreshes are single-flight. Within a process, callers holding the same refresh
+token queue on one lock; across processes, the first caller takes a lock in Django's
+cache and the rest wait for it. The new token is kept in the cache, keyed by the
+refresh token it came from, so every session and job holding the old token picks up
+the new one without another call to the accounts service.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from dotenv import load_dotenv
+
+from .spotify import SpotifyClient, get_accounts_url
+
+# load environment variables
+load_dotenv()
+
+CLIENT_ID = os.getenv("CLIENT_ID")
+CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+
+# refresh access tokens this many seconds before they expire
+DEFAULT_REFRESH_MARGIN = 5 * 60
+# longest a refresh may hold the cross-process lock, in seconds
+REFRESH_LOCK_TIMEOUT = 30
+# how often a caller waiting on another process's refresh checks for it, in seconds
+REFRESH_POLL_INTERVAL = 0.1
+
+_refresh_locks = {}
+_refresh_locks_lock = threading.Lock()
+
+
+def request_token(data):
+    """
+    Request a token from the Spotify accounts service.
+
+    :param data: Grant parameters, without the client credentials
+    :return: Decoded JSON token response
+    """
+    data = dict(data, client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
+    return SpotifyClient().post(get_accounts_url("/api/token"), data=data)
+
+
+def get_refresh_lock(cache_key):
+    """
+    Get the lock serializing this process's refreshes of one refresh token.
+
+    :param cache_key: Cache key of the refresh token
+    :return: threading.Lock shared by every refresh of that token in the process
+    """
+    with _refresh_locks_lock:
+        return _refresh_locks.setdefault(cache_key, threading.Lock())
+
+
+class UserToken:
+    """
+    A user's Spotify access token, refreshed automatically before it expires.
+
+    Calling the token returns a current access token, so it can be given to a
+    SpotifyClient in place of a fixed one.
+    """
+
+    def __init__(self, access_token, refresh_token=None, expires_at=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_response(cls, response_data, refresh_token=None):
+        """
+        Create a token from an accounts service token response.
+
+        :param response_data: Decoded JSON token response
+        :param refresh_token: Refresh token to keep if the response does not rotate it
+        :return: UserToken object
+        """
+        return cls(response_data['access_token'],
+                   response_data.get('refresh_token', refresh_token),
+                   time.time() + response_data['expires_in'])
+
+    @classmethod
+    def from_authorization_code(cls, code, redirect_uri):
+        """
+        Exchange an authorization code from the login callback for a token.
+
+        :param code: Authorization code
+        :param redirect_uri: Redirect URI the code was issued for
+        :return: UserToken object
+        """
+        return cls.from_response(request_token({
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": redirect_uri,
+        }))
+
+    @classmethod
+    def from_session(cls, session):
+        """
+        Load the logged in user's token from their session.
+
+        :param session: Django session
+        :return: UserToken object, or None if the user has not logged in
+        """
+        if not session.get('access_token'):
+            return None
+        return cls(session['access_token'], session.get('refresh_token'),
+                   session.get('expires_at'))
+
+    def save(self, session):
+        """
+        Store the token in a session, if it has changed.
+
+        :param session: Django session
+        """
+        for key in ('access_token', 'refresh_token', 'expires_at'):
+            if session.get(key) != getattr(self, key):
+                session[key] = getattr(self, key)
+
+    @classmethod
+    async def afrom_session(cls, session):
+        """
+        Load the logged in user's token from their session, in an async view.
+
+        :param session: Django session
+        :return: UserToken object, or None if the user has not logged in
+        """
+        if not await session.aget('access_token'):
+            return None
+        return cls(await session.aget('access_token'), await session.aget('refresh_token'),
+                   await session.aget('expires_at'))
+
+    async def asave(self, session):
+        """
+        Store the token in a session, if it has changed, in an async view.
+
+        :param session: Django session
+        """
+        for key in ('access_token', 'refresh_token', 'expires_at'):
+            if await session.aget(key) != getattr(self, key):
+                await session.aset(key, getattr(self, key))
+
+    def get_cache_key(self):
+        """
+        Get the cache key under which refreshes of this token are shared.
+
+        :return: Cache key string
+        """
+        digest = hashlib.sha256(self.refresh_token.encode()).hexdigest()
+        return f"spotify-token:{digest}"
+
+    def expires_soon(self):
+        """
+        Check whether the access token is expired or about to expire.
+
+        :return: True if the token should be refreshed before it is used
+        """
+        margin = getattr(settings, 'RAINBOW_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN)
+        return self.expires_at is not None and time.time() >= self.expires_at - margin
+
+    def __call__(self):
+        """
+        Get a current access token, refreshing it first if it is about to expire.
+
+        :return: Access token string
+        """
+        with self.lock:
+            if self.refresh_token and self.expires_soon():
+                self.refresh()
+            return self.access_token
+
+    def adopt(self, token_data):
+        """
+        Take on the values of a refreshed token.
+
+        :param token_data: Dictionary with access_token, refresh_token and expires_at
+        """
+        self.access_token = token_data['access_token']
+        self.refresh_token = token_data['refresh_token']
+        self.expires_at = token_data['expires_at']
+
+    def shared_token(self):
+        """
+        Get a refreshed token another caller has already shared through the cache.
+
+        :return: Dictionary of token values, or None if there is no usable one
+        """
+        token_data = cache.get(self.get_cache_key())
+        if token_data and not UserToken(**token_data).expires_soon():
+            return token_data
+        return None
+
+    def refresh(self):
+        """
+        Exchange the refresh token for a new access token, unless another caller
+        already has.
+        """
+        cache_key = self.get_cache_key()
+        lock_key = f"{cache_key}:lock"
+        with get_refresh_lock(cache_key):
+            deadline = time.monotonic() + REFRESH_LOCK_TIMEOUT
+            while True:
+                token_data = self.shared_token()
+                if token_data:
+                    self.adopt(token_data)
+                    return
+                # only one process refreshes; the others wait for its result, and
+                # take over if it has not arrived by the time the lock would expire
+                if cache.add(lock_key, True, REFRESH_LOCK_TIMEOUT) or time.monotonic() > deadline:
+                    break
+                time.sleep(REFRESH_POLL_INTERVAL)
+
+            try:
+                refreshed = UserToken.from_response(request_token({
+                    "grant_type": "refresh_token",
+                    "refresh_token": self.refresh_token,
+                }), self.refresh_token)
+                token_data = {'access_token': refreshed.access_token,
+                              'refresh_token': refreshed.refresh_token,
+                              'expires_at': refreshed.expires_at}
+                cache.set(cache_key, token_data, max(1, int(refreshed.expires_at - time.time())))
+                self.adopt(token_data)
+            finally:
+                cache.delete(lock_key)
@@ -48,8 +48,7 @@ colors = [
     (47, 79, 79),       # dark slate gray
     (0, 128, 128),      # teal
     (0, 139, 139),      # dark cyan
-    (0, 255, 255),      # aqua
-    (0, 255, 255),      # cyan
+    (0, 255, 255),      # aqua / cyan
     (224, 255, 255),    # light cyan
     (0, 206, 209),      # dark turquoise
     (64, 224, 208),     # turquoise
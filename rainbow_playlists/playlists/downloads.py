@@ -0,0 +1,311 @@
+"""
+Concurrent album art downloader for the Rainbow Playlists application.
+
+Covers are fetched by a bounded thread pool over a single pooled, keep-alive
+requests session. Identical URLs are only downloaded once (tracks from the same
+album share a cover), and concurrency is limited per host so a large playlist
+does not hammer a single CDN node: downloads beyond a host's limit wait in that
+host's queue, not in pool threads, so they never hold a thread another host could
+use. ``stream_images`` starts each download as soon
+as its URL is produced, so covers can be fetched while later URLs are still being
+worked out; streams share one thread pool per process, and concurrent streams
+wanting the same cover share a single download of it. Every download is timed,
+and counted with its size, in the metrics module.
+
+Covers are kept in the on-disk image cache, so a cover already fetched by any
+worker is read from disk, or at most revalidated with a conditional request, rather
+than downloaded again.
+"""
+
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import image_cache, metrics
+
+DEFAULT_WORKERS = 16
+DEFAULT_PER_HOST = 8
+CHUNK_SIZE = 64 * 1024
+
+# outcome of a single download; content is None when error is set
+DownloadResult = namedtuple('DownloadResult', ['url', 'content', 'elapsed', 'error'])
+
+_host_queues = {}
+_host_queues_lock = threading.Lock()
+
+# downloads currently running for streams, by URL, so concurrent streams share them
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def get_worker_count():
+    """
+    Get the number of concurrent download threads.
+
+    :return: Size of the download thread pool
+    """
+    return getattr(settings, 'RAINBOW_DOWNLOAD_WORKERS', DEFAULT_WORKERS)
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """
+    Get the shared requests session used for all image downloads.
+
+    The session is created on first use, with a connection pool large enough for
+    every download thread to keep its own connection alive.
+
+    :return: requests.Session object
+    """
+    pool_size = get_worker_count()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """
+    Get the thread pool shared by every streamed download in the process.
+
+    :return: concurrent.futures.ThreadPoolExecutor object
+    """
+    return ThreadPoolExecutor(max_workers=get_worker_count(),
+                              thread_name_prefix='image-download')
+
+
+class HostQueue:
+    """
+    Queue starting one host's downloads on the shared pool, a few at a time.
+
+    At most ``limit`` of the host's downloads are on the pool at once; the rest wait
+    here, and each one finishing starts the next.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = deque()
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Run a function on the shared pool once the host has a free slot.
+
+        :param func: Function to run
+        :param args: Arguments to call it with
+        :return: concurrent.futures.Future resolving to the function's result
+        """
+        future = Future()
+        with self.lock:
+            if self.running >= self.limit:
+                self.waiting.append((future, func, args))
+                return future
+            self.running += 1
+        self.start(future, func, args)
+        return future
+
+    def start(self, future, func, args):
+        """
+        Run a queued function on the shared pool, taking the slot it was given.
+
+        :param future: Future to resolve with the function's result
+        :param func: Function to run
+        :param args: Arguments to call it with
+        """
+        def done(pool_future):
+            error = pool_future.exception()
+            if error is None:
+                future.set_result(pool_future.result())
+            else:
+                future.set_exception(error)
+            self.release()
+
+        get_executor().submit(func, *args).add_done_callback(done)
+
+    def release(self):
+        """
+        Hand a finished download's slot to the next waiting one, if any.
+        """
+        with self.lock:
+            if not self.waiting:
+                self.running -= 1
+                return
+            queued = self.waiting.popleft()
+        self.start(*queued)
+
+
+def get_host_queue(url):
+    """
+    Get the queue limiting concurrent downloads from the host of a URL.
+
+    :param url: URL of the image
+    :return: HostQueue shared by all downloads from that host
+    """
+    host = urlsplit(url).netloc
+    with _host_queues_lock:
+        if host not in _host_queues:
+            per_host = getattr(settings, 'RAINBOW_DOWNLOAD_PER_HOST', DEFAULT_PER_HOST)
+            _host_queues[host] = HostQueue(per_host)
+        return _host_queues[host]
+
+
+def read_cached(image_url):
+    """
+    Read an image from the image cache.
+
+    :param image_url: URL of the image
+    :return: Tuple of the CachedImage, or None if the URL is not cached, and the bytes
+        of the image, or None if they are not on disk
+    """
+    cached = image_cache.lookup(image_url)
+    return cached, image_cache.read(cached) if cached else None
+
+
+def fetch_image(image_url):
+    """
+    Get a single image into memory, from the image cache or by downloading it.
+
+    A fresh cached copy is used as it is. A stale one is revalidated with the CDN,
+    and only downloaded again if it has changed. Failures are captured in the result
+    rather than raised, so one bad cover does not abort the rest of the batch.
+
+    :param image_url: URL of the image
+    :return: DownloadResult for the image
+    """
+    start = time.perf_counter()
+    cached, content = read_cached(image_url)
+    if content is not None and image_cache.is_fresh(cached):
+        metrics.increment('image_cache_hits')
+        return DownloadResult(image_url, content, time.perf_counter() - start, None)
+    try:
+        # only a copy still on disk can be revalidated
+        response = get_session().get(
+            image_url, stream=True, timeout=10,
+            headers=image_cache.get_validators(cached) if content is not None else None)
+        if response.status_code == 304 and content is not None:
+            response.close()
+        else:
+            response.raise_for_status()
+            content = b"".join(response.iter_content(chunk_size=CHUNK_SIZE))
+    except requests.RequestException as error:
+        metrics.increment('image_download_failures')
+        return DownloadResult(image_url, None, time.perf_counter() - start, error)
+    return finish_download(image_url, start, cached, content, response)
+
+
+def finish_download(image_url, start, cached, content, response):
+    """
+    Time and count a completed download or revalidation, and update the image cache.
+
+    :param image_url: URL of the image
+    :param start: time.perf_counter() value when fetching the image began
+    :param cached: CachedImage the request was made conditional on, or None
+    :param content: Bytes of the image, downloaded or, if revalidated, cached
+    :param response: Response to the request, 304 if the cached copy was revalidated
+    :return: DownloadResult for the image
+    """
+    elapsed = time.perf_counter() - start
+    metrics.observe('image_download', elapsed)
+    if response.status_code == 304 and cached is not None:
+        metrics.increment('image_cache_revalidations')
+        image_cache.refresh(cached, response.headers)
+    else:
+        metrics.increment('images_downloaded')
+        metrics.increment('image_bytes_downloaded', len(content))
+        image_cache.store(image_url, content, response.headers)
+    return DownloadResult(image_url, content, elapsed, None)
+
+
+def get_download_totals():
+    """
+    Get the number of images, and bytes, this process has downloaded so far.
+
+    :return: Dictionary with 'images' and 'bytes' counts
+    """
+    counters = metrics.snapshot()['counters']
+    return {'images': counters['images_downloaded'],
+            'bytes': counters['image_bytes_downloaded']}
+
+
+def submit_image(image_url):
+    """
+    Queue an image download on the shared pool, or join one already in flight.
+
+    The download waits in its host's queue until the host has a free slot.
+
+    :param image_url: URL of the image
+    :return: concurrent.futures.Future resolving to the DownloadResult
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(image_url)
+        if future is not None:
+            metrics.increment('image_downloads_shared')
+            return future
+        future = get_host_queue(image_url).submit(fetch_image, image_url)
+        _in_flight[image_url] = future
+
+    def forget(done):
+        with _in_flight_lock:
+            if _in_flight.get(image_url) is done:
+                del _in_flight[image_url]
+
+    future.add_done_callback(forget)
+    return future
+
+
+def stream_images(image_urls):
+    """
+    Download images whose URLs are produced lazily, yielding each as it arrives.
+
+    The URLs are consumed on a feeder thread, and every new URL is queued for
+    download straight away rather than after the whole iterable has been read.
+    Exceptions raised while producing the URLs are re-raised to the consumer.
+
+    :param image_urls: Iterable of image URLs, such as a generator; duplicates are
+        fetched once
+    :return: Generator of DownloadResult, in completion order
+    """
+    finished = queue.Queue()
+    stopped = threading.Event()
+
+    def feed():
+        seen = set()
+        try:
+            for url in image_urls:
+                if stopped.is_set():
+                    break
+                if url not in seen:
+                    seen.add(url)
+                    submit_image(url).add_done_callback(finished.put)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            finished.put(error)
+        finally:
+            # sentinel carrying the number of downloads started
+            finished.put(len(seen))
+
+    threading.Thread(target=feed, name='image-feed', daemon=True).start()
+    try:
+        received, expected = 0, None
+        while expected is None or received < expected:
+            item = finished.get()
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, int):
+                expected = item
+                continue
+            received += 1
+            yield item.result()
+    finally:
+        # downloads already queued still finish, since other streams may share them
+        stopped.set()
@@ -0,0 +1,278 @@
+"""
+Dominant color extraction for album art.
+
+Each cover is decoded straight to a small working size (the JPEG decoder's draft
+mode scales while decoding rather than after it) and every ``quality``-th pixel is
+handed to one of two interchangeable engines. 'numpy' is this app's vectorized port
+of ColorThief's median cut quantizer in the quantize module; 'colorthief' runs the
+ColorThief library itself, which gives the same colors far more slowly. ColorThief
+over the full-size cover at quality=1 is the reference the benchmark_extraction
+management command compares every engine and setting against.
+
+Median cut is CPU-bound and holds the GIL, so covers are extracted in batches on a
+process pool sized to the host. Workers receive the raw image bytes and the resolved
+options, so they need neither the filesystem nor Django settings. Each cover's
+small weighted palette comes out of the same median cut as its dominant color, and
+is what workers return; the dominant color is the palette's first entry. The async
+views hand batches to the same pool through ``run_extraction``.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from colorthief import MMCQ, ColorThief
+from django.conf import settings
+from PIL import Image
+
+from . import metrics, quantize
+
+ENGINES = ('numpy', 'colorthief')
+DEFAULT_ENGINE = 'numpy'
+DEFAULT_COVER_MIN_SIZE = 64
+DEFAULT_MAX_SIZE = 64
+DEFAULT_QUALITY = 1
+DEFAULT_BATCH_SIZE = 8
+
+
+def get_extraction_options():
+    """
+    Get the configured color engine, working size and sampling stride.
+
+    :return: Tuple of (engine, max_size, quality)
+    """
+    return (getattr(settings, 'RAINBOW_COLOR_ENGINE', DEFAULT_ENGINE),
+            getattr(settings, 'RAINBOW_EXTRACTION_MAX_SIZE', DEFAULT_MAX_SIZE),
+            getattr(settings, 'RAINBOW_EXTRACTION_QUALITY', DEFAULT_QUALITY))
+
+
+def select_album_image(images, min_size=None):
+    """
+    Pick the smallest album image that is at least the given size.
+
+    Falls back to the largest image if none are big enough, and to the last listed
+    image if the API gave no sizes.
+
+    :param images: List of Spotify image objects, with url, width and height
+    :param min_size: Smallest acceptable width in pixels, defaults to
+        RAINBOW_COVER_MIN_SIZE
+    :return: URL of the chosen image
+    """
+    if min_size is None:
+        min_size = getattr(settings, 'RAINBOW_COVER_MIN_SIZE', DEFAULT_COVER_MIN_SIZE)
+    sized = [image for image in images if image.get('width')]
+    if not sized:
+        return images[-1]['url']
+    large_enough = [image for image in sized if image['width'] >= min_size]
+    if large_enough:
+        return min(large_enough, key=lambda image: image['width'])['url']
+    return max(sized, key=lambda image: image['width'])['url']
+
+
+def decode_image(source, max_size=None):
+    """
+    Decode an image, scaled down so neither side exceeds max_size.
+
+    :param source: Path of the image file, or a file-like object holding the image
+    :param max_size: Largest side in pixels, or 0 to decode at full size
+    :return: PIL Image object
+    """
+    image = Image.open(source)
+    if max_size:
+        # lets the JPEG decoder scale by 1/2, 1/4 or 1/8 as it decodes
+        image.draft('RGB', (max_size, max_size))
+        image.thumbnail((max_size, max_size))
+    return image
+
+
+class ImageColorThief(ColorThief):
+    """
+    ColorThief over an image that has already been decoded.
+    """
+
+    def __init__(self, image):  # pylint: disable=super-init-not-called
+        # ColorThief's constructor would open the image from a file
+        self.image = image
+
+    def get_weighted_palette(self, color_count=quantize.PALETTE_SIZE, quality=1):
+        """
+        Build a color palette as get_palette does, with each color's weight.
+
+        :param color_count: Maximum number of colors
+        :param quality: Sampling stride over the pixels, 1 examines every pixel
+        :return: List of [red, green, blue, weight] lists, the dominant color first
+        """
+        pixels = [tuple(pixel) for pixel in
+                  quantize.get_valid_pixels(self.image, quality).tolist()]
+        if not pixels:
+            return [[*quantize.EMPTY_COLOR, 1.0]]
+        cmap = MMCQ.quantize(pixels, color_count)
+        # the queue's map gives the boxes in palette order
+        boxes = cmap.vboxes.map(lambda box: box)
+        return [[*box['color'], round(box['vbox'].count / len(pixels), 4)]
+                for box in boxes if box['vbox'].count]
+
+
+def get_image_palettes(images, engine, quality):
+    """
+    Get the weighted palettes of a batch of decoded images.
+
+    :param images: List of PIL Image objects
+    :param engine: 'numpy' or 'colorthief'
+    :param quality: Sampling stride over the pixels, 1 examines every pixel
+    :return: List of palettes, each a list of [red, green, blue, weight] lists with
+        the dominant color first, in the same order as the images
+    """
+    if engine == 'numpy':
+        return quantize.get_palettes(images, quality)
+    if engine == 'colorthief':
+        return [ImageColorThief(image).get_weighted_palette(quality=quality)
+                for image in images]
+    raise ValueError(f"Unknown color engine {engine!r}, expected one of {ENGINES}")
+
+
+def palette_color(palette):
+    """
+    Get the dominant color of a palette.
+
+    :param palette: List of [red, green, blue, weight] lists, the dominant color first
+    :return: Tuple representing the RGB values of the dominant color
+    """
+    return tuple(palette[0][:3])
+
+
+def extract_palettes(contents, options):
+    """
+    Get the weighted palettes of a batch of images held in memory.
+
+    This is the process pool's entry point, so it takes every option explicitly. An
+    image that cannot be decoded gives None rather than failing the whole batch.
+
+    :param contents: List of image bytes
+    :param options: Tuple of (engine, max_size, quality)
+    :return: List of palettes, or None for undecodable images, in the same order as
+        the contents
+    """
+    engine, max_size, quality = options
+    images = {}
+    for index, content in enumerate(contents):
+        try:
+            image = decode_image(BytesIO(content), max_size)
+            image.load()
+        except OSError:
+            continue
+        images[index] = image
+    palettes = dict(zip(images, get_image_palettes(list(images.values()), engine, quality)))
+    return [palettes.get(index) for index in range(len(contents))]
+
+
+def extract_colors(contents, options):
+    """
+    Get the dominant colors of a batch of images held in memory.
+
+    :param contents: List of image bytes
+    :param options: Tuple of (engine, max_size, quality)
+    :return: List of RGB tuples, or None for undecodable images, in the same order
+        as the contents
+    """
+    return [palette and palette_color(palette)
+            for palette in extract_palettes(contents, options)]
+
+
+def timed_extract_palettes(contents, options):
+    """
+    Get the weighted palettes of a batch of images, and how long that took.
+
+    Timed in the worker, so the time excludes waiting for a free worker.
+
+    :param contents: List of image bytes
+    :param options: Tuple of (engine, max_size, quality)
+    :return: Tuple of (list extract_palettes returns, seconds taken)
+    """
+    start = time.perf_counter()
+    palettes = extract_palettes(contents, options)
+    return palettes, time.perf_counter() - start
+
+
+@lru_cache(maxsize=None)
+def get_process_pool():
+    """
+    Get the process pool shared by every extraction in this process.
+
+    Workers are spawned rather than forked, since forking a process that is running
+    job and download threads can copy held locks into the children.
+
+    :return: concurrent.futures.ProcessPoolExecutor object
+    """
+    workers = getattr(settings, 'RAINBOW_EXTRACTION_PROCESSES', None) or os.cpu_count()
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_batch_size():
+    """
+    Get the number of images sent to an extraction worker at a time.
+
+    :return: Batch size
+    """
+    return getattr(settings, 'RAINBOW_EXTRACTION_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def submit_extraction(contents):
+    """
+    Queue the extraction of a batch of images' weighted palettes.
+
+    When RAINBOW_EXTRACTION_PROCESSES is 0, the palettes are extracted right away in
+    this process instead. The time the batch takes is recorded in the
+    color_extraction span, one observation per image.
+
+    :param contents: List of image bytes
+    :return: concurrent.futures.Future resolving to the list extract_palettes returns
+    """
+    options = get_extraction_options()
+    future = Future()
+
+    def finish(result):
+        palettes, elapsed = result
+        metrics.observe('color_extraction', elapsed, count=len(contents))
+        future.set_result(palettes)
+
+    if getattr(settings, 'RAINBOW_EXTRACTION_PROCESSES', None) == 0:
+        try:
+            finish(timed_extract_palettes(contents, options))
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            future.set_exception(error)
+        return future
+
+    def done(pool_future):
+        try:
+            finish(pool_future.result())
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            future.set_exception(error)
+
+    get_process_pool().submit(timed_extract_palettes, contents, options).add_done_callback(done)
+    return future
+
+
+async def run_extraction(contents):
+    """
+    Extract the weighted palettes of a batch of images in an executor, for code
+    running on an event loop.
+
+    The batch goes to the process pool, or when RAINBOW_EXTRACTION_PROCESSES is 0 to
+    a thread, so the loop carries on serving other requests meanwhile. Its time is
+    recorded as submit_extraction records it.
+
+    :param contents: List of image bytes
+    :return: List extract_palettes returns
+    """
+    in_process = getattr(settings, 'RAINBOW_EXTRACTION_PROCESSES', None) == 0
+    executor = None if in_process else get_process_pool()
+    palettes, elapsed = await asyncio.get_running_loop().run_in_executor(
+        executor, timed_extract_palettes, contents, get_extraction_options())
+    metrics.observe('color_extraction', elapsed, count=len(contents))
+    return palettes
@@ -0,0 +1,336 @@
+"""
+Content-addressed on-disk cache of album art, shared by every worker process.
+
+Each cover is stored once, named by the SHA-256 of its bytes, however many URLs
+serve it. Each URL has a small record of the hash it last resolved to, with the
+ETag, Last-Modified date and freshness lifetime the CDN sent. A cover that is still
+fresh is read straight from disk. A stale one is revalidated with a conditional
+request, so an unchanged cover costs a 304 response and no image bytes.
+
+Files are written under a temporary name and renamed into place, so readers in
+other threads and processes never see a partial file; a file removed by another
+process's eviction just counts as a miss. Disk use is bounded by
+RAINBOW_IMAGE_CACHE_SIZE: reading a file refreshes its modification time, and the
+least recently used files are evicted once the cache grows past the limit.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# eviction brings the cache down to this fraction of its limit, so it is not needed
+# again straight away
+EVICTION_TARGET = 0.9
+# fraction of the limit written by this process between checks on the cache's size
+EVICTION_CHECK_INTERVAL = 0.05
+# temporary files older than this, in seconds, were left by a writer that died
+STALE_TEMP_AGE = 60 * 60
+TEMP_PREFIX = ".tmp-"
+
+# what the cache knows about a URL: the hash of its cover and the CDN's validators
+CachedImage = namedtuple('CachedImage', ['url', 'sha256', 'etag', 'last_modified', 'expires'])
+
+# bytes this process has added to the cache since it last checked the cache's size
+_written = {'bytes': 0}
+_written_lock = threading.Lock()
+_eviction_lock = threading.Lock()
+
+
+def get_cache_directory():
+    """
+    Get the directory the image cache is kept in.
+
+    :return: Path of the directory, or None if the cache is disabled
+    """
+    directory = getattr(settings, 'RAINBOW_IMAGE_CACHE_DIR', None)
+    return os.fspath(directory) if directory else None
+
+
+def get_cache_size():
+    """
+    Get the most disk space the image cache may use.
+
+    :return: Size in bytes
+    """
+    return getattr(settings, 'RAINBOW_IMAGE_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+
+def get_blob_path(directory, digest):
+    """
+    Get the path of the cover with the given hash.
+
+    :param directory: Cache directory
+    :param digest: SHA-256 hex digest of the cover
+    :return: Path of the file
+    """
+    return os.path.join(directory, 'blobs', digest[:2], digest)
+
+
+def get_record_path(directory, url):
+    """
+    Get the path of a URL's record.
+
+    :param directory: Cache directory
+    :param url: URL of the cover
+    :return: Path of the file
+    """
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(directory, 'urls', key[:2], f"{key}.json")
+
+
+def write_atomic(path, data):
+    """
+    Write a file so that readers only ever see it complete.
+
+    :param path: Path of the file
+    :param data: Bytes to write
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def get_freshness(headers):
+    """
+    Get how long a response may be reused without asking the CDN again.
+
+    :param headers: Response headers
+    :return: Lifetime in seconds, 0 if it must be revalidated every time, or None if
+        it must not be stored at all
+    """
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    try:
+        return max(int(directives.get('max-age', 0)), 0)
+    except ValueError:
+        return 0
+
+
+def lookup(url):
+    """
+    Look up what the cache knows about a URL.
+
+    :param url: URL of the cover
+    :return: CachedImage, or None if the URL is not cached or the cache is disabled
+    """
+    directory = get_cache_directory()
+    if directory is None:
+        return None
+    try:
+        with open(get_record_path(directory, url), 'rb') as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if record.get('url') != url:
+        return None
+    return CachedImage(url, record['sha256'], record.get('etag'), record.get('last_modified'),
+                       record.get('expires', 0))
+
+
+def read(cached):
+    """
+    Read a cached cover, marking it as recently used.
+
+    :param cached: CachedImage from lookup
+    :return: Bytes of the cover, or None if it has been evicted
+    """
+    directory = get_cache_directory()
+    if directory is None:
+        return None
+    path = get_blob_path(directory, cached.sha256)
+    try:
+        with open(path, 'rb') as file:
+            content = file.read()
+        os.utime(path)
+        os.utime(get_record_path(directory, cached.url))
+    except OSError:
+        return None
+    return content
+
+
+def is_fresh(cached):
+    """
+    Check whether a cached cover may be used without asking the CDN.
+
+    :param cached: CachedImage from lookup
+    :return: True if the cover's freshness lifetime has not run out
+    """
+    return time.time() < cached.expires
+
+
+def get_validators(cached):
+    """
+    Get the headers that make a request for a cached cover conditional.
+
+    :param cached: CachedImage from lookup, or None
+    :return: Dictionary of request headers
+    """
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+def save_record(directory, url, digest, headers, freshness):
+    """
+    Record the cover a URL resolves to, with the CDN's validators.
+
+    :param directory: Cache directory
+    :param url: URL of the cover
+    :param digest: SHA-256 hex digest of the cover
+    :param headers: Response headers
+    :param freshness: Lifetime of the response in seconds
+    """
+    record = {'url': url, 'sha256': digest, 'etag': headers.get('ETag'),
+              'last_modified': headers.get('Last-Modified'),
+              'expires': time.time() + freshness}
+    write_atomic(get_record_path(directory, url), json.dumps(record).encode())
+
+
+def store(url, content, headers):
+    """
+    Add a downloaded cover to the cache.
+
+    The cover's file is only written if no URL has stored the same bytes already.
+    Failures are logged rather than raised, since the cover has been downloaded
+    either way.
+
+    :param url: URL of the cover
+    :param content: Bytes of the cover
+    :param headers: Response headers
+    """
+    directory = get_cache_directory()
+    freshness = get_freshness(headers)
+    if directory is None or freshness is None:
+        return
+    digest = hashlib.sha256(content).hexdigest()
+    path = get_blob_path(directory, digest)
+    try:
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            write_atomic(path, content)
+            record_written(len(content))
+        save_record(directory, url, digest, headers, freshness)
+    except OSError as error:
+        logger.warning("Could not cache image %s: %s", url, error)
+
+
+def refresh(cached, headers):
+    """
+    Renew a cached cover's freshness after the CDN confirmed it is unchanged.
+
+    :param cached: CachedImage from lookup
+    :param headers: Headers of the 304 response
+    """
+    directory = get_cache_directory()
+    freshness = get_freshness(headers)
+    if directory is None or freshness is None:
+        return
+    # a 304 only carries the validators that have changed
+    merged = {'ETag': headers.get('ETag') or cached.etag,
+              'Last-Modified': headers.get('Last-Modified') or cached.last_modified}
+    try:
+        save_record(directory, cached.url, cached.sha256, merged, freshness)
+    except OSError as error:
+        logger.warning("Could not cache image %s: %s", cached.url, error)
+
+
+def record_written(size):
+    """
+    Count bytes this process has added to the cache, evicting once enough have been
+    written since the last check.
+
+    :param size: Number of bytes written
+    """
+    with _written_lock:
+        _written['bytes'] += size
+        if _written['bytes'] < get_cache_size() * EVICTION_CHECK_INTERVAL:
+            return
+        _written['bytes'] = 0
+    evict()
+
+
+def list_files(directory):
+    """
+    List the files in the cache, skipping temporary files still being written.
+
+    :param directory: Cache directory
+    :return: List of (modification time, size, path) tuples
+    """
+    files = []
+    now = time.time()
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(TEMP_PREFIX) and now - stat.st_mtime < STALE_TEMP_AGE:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
+
+
+def evict():
+    """
+    Delete the least recently used files until the cache is back within its limit.
+
+    Only one thread per process evicts at a time, and files another process has
+    already deleted are skipped.
+
+    :return: Number of files deleted
+    """
+    directory = get_cache_directory()
+    if directory is None:
+        return 0
+    with _eviction_lock:
+        files = list_files(directory)
+        total = sum(size for _, size, _ in files)
+        max_size = get_cache_size()
+        if total <= max_size:
+            return 0
+        deleted = 0
+        for _, size, path in sorted(files):
+            if total <= max_size * EVICTION_TARGET:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+        metrics.increment('image_cache_evictions', deleted)
+        logger.info("Evicted %d files from the image cache", deleted)
+        return deleted
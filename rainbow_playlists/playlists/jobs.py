@@ -0,0 +1,216 @@
+"""
+Background job queue for long-running rainbowify work.
+
+Jobs run on an in-process thread pool, so a request only has to enqueue the work and
+can return straight away. Low-priority jobs that no user is waiting on, such as
+indexing a library, run on a smaller pool of their own, so they never hold up the
+jobs users start. Each job's progress is kept in Django's cache, where the
+status endpoint reads it; with a shared cache backend configured, any worker process
+can report on any job.
+
+Jobs started from the async views run as tasks on the server's event loop instead,
+reporting their progress the same way.
+"""
+
+import asyncio
+import contextvars
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+DEFAULT_JOB_WORKERS = 4
+DEFAULT_LOW_PRIORITY_JOB_WORKERS = 1
+# how long a job's status is kept after its last update, in seconds
+STATUS_TIMEOUT = 60 * 60
+
+QUEUED = 'queued'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+# async jobs still running
+_async_jobs = set()
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    """
+    Get the thread pool that runs background jobs.
+
+    :return: concurrent.futures.ThreadPoolExecutor object
+    """
+    workers = getattr(settings, 'RAINBOW_JOB_WORKERS', DEFAULT_JOB_WORKERS)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rainbowify-job')
+
+
+@lru_cache(maxsize=None)
+def get_low_priority_executor():
+    """
+    Get the thread pool that runs low-priority background jobs.
+
+    :return: concurrent.futures.ThreadPoolExecutor object
+    """
+    workers = getattr(settings, 'RAINBOW_LOW_PRIORITY_JOB_WORKERS',
+                      DEFAULT_LOW_PRIORITY_JOB_WORKERS)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='low-priority-job')
+
+
+def get_cache_key(job_id):
+    """
+    Get the cache key holding a job's status.
+
+    :param job_id: ID of the job
+    :return: Cache key string
+    """
+    return f"rainbowify-job:{job_id}"
+
+
+def get_job_status(job_id):
+    """
+    Get the current status of a job.
+
+    :param job_id: ID of the job
+    :return: Dictionary with the job's stage, percent complete and any error, or None
+        if the job is unknown or has expired
+    """
+    return cache.get(get_cache_key(job_id))
+
+
+def make_status(job_id, stage, percent, **extra):
+    """
+    Build a job's status.
+
+    :param job_id: ID of the job
+    :param stage: Name of the stage the job has reached
+    :param percent: How far through the job is, from 0 to 100
+    :param extra: Any other values to include in the job's status
+    :return: Dictionary with the job's stage, percent complete and any error
+    """
+    status = {'id': job_id, 'stage': stage, 'percent': percent,
+              'done': stage in (COMPLETE, FAILED), 'error': None}
+    status.update(extra)
+    return status
+
+
+def update_job(job_id, stage, percent, **extra):
+    """
+    Record a job's progress.
+
+    :param job_id: ID of the job
+    :param stage: Name of the stage the job has reached
+    :param percent: How far through the job is, from 0 to 100
+    :param extra: Any other values to include in the job's status
+    """
+    cache.set(get_cache_key(job_id), make_status(job_id, stage, percent, **extra),
+              STATUS_TIMEOUT)
+
+
+async def aupdate_job(job_id, stage, percent, **extra):
+    """
+    Record a job's progress, from a coroutine.
+
+    :param job_id: ID of the job
+    :param stage: Name of the stage the job has reached
+    :param percent: How far through the job is, from 0 to 100
+    :param extra: Any other values to include in the job's status
+    """
+    await cache.aset(get_cache_key(job_id), make_status(job_id, stage, percent, **extra),
+                     STATUS_TIMEOUT)
+
+
+def submit_job(func, *args, low_priority=False):
+    """
+    Queue a function to run in the background.
+
+    The function is called with the given arguments plus a ``progress`` keyword
+    argument, a callable taking a stage name and a percentage, which it uses to
+    report how far it has got.
+
+    :param func: Function implementing the job
+    :param args: Positional arguments for the function
+    :param low_priority: True to queue the job on the low-priority pool
+    :return: ID of the queued job
+    """
+    job_id = uuid.uuid4().hex
+    update_job(job_id, QUEUED, 0)
+    executor = get_low_priority_executor() if low_priority else get_executor()
+    executor.submit(run_job, job_id, func, *args)
+    return job_id
+
+
+def run_job(job_id, func, *args):
+    """
+    Run a job, recording its completion or failure.
+
+    :param job_id: ID of the job
+    :param func: Function implementing the job
+    :param args: Positional arguments for the function
+    """
+    def progress(stage, percent):
+        update_job(job_id, stage, percent)
+
+    try:
+        func(*args, progress=progress)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        logger.exception("Job %s failed", job_id)
+        update_job(job_id, FAILED, 100, error=str(error))
+    else:
+        update_job(job_id, COMPLETE, 100)
+    finally:
+        # job threads outlive requests, so release their database connections here
+        close_old_connections()
+
+
+async def submit_async_job(func, *args):
+    """
+    Start a coroutine function as a background task on the running event loop.
+
+    Like submit_job, but for the async views: the job awaits its I/O on the loop
+    instead of holding a thread. The function is called with the given arguments
+    plus a ``progress`` keyword argument, a coroutine function taking a stage name
+    and a percentage. The loop must outlive the request, as an ASGI server's does.
+
+    :param func: Coroutine function implementing the job
+    :param args: Positional arguments for the function
+    :return: ID of the started job
+    """
+    job_id = uuid.uuid4().hex
+    await aupdate_job(job_id, QUEUED, 0)
+    # a fresh context, so the job does not hold on to the request's, such as the
+    # executor Django runs the request's synchronous code on; the task copies the
+    # context it is created in, as create_task only takes one from Python 3.11
+    task = contextvars.Context().run(asyncio.get_running_loop().create_task,
+                                     run_async_job(job_id, func, *args))
+    # the loop only keeps weak references to its tasks
+    _async_jobs.add(task)
+    task.add_done_callback(_async_jobs.discard)
+    return job_id
+
+
+async def run_async_job(job_id, func, *args):
+    """
+    Run an async job, recording its completion or failure.
+
+    :param job_id: ID of the job
+    :param func: Coroutine function implementing the job
+    :param args: Positional arguments for the function
+    """
+    async def progress(stage, percent):
+        await aupdate_job(job_id, stage, percent)
+
+    try:
+        await func(*args, progress=progress)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        logger.exception("Job %s failed", job_id)
+        await aupdate_job(job_id, FAILED, 100, error=str(error))
+    else:
+        await aupdate_job(job_id, COMPLETE, 100)
+    finally:
+        await sync_to_async(close_old_connections)()
@@ -0,0 +1,96 @@
+"""
+Benchmark the dominant color engines and extraction settings against ColorThief.
+
+The covers in a directory are run through each color engine once for every
+combination of working size and sampling stride, a batch at a time as the process
+pool workers see them. Each run is compared with ColorThief over the full-size
+covers at quality=1: how long it took, how far the colors moved, and how many covers
+would land on a different palette rank.
+"""
+
+import os
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from playlists.extraction import ENGINES, extract_colors
+from playlists.matching import closest_color_indices
+
+
+class Command(BaseCommand):
+    """
+    Compare extraction speed and accuracy across engines, working sizes and strides.
+    """
+    help = "Benchmark dominant color engines and extraction settings against ColorThief."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', nargs='+', choices=ENGINES, default=list(ENGINES),
+                            help="Color engines to try.")
+        parser.add_argument('--directory', default='art_images',
+                            help="Directory of album covers to benchmark with.")
+        parser.add_argument('--size', type=int, nargs='+', default=[64, 32, 16],
+                            help="Working sizes (largest side, in pixels) to try.")
+        parser.add_argument('--quality', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help="Pixel sampling strides to try.")
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Runs per setting; the fastest is reported.")
+
+    def handle(self, *args, **options):
+        covers = self.load_covers(options['directory'])
+        reference_time, reference = self.run(covers, ('colorthief', 0, 1), options['repeat'])
+        reference_ranks = closest_color_indices(reference)
+        self.stdout.write(f"{len(covers)} covers, full-size ColorThief "
+                          f"{1000 * reference_time / len(covers):.2f} ms/cover")
+        self.stdout.write(f"{'engine':>10} {'size':>5} {'quality':>8} {'ms/cover':>9} "
+                          f"{'speedup':>8} {'mean dRGB':>10} {'max dRGB':>9} "
+                          f"{'same rank':>10}")
+
+        for engine in options['engine']:
+            for max_size in options['size']:
+                for quality in options['quality']:
+                    elapsed, colors = self.run(covers, (engine, max_size, quality),
+                                               options['repeat'])
+                    distances = np.linalg.norm(colors - reference, axis=1)
+                    same_rank = np.mean(closest_color_indices(colors) == reference_ranks)
+                    self.stdout.write(
+                        f"{engine:>10} {max_size:>5} {quality:>8} "
+                        f"{1000 * elapsed / len(covers):>9.2f} "
+                        f"{reference_time / elapsed:>7.1f}x {distances.mean():>10.1f} "
+                        f"{distances.max():>9.1f} {100 * same_rank:>9.1f}%")
+
+    @staticmethod
+    def load_covers(directory):
+        """
+        Read every cover in a directory into memory.
+
+        :param directory: Directory of album covers
+        :return: List of image bytes
+        """
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        covers = []
+        for filename in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, filename), 'rb') as file:
+                covers.append(file.read())
+        if not covers:
+            raise CommandError(f"{directory} has no images")
+        return covers
+
+    @staticmethod
+    def run(covers, options, repeat):
+        """
+        Extract the dominant color of every cover with the given settings.
+
+        :param covers: List of image bytes
+        :param options: Tuple of (engine, max_size, quality) passed to extract_colors
+        :param repeat: Number of timed runs
+        :return: Tuple of (fastest run time in seconds, (N, 3) array of colors)
+        """
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            colors = extract_colors(covers, options)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, np.array(colors, dtype=float)
@@ -0,0 +1,386 @@
+"""
+Benchmark rainbowify end to end against a local stand-in for Spotify.
+
+Playlists of each requested size are rainbowified through rainbowify_playlist, the
+path the web app's jobs and the rainbowify command take, against the mock_spotify
+server: its API pages, playlist writes, token refresh and synthetic covers, with
+the configured latency on every request. Each run is a fresh process with an empty
+database, cache and image cache, so every cover is downloaded and extracted, and
+the process's CPU time and peak memory belong to that run alone.
+
+Every run records its wall time, the time spent in each stage of the job, CPU time
+and peak RSS of the job process and of its extraction workers, and the requests it
+made, along with the totals of the app's own timing spans and counters. The
+results are saved as JSON; given an earlier results file with --compare, the runs
+are compared size by size, and the command fails if any got slower or bigger by
+more than --threshold percent.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+
+from playlists import metrics
+from playlists.mock_spotify import MockSpotifyServer
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+DEFAULT_TRACKS = [50, 100, 1000, 10000]
+# metrics that fail a comparison when they grow by more than the threshold
+REGRESSION_METRICS = ('wall_s', 'cpu_s', 'worker_cpu_s', 'peak_rss_mb')
+# the job's own database and cache, so a run neither sees nor touches real data
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def get_usage():
+    """
+    Get the CPU time and peak RSS of this process and of its finished children.
+
+    :return: Dictionary of CPU seconds and peak RSS in megabytes, or None where the
+        platform cannot tell
+    """
+    usage = {'cpu_s': time.process_time(), 'worker_cpu_s': None,
+             'peak_rss_mb': None, 'worker_peak_rss_mb': None}
+    if resource is None:
+        return usage
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage.update(worker_cpu_s=children.ru_utime + children.ru_stime,
+                 peak_rss_mb=own.ru_maxrss / scale,
+                 worker_peak_rss_mb=children.ru_maxrss / scale)
+    return usage
+
+
+def start_extraction_workers():
+    """
+    Start the extraction workers ahead of a job, as a long-running server would
+    have them already.
+    """
+    # pylint: disable=import-outside-toplevel
+    from playlists.extraction import submit_extraction
+    for future in [submit_extraction([]) for _ in range(os.cpu_count())]:
+        future.result()
+
+
+def stop_extraction_workers():
+    """
+    Stop the extraction workers, so their CPU time is counted as this process's
+    children.
+    """
+    # pylint: disable=import-outside-toplevel
+    from playlists.extraction import get_process_pool
+    if getattr(settings, 'RAINBOW_EXTRACTION_PROCESSES', None) != 0:
+        get_process_pool().shutdown()
+
+
+@contextmanager
+def isolated_database():
+    """
+    Run against a new, migrated database, removed again on exit.
+
+    SQLite test databases are kept in memory by default, which the job's threads
+    cannot share, so the benchmark's is a temporary file instead.
+    """
+    with tempfile.TemporaryDirectory(prefix='rainbowify-benchmark-') as directory:
+        if connection.vendor == 'sqlite':
+            connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'db.sqlite3')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def get_stage_times(stages, finished):
+    """
+    Work out how long each stage of a job took from when each one started.
+
+    :param stages: List of (stage name, start time) tuples, in order
+    :param finished: Time the job finished
+    :return: Dictionary mapping stage names to seconds
+    """
+    ends = [start for _, start in stages[1:]] + [finished]
+    return {name: end - start for (name, start), end in zip(stages, ends)}
+
+
+def summarize(runs):
+    """
+    Reduce the runs of each playlist size to the median of every metric.
+
+    :param runs: List of run result dictionaries
+    :return: Dictionary mapping track counts to dictionaries of metrics
+    """
+    by_size = {}
+    for run in runs:
+        row = {key: value for key, value in run.items()
+               if isinstance(value, (int, float)) and key != 'tracks'}
+        row.update({f"stage:{name}": value for name, value in run['stages'].items()})
+        row.update({f"span:{name}": value for name, value in run.get('spans', {}).items()})
+        row.update({f"count:{name}": value
+                    for name, value in run.get('counters', {}).items()})
+        row['requests'] = sum(count for kind, count in run['requests'].items()
+                              if kind != 'image_bytes')
+        by_size.setdefault(run['tracks'], []).append(row)
+    return {tracks: {key: statistics.median(row[key] for row in size_runs
+                                            if row.get(key) is not None)
+                     for key in size_runs[0] if size_runs[0][key] is not None}
+            for tracks, size_runs in by_size.items()}
+
+
+class Command(BaseCommand):
+    """
+    Time rainbowify's full path, from fetching tracks to populating the playlist.
+    """
+    help = "Benchmark rainbowify end to end against a local stand-in for Spotify."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, nargs='+', default=DEFAULT_TRACKS,
+                            help="Playlist sizes to benchmark.")
+        parser.add_argument('--tracks-per-album', type=int, default=1,
+                            help="Tracks sharing each cover; 1 makes every cover distinct.")
+        parser.add_argument('--latency', type=float, default=50,
+                            help="Milliseconds added to every API request.")
+        parser.add_argument('--image-latency', type=float, default=20,
+                            help="Milliseconds added to every cover download.")
+        parser.add_argument('--repeat', type=int, default=1,
+                            help="Runs per playlist size; the median is compared.")
+        parser.add_argument('--output',
+                            help="File to save the results to, by default "
+                                 "rainbowify-benchmark-<time>.json.")
+        parser.add_argument('--compare', metavar='BASELINE',
+                            help="Results file of an earlier benchmark to compare with.")
+        parser.add_argument('--threshold', type=float, default=10,
+                            help="Percent increase in wall time, CPU time or peak RSS "
+                                 "over the baseline that counts as a regression.")
+        # used by the benchmark itself to run each job in a fresh process
+        parser.add_argument('--job', help=argparse.SUPPRESS)
+        parser.add_argument('--server-url', help=argparse.SUPPRESS)
+        parser.add_argument('--result-file', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['job']:
+            result = self.run_job(options['job'], options['server_url'])
+            with open(options['result_file'], 'w', encoding='utf-8') as file:
+                json.dump(result, file)
+            return
+
+        baseline = self.load_results(options['compare']) if options['compare'] else None
+        server = MockSpotifyServer(latency=options['latency'] / 1000,
+                                   image_latency=options['image_latency'] / 1000,
+                                   tracks_per_album=options['tracks_per_album'])
+        server.start()
+        try:
+            runs = self.run_all(server, options)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        results = {
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'environment': self.get_environment(),
+            'mock': {key: options[key] for key in
+                     ('latency', 'image_latency', 'tracks_per_album')},
+            'runs': runs,
+        }
+        output = options['output'] or datetime.now().strftime(
+            "rainbowify-benchmark-%Y%m%d-%H%M%S.json")
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        self.stdout.write(f"Results saved to {output}")
+
+        if baseline is not None:
+            self.compare(baseline, results, options['threshold'])
+
+    def run_all(self, server, options):
+        """
+        Run a job for every playlist size and repeat, one after another.
+
+        :param server: Running MockSpotifyServer
+        :param options: Command options
+        :return: List of run result dictionaries
+        """
+        self.stdout.write(f"{'tracks':>7} {'wall s':>8} {'tracks/s':>9} {'cpu s':>7} "
+                          f"{'worker s':>9} {'rss MB':>7} {'requests':>9} {'images':>7}  "
+                          f"stages")
+        runs = []
+        for tracks in options['tracks']:
+            for _ in range(options['repeat']):
+                server.take_counts()
+                run = self.run_subprocess(f"bench{tracks}", server.base_url,
+                                          options['verbosity'])
+                run['requests'] = server.take_counts()
+                runs.append(run)
+                self.report(run)
+        return runs
+
+    def run_subprocess(self, playlist_id, server_url, verbosity):
+        """
+        Rainbowify a playlist in a new process, running this command with --job.
+
+        :param playlist_id: ID of the made-up playlist
+        :param server_url: URL of the MockSpotifyServer
+        :param verbosity: Verbosity of this command; above 1, the job's output and
+            logging are shown
+        :return: Run result dictionary
+        """
+        with tempfile.TemporaryDirectory(prefix='rainbowify-benchmark-') as directory:
+            result_file = os.path.join(directory, 'result.json')
+            command = [sys.executable, '-m', 'django', 'benchmark_rainbowify',
+                       '--settings', settings.SETTINGS_MODULE, '--job', playlist_id,
+                       '--server-url', server_url, '--result-file', result_file]
+            quiet = verbosity <= 1
+            completed = subprocess.run(
+                command, cwd=settings.BASE_DIR, check=False,
+                stdout=subprocess.DEVNULL if quiet else None,
+                stderr=subprocess.PIPE if quiet else None)
+            if completed.returncode != 0:
+                if completed.stderr:
+                    self.stderr.write(completed.stderr.decode(errors='replace'))
+                raise CommandError(f"Benchmark job for {playlist_id} failed")
+            with open(result_file, encoding='utf-8') as file:
+                return json.load(file)
+
+    @staticmethod
+    def run_job(playlist_id, server_url):
+        """
+        Rainbowify one playlist from the mock server, measuring it.
+
+        :param playlist_id: ID of the made-up playlist
+        :param server_url: URL of the MockSpotifyServer
+        :return: Run result dictionary
+        """
+        # imported here, as the job's settings must be in place first
+        # pylint: disable=import-outside-toplevel
+        from playlists.auth import UserToken
+        from playlists.views import rainbowify_playlist
+
+        with tempfile.TemporaryDirectory() as image_cache_dir, \
+                override_settings(RAINBOW_SPOTIFY_API_URL=f"{server_url}/v1",
+                                  RAINBOW_SPOTIFY_ACCOUNTS_URL=server_url,
+                                  RAINBOW_IMAGE_CACHE_DIR=image_cache_dir,
+                                  CACHES=BENCHMARK_CACHES), isolated_database():
+            start_extraction_workers()
+
+            stages = [('starting', time.perf_counter())]
+            # an already expired token, so the run includes a refresh
+            token = UserToken("expired", "benchmark-refresh-token", 0)
+            before = get_usage()
+            tracks = rainbowify_playlist(
+                playlist_id, token,
+                progress=lambda stage, percent: stages.append((stage, time.perf_counter())))
+            finished = time.perf_counter()
+
+            stop_extraction_workers()
+            after = get_usage()
+            totals = metrics.snapshot()
+
+        result = {'tracks': tracks, 'wall_s': finished - stages[0][1],
+                  'stages': get_stage_times(stages, finished),
+                  'images': totals['counters']['images_downloaded'],
+                  'image_bytes': totals['counters']['image_bytes_downloaded'],
+                  'spans': {name: values['seconds'] for name, values in totals['spans'].items()
+                            if values['count']},
+                  'counters': totals['counters']}
+        for key in ('cpu_s', 'worker_cpu_s'):
+            result[key] = after[key] - before[key] if after[key] is not None else None
+        for key in ('peak_rss_mb', 'worker_peak_rss_mb'):
+            result[key] = after[key]
+        return result
+
+    def report(self, run):
+        """
+        Print the headline numbers of one run.
+
+        :param run: Run result dictionary
+        """
+        def number(value, width, precision):
+            return f"{value:>{width}.{precision}f}" if value is not None else f"{'-':>{width}}"
+
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in run['stages'].items())
+        requests = sum(count for kind, count in run['requests'].items() if kind != 'image_bytes')
+        self.stdout.write(
+            f"{run['tracks']:>7} {run['wall_s']:>8.2f} "
+            f"{run['tracks'] / run['wall_s']:>9.1f} {number(run['cpu_s'], 7, 2)} "
+            f"{number(run['worker_cpu_s'], 9, 2)} {number(run['peak_rss_mb'], 7, 1)} "
+            f"{requests:>9} {run['images']:>7}  {stages}")
+
+    @staticmethod
+    def get_environment():
+        """
+        Describe the host and the settings the benchmark ran with.
+
+        :return: Dictionary of environment details
+        """
+        names = ['RAINBOW_DOWNLOAD_WORKERS', 'RAINBOW_DOWNLOAD_PER_HOST',
+                 'RAINBOW_SPOTIFY_RATE', 'RAINBOW_SPOTIFY_BURST', 'RAINBOW_PAGE_WORKERS',
+                 'RAINBOW_PIPELINE_BUFFER', 'RAINBOW_IN_MEMORY_IMAGES',
+                 'RAINBOW_COLOR_ENGINE', 'RAINBOW_COVER_MIN_SIZE',
+                 'RAINBOW_EXTRACTION_MAX_SIZE', 'RAINBOW_EXTRACTION_QUALITY',
+                 'RAINBOW_EXTRACTION_PROCESSES', 'RAINBOW_EXTRACTION_BATCH_SIZE',
+                 'RAINBOW_ORDERING']
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'settings': {name: getattr(settings, name, None) for name in names},
+        }
+
+    @staticmethod
+    def load_results(path):
+        """
+        Read an earlier benchmark's results.
+
+        :param path: Path of the results file
+        :return: Decoded results
+        """
+        try:
+            with open(path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Could not read {path}: {error}") from error
+
+    def compare(self, baseline, results, threshold):
+        """
+        Compare the median of every metric with an earlier benchmark's, size by size.
+
+        :param baseline: Results of the earlier benchmark
+        :param results: Results of this benchmark
+        :param threshold: Percent increase in a regression metric that fails the
+            comparison
+        """
+        before = summarize(baseline['runs'])
+        after = summarize(results['runs'])
+        regressions = []
+        for tracks in sorted(set(before) & set(after)):
+            self.stdout.write(f"\n{tracks} tracks: {'baseline':>10} {'now':>10} {'change':>8}")
+            for key in sorted(set(before[tracks]) & set(after[tracks])):
+                old, new = before[tracks][key], after[tracks][key]
+                if not old and not new:
+                    continue
+                change = 100 * (new - old) / old if old else 0.0
+                self.stdout.write(f"  {key:<36} {old:>10.2f} {new:>10.2f} {change:>+7.1f}%")
+                if key in REGRESSION_METRICS and change > threshold:
+                    regressions.append(f"{tracks} tracks: {key} {change:+.1f}%")
+        if not set(before) & set(after):
+            self.stdout.write("No playlist sizes in common with the baseline")
+        if regressions:
+            raise CommandError("Regressions over the baseline: " + "; ".join(regressions))
@@ -0,0 +1,111 @@
+"""
+Rainbowify many playlists from the command line.
+
+Playlists are processed concurrently, through the same rainbowify_playlist used by
+the web app's background jobs, so every run in the batch shares the process's
+Spotify session and rate limit, its image download pool, its extraction process
+pool and the dominant color cache. The user is identified by a refresh token, from
+which access tokens are obtained and refreshed as the batch runs.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from playlists.auth import UserToken
+from playlists.downloads import get_download_totals
+from playlists.spotify import SpotifyClient
+from playlists.views import (get_owned_playlists, get_user_name, rainbowify_playlist)
+
+
+class Command(BaseCommand):
+    """
+    Rainbowify a list of playlists, or every playlist the user owns.
+    """
+    help = "Rainbowify many playlists concurrently, reporting throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument('playlist_ids', nargs='*', metavar='playlist_id',
+                            help="IDs of the playlists to rainbowify.")
+        parser.add_argument('--all-owned', action='store_true',
+                            help="Rainbowify every playlist the user owns.")
+        parser.add_argument('--refresh-token', default=os.getenv("SPOTIFY_REFRESH_TOKEN"),
+                            help="Spotify refresh token of the user, defaults to the "
+                                 "SPOTIFY_REFRESH_TOKEN environment variable.")
+        parser.add_argument('--access-token', default=os.getenv("SPOTIFY_ACCESS_TOKEN"),
+                            help="Spotify access token to use instead of a refresh token, "
+                                 "defaults to the SPOTIFY_ACCESS_TOKEN environment variable.")
+        parser.add_argument('--workers', type=int,
+                            default=getattr(settings, 'RAINBOW_JOB_WORKERS', 4),
+                            help="Playlists processed at the same time.")
+
+    def handle(self, *args, **options):
+        if not options['refresh_token'] and not options['access_token']:
+            raise CommandError("A Spotify refresh token or access token is required")
+        if not options['playlist_ids'] and not options['all_owned']:
+            raise CommandError("Give some playlist IDs, or --all-owned")
+
+        # an expiry in the past makes the token refresh before its first use
+        token = UserToken(options['access_token'], options['refresh_token'],
+                          0 if options['refresh_token'] else None)
+        client = SpotifyClient(token)
+        user_id = get_user_name(client)
+
+        playlists = list(options['playlist_ids'])
+        if options['all_owned']:
+            playlists.extend(playlist['id'] for playlist in get_owned_playlists(client, user_id))
+        playlists = list(dict.fromkeys(playlists))
+        self.stdout.write(f"Rainbowifying {len(playlists)} playlists for {user_id} "
+                          f"with {options['workers']} workers")
+
+        start = time.perf_counter()
+        images_before = get_download_totals()['images']
+        tracks, failures = self.run(playlists, token, user_id, options['workers'])
+        elapsed = time.perf_counter() - start
+        images = get_download_totals()['images'] - images_before
+
+        self.stdout.write(
+            f"Rainbowified {len(playlists) - failures}/{len(playlists)} playlists in "
+            f"{elapsed:.1f}s: {tracks} tracks ({tracks / elapsed:.1f} tracks/s), "
+            f"{images} images downloaded ({images / elapsed:.1f} images/s)")
+        if failures:
+            raise CommandError(f"{failures} playlists failed")
+
+    def run(self, playlists, token, user_id, workers):
+        """
+        Rainbowify playlists concurrently, reporting each as it finishes.
+
+        :param playlists: List of playlist IDs
+        :param token: UserToken shared by every run
+        :param user_id: Spotify user ID
+        :param workers: Number of playlists processed at the same time
+        :return: Tuple of (number of tracks processed, number of failed playlists)
+        """
+        def rainbowify_one(playlist_id):
+            started = time.perf_counter()
+            try:
+                return rainbowify_playlist(playlist_id, token, user_id), \
+                    time.perf_counter() - started
+            finally:
+                # worker threads outlive each run, so release their database connections
+                close_old_connections()
+
+        tracks = failures = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers),
+                                thread_name_prefix='rainbowify-cli') as executor:
+            futures = {executor.submit(rainbowify_one, playlist_id): playlist_id
+                       for playlist_id in playlists}
+            for future in as_completed(futures):
+                try:
+                    count, elapsed = future.result()
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    failures += 1
+                    self.stderr.write(f"{futures[future]}: failed ({error!r})")
+                    continue
+                tracks += count
+                self.stdout.write(f"{futures[future]}: {count} tracks in {elapsed:.1f}s")
+        return tracks, failures
@@ -0,0 +1,432 @@
+"""
+Ranking of dominant colors into rainbow order.
+
+Three orderings are available. 'hue' converts colors to CIE LCh, a perceptual space
+in which equal steps look roughly equally different, and orders them by hue angle
+from red round to pink, followed by the near-greys from black to white. 'palette'
+matches each color to the closest entry of the hand-ordered palette in colors.py by
+RGB distance and ranks it by that entry's position.
+
+Under either, a track's rank depends only on its color, so each ordering is computed
+once for every cell of a 32x32x32 quantized RGB cube. Ranking a batch of colors is
+then a single table lookup per color.
+
+'path' instead orders a whole set of tracks at once, along a smooth path through CIE
+Lab space that starts from the reddest track. Each track is placed by a signature
+built from its cover's weighted palette, its dominant color and its second strongest
+color, so covers with two strong colors sit between the tracks they resemble. The
+path is built greedily, always stepping to the nearest unvisited signature, with a
+uniform grid over the dominant colors so each step only compares nearby tracks.
+Where a single color needs a rank under 'path', it ranks as under 'hue'.
+"""
+
+from functools import lru_cache
+from itertools import product
+
+import numpy as np
+from django.conf import settings
+
+from .colors import colors
+
+ORDERINGS = ('hue', 'palette', 'path')
+DEFAULT_ORDERING = 'hue'
+
+# (P, 3) palette, plus each palette color's squared norm for the distance expansion
+PALETTE = np.ascontiguousarray(colors, dtype=np.int64)
+PALETTE_NORMS = np.einsum('pc,pc->p', PALETTE, PALETTE)
+
+# rows matched per step, which bounds the (N, P) distance matrix for huge batches
+BATCH_SIZE = 8192
+
+# bits kept per channel in the rank tables
+TABLE_BITS = 5
+TABLE_SHIFT = 8 - TABLE_BITS
+TABLE_SIZE = 1 << TABLE_BITS
+
+# colors with less chroma than this are treated as greys, ordered by lightness
+NEUTRAL_CHROMA = 10
+# hue angle, in degrees, the rainbow starts from; it falls between pinks and reds
+HUE_START = 20
+
+# sRGB (D65) to CIE XYZ, and the D65 white point
+XYZ_MATRIX = np.array([[0.4124, 0.3576, 0.1805],
+                       [0.2126, 0.7152, 0.0722],
+                       [0.0193, 0.1192, 0.9505]])
+WHITE_POINT = np.array([0.95047, 1.0, 1.08883])
+
+# neighbours listed per signature, from which the path's next step is picked
+NEIGHBOURS = 8
+# average number of signatures per cell of the path ordering's grid
+POINTS_PER_CELL = 2
+# ratio of a search shell's cells to the cells still holding points beyond which
+# comparing with every wanted point at once is cheaper than visiting the shell
+BRUTE_FORCE_RATIO = 1
+# smallest side of the grid's bounding box, in Lab units, so flat sets still get cells
+MIN_GRID_EXTENT = 1.0
+
+
+def closest_color_indices(dominant_colors):
+    """
+    Find the index of the closest predefined color for each of a batch of colors.
+
+    Ties resolve to the earliest palette entry.
+
+    :param dominant_colors: Sequence of RGB tuples, or an (N, 3) array
+    :return: NumPy array of N palette indices
+    """
+    points = np.asarray(dominant_colors, dtype=np.int64).reshape(-1, 3)
+    indices = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), BATCH_SIZE):
+        batch = points[start:start + BATCH_SIZE]
+        # |x - p|^2 without the per-row |x|^2 term, which is constant along each row
+        distances = PALETTE_NORMS - 2 * (batch @ PALETTE.T)
+        indices[start:start + BATCH_SIZE] = distances.argmin(axis=1)
+    return indices
+
+
+def rgb_to_lab(rgb):
+    """
+    Convert sRGB colors to CIE Lab.
+
+    :param rgb: (N, 3) array of RGB values from 0 to 255
+    :return: (N, 3) array of lightness, a and b values
+    """
+    srgb = np.asarray(rgb, dtype=float).reshape(-1, 3) / 255
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ XYZ_MATRIX.T / WHITE_POINT
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]),
+                     200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def rgb_to_lch(rgb):
+    """
+    Convert sRGB colors to CIE LCh.
+
+    :param rgb: (N, 3) array of RGB values from 0 to 255
+    :return: Tuple of (lightness, chroma, hue angle in degrees) arrays
+    """
+    lab = rgb_to_lab(rgb)
+    a, b = lab[:, 1], lab[:, 2]
+    return lab[:, 0], np.hypot(a, b), np.degrees(np.arctan2(b, a)) % 360
+
+
+def get_cell_colors():
+    """
+    Get the color at the centre of every cell of the quantized RGB cube.
+
+    :return: (32768, 3) array of RGB values, in table order
+    """
+    centres = np.arange(TABLE_SIZE) * (1 << TABLE_SHIFT) + (1 << TABLE_SHIFT) // 2
+    return np.stack(np.meshgrid(centres, centres, centres, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def hue_keys(rgb):
+    """
+    Get the hue ordering's sort key for each of a batch of colors.
+
+    :param rgb: (N, 3) array of RGB values
+    :return: Array of N sort keys, chromatic colors by hue before greys by lightness
+    """
+    lightness, chroma, hue = rgb_to_lch(rgb)
+    return np.where(chroma < NEUTRAL_CHROMA, 360 + lightness, (hue - HUE_START) % 360)
+
+
+@lru_cache(maxsize=None)
+def get_rank_table(ordering):
+    """
+    Get the rank of every cell of the quantized RGB cube under an ordering.
+
+    :param ordering: 'hue', 'palette' or 'path', which ranks single colors as 'hue'
+    :return: (32, 32, 32) array of ranks, lower ranks coming first in the rainbow
+    """
+    cells = get_cell_colors()
+    if ordering in ('hue', 'path'):
+        keys = hue_keys(cells)
+        ranks = np.empty(len(keys), dtype=np.int32)
+        ranks[np.argsort(keys, kind='stable')] = np.arange(len(keys))
+    elif ordering == 'palette':
+        ranks = closest_color_indices(cells).astype(np.int32)
+    else:
+        raise ValueError(f"Unknown rainbow ordering {ordering!r}, expected one of {ORDERINGS}")
+    return ranks.reshape((TABLE_SIZE,) * 3)
+
+
+def get_ordering():
+    """
+    Get the configured rainbow ordering.
+
+    :return: 'hue', 'palette' or 'path'
+    """
+    return getattr(settings, 'RAINBOW_ORDERING', DEFAULT_ORDERING)
+
+
+def color_ranks(dominant_colors, ordering=None):
+    """
+    Rank each of a batch of colors by its place in the rainbow.
+
+    Colors in the same cell of the quantized RGB cube share a rank, so a stable sort
+    keeps their original order.
+
+    :param dominant_colors: Sequence of RGB tuples, or an (N, 3) array
+    :param ordering: 'hue', 'palette' or 'path', defaults to RAINBOW_ORDERING
+    :return: NumPy array of N ranks
+    """
+    ordering = ordering or get_ordering()
+    cells = np.asarray(dominant_colors, dtype=np.uint8).reshape(-1, 3) >> TABLE_SHIFT
+    return get_rank_table(ordering)[cells[:, 0], cells[:, 1], cells[:, 2]]
+
+
+def color_palette(color):
+    """
+    Get a palette holding just one color, for covers whose palette is not known.
+
+    :param color: RGB tuple or list
+    :return: List of one [red, green, blue, weight] list
+    """
+    return [[*color[:3], 1.0]]
+
+
+def palette_signatures(palettes):
+    """
+    Get the point in color space that places each of a batch of covers on the path.
+
+    A signature is the Lab dominant color, followed by a Lab point between it and the
+    cover's second strongest color, drawn towards the second color by its share of the
+    pair. A cover of one color has both halves equal.
+
+    :param palettes: Sequence of palettes, each a list of [red, green, blue, weight]
+        lists with the dominant color first
+    :return: (N, 6) array of signatures
+    """
+    primary = np.empty((len(palettes), 3))
+    secondary = np.empty((len(palettes), 3))
+    shares = np.zeros(len(palettes))
+    for row, palette in enumerate(palettes):
+        primary[row] = palette[0][:3]
+        secondary[row] = palette[0][:3]
+        if len(palette) > 1:
+            second = max(palette[1:], key=lambda color: color[3])
+            total = palette[0][3] + second[3]
+            if total > 0:
+                secondary[row] = second[:3]
+                shares[row] = second[3] / total
+    primary = rgb_to_lab(primary)
+    secondary = rgb_to_lab(secondary)
+    return np.hstack([primary, primary + shares[:, None] * (secondary - primary)])
+
+
+class PointGrid:
+    """
+    Uniform grid over a set of points' three main axes, for finding the nearest of
+    the points that are still wanted without comparing every pair.
+
+    Points are placed by their projection onto the three directions along which they
+    vary most. The distance between two projections is never more than the distance
+    between the points, so a search can stop once the cells left are further away
+    than the best point found.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        # rows of vt are the principal directions, most varied first; sets of fewer
+        # than three points have fewer, so the rest are padded with zeros
+        directions = np.linalg.svd(points - points.mean(axis=0), full_matrices=False)[2][:3]
+        self.axes = np.zeros((3, points.shape[1]))
+        self.axes[:len(directions)] = directions
+        keys = points @ self.axes.T
+        # projections are measured from the corner of the grid
+        self.offset = keys.min(axis=0)
+        extent = np.maximum(keys.max(axis=0) - self.offset, MIN_GRID_EXTENT)
+        self.cell_size = float(np.cbrt(np.prod(extent) * POINTS_PER_CELL / len(points)))
+        self.shape = (extent // self.cell_size).astype(int) + 1
+        self.point_cells = [tuple(cell) for cell in self.get_cells(keys - self.offset).tolist()]
+        # only cells holding wanted points are kept
+        self.cells = {}
+        for index, cell in enumerate(self.point_cells):
+            self.cells.setdefault(cell, set()).add(index)
+
+    def project(self, points):
+        """
+        Project points onto the grid's axes.
+
+        :param points: (N, D) array of points
+        :return: (N, 3) array of coordinates along the grid's axes, from its corner
+        """
+        return points @ self.axes.T - self.offset
+
+    def get_cells(self, keys):
+        """
+        Get the grid cells holding the given projections, clamped to the grid.
+
+        :param keys: (N, 3) array of projected points
+        :return: (N, 3) array of cell coordinates
+        """
+        cells = (keys // self.cell_size).astype(int)
+        return np.clip(cells, 0, self.shape - 1)
+
+    def remove(self, index):
+        """
+        Stop returning a point from searches.
+
+        :param index: Index of the point
+        """
+        cell = self.point_cells[index]
+        self.cells[cell].discard(index)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def nearest(self, point):
+        """
+        Find the nearest wanted point.
+
+        Searches outwards from the point's cell one shell of cells at a time, and
+        compares the point with every wanted point at once, in a single array
+        operation, once a shell holds more cells than there are cells left to find.
+
+        :param point: Array of coordinates, as long as the grid's points
+        :return: Index of the nearest wanted point, or None if there are none left
+        """
+        if not self.cells:
+            return None
+        centre = tuple(min(max(int(key // self.cell_size), 0), size - 1)
+                       for key, size in zip(self.project(point).tolist(), self.shape.tolist()))
+        reach = max(max(cell, size - 1 - cell)
+                    for cell, size in zip(centre, self.shape.tolist()))
+        best, best_distance = None, np.inf
+        # the point's own cell and its neighbours are searched together
+        for radius in range(1, max(reach, 1) + 1):
+            # every cell in this shell is at least radius - 1 cells away
+            if ((radius - 1) * self.cell_size) ** 2 > best_distance:
+                break
+            if len(get_shell_offsets(radius)) > len(self.cells) * BRUTE_FORCE_RATIO:
+                return self.nearest_of(point, [index for members in self.cells.values()
+                                               for index in members])[0]
+            candidates = self.members_near(centre, radius)
+            if candidates:
+                index, distance = self.nearest_of(point, candidates)
+                if distance < best_distance:
+                    best, best_distance = index, distance
+        return best
+
+    def members_near(self, cell, radius):
+        """
+        Get the wanted points in the cells a search visits at a given radius.
+
+        :param cell: Cell coordinates the search started from
+        :param radius: Distance in cells, at least 1
+        :return: List of point indices
+        """
+        x, y, z = cell
+        return [index for dx, dy, dz in get_shell_offsets(radius)
+                for index in self.cells.get((x + dx, y + dy, z + dz), ())]
+
+    def neighbours(self, count):
+        """
+        List some of the points near each point, nearest first.
+
+        Each point is compared, in one array operation per cell, with the points in
+        its own and the adjacent cells only, so a list can miss closer points that
+        are further away on the grid.
+
+        :param count: Most neighbours to list per point
+        :return: List of lists of point indices, one list per point
+        """
+        neighbours = [[] for _ in range(len(self.points))]
+        for cell, members in self.cells.items():
+            members = list(members)
+            nearby = np.array(self.members_near(cell, 1))
+            distances = ((self.points[members][:, None] - self.points[nearby]) ** 2).sum(axis=2)
+            # each point is its own nearest, at a distance of zero
+            closest = nearby[np.argsort(distances, axis=1, kind='stable')[:, 1:count + 1]]
+            for member, indices in zip(members, closest.tolist()):
+                neighbours[member] = indices
+        return neighbours
+
+    def nearest_of(self, point, indices):
+        """
+        Find the nearest of some of the points, the first listed winning ties.
+
+        :param point: Array of coordinates, as long as the grid's points
+        :param indices: Sequence of point indices
+        :return: Tuple of the nearest point's index and its squared distance
+        """
+        distances = ((self.points[indices] - point) ** 2).sum(axis=1)
+        nearest = distances.argmin()
+        return int(indices[nearest]), float(distances[nearest])
+
+
+@lru_cache(maxsize=None)
+def get_shell_offsets(radius):
+    """
+    Get the offsets of the cells a search visits at a given radius.
+
+    That is every cell exactly radius cells from the centre along some axis, and for
+    a radius of 1, the centre cell as well.
+
+    :param radius: Distance in cells, at least 1
+    :return: Tuple of (x, y, z) offsets
+    """
+    steps = range(-radius, radius + 1)
+    if radius == 1:
+        return tuple(product(steps, steps, steps))
+    return tuple(offset for offset in product(steps, steps, steps)
+                 if max(abs(step) for step in offset) == radius)
+
+
+def path_order(palettes):
+    """
+    Order covers along a smooth path through color space, starting from the reddest.
+
+    Covers with the same signature are kept together, in their original order.
+
+    :param palettes: Sequence of palettes, each a list of [red, green, blue, weight]
+        lists with the dominant color first
+    :return: NumPy array of indices into palettes, in path order
+    """
+    if not palettes:
+        return np.empty(0, dtype=np.intp)
+    signatures = palette_signatures(palettes)
+    points, first, inverse = np.unique(signatures.round(3), axis=0, return_index=True,
+                                       return_inverse=True)
+    # the reddest signature starts the path
+    current = int(hue_keys(np.array([palettes[index][0][:3] for index in first])).argmin())
+    grid = PointGrid(points)
+    neighbours = grid.neighbours(NEIGHBOURS)
+    wanted = [True] * len(points)
+    order = []
+    while current is not None:
+        order.append(current)
+        wanted[current] = False
+        grid.remove(current)
+        # the nearest neighbour not yet on the path, searching the grid only when
+        # every listed neighbour already is
+        current = next((index for index in neighbours[current] if wanted[index]), None)
+        if current is None:
+            current = grid.nearest(points[order[-1]])
+    # each unique signature's position, given to every cover that has it
+    positions = np.empty(len(points), dtype=np.intp)
+    positions[order] = np.arange(len(points))
+    return np.argsort(positions[inverse.reshape(-1)], kind='stable')
+
+
+def path_insertion_keys(kept_palettes, added_palettes):
+    """
+    Work out where to insert new covers into an existing path.
+
+    Each new cover goes straight after the existing cover nearest to it in color
+    space; covers that land at the same place keep their order.
+
+    :param kept_palettes: Palettes of the covers already on the path, in path order
+    :param added_palettes: Palettes of the covers to insert
+    :return: Tuple of sort keys for the kept covers and the added covers, such that
+        merging them by key gives the combined path
+    """
+    kept_keys = np.arange(len(kept_palettes), dtype=float)
+    if not kept_palettes or not added_palettes:
+        return kept_keys, np.full(len(added_palettes), -0.5)
+    grid = PointGrid(palette_signatures(kept_palettes))
+    added_keys = np.array([grid.nearest(point) + 0.5
+                           for point in palette_signatures(added_palettes)])
+    return kept_keys, added_keys
@@ -0,0 +1,143 @@
+"""
+In-process timing spans and counters for the Rainbow Playlists application.
+
+Each stage of a rainbowify job is timed with ``span``, which logs how long it took
+at DEBUG level and adds it to a running count and total for the stage; the counters
+record volumes such as bytes downloaded, cache hits and retried API requests. The
+totals are kept per process, since that is where the work happens, and are served
+in the Prometheus text format by the ``metrics`` view, so production data shows
+where the time goes and how to size the worker pools.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "rainbow"
+
+# timed stages: name -> description
+SPANS = {
+    'rainbowify': "Whole rainbowify jobs.",
+    'track_fetch': "Requests for a page of a playlist's tracks.",
+    'image_download': "Album image downloads and revalidations.",
+    'color_extraction': "Dominant color extraction, per image, in the extraction workers.",
+    'matching': "Ranking and sorting tracks by color.",
+    'playlist_create': "Creating rainbow playlists.",
+    'playlist_populate': "Adding tracks to new rainbow playlists.",
+    'playlist_update': "Removing and inserting tracks in existing rainbow playlists.",
+    'spotify_request': "Spotify API requests, including retries.",
+}
+
+# counters: name -> description
+COUNTERS = {
+    'images_downloaded': "Album images downloaded.",
+    'image_bytes_downloaded': "Bytes of album images downloaded.",
+    'image_download_failures': "Album image downloads that failed.",
+    'image_downloads_shared': "Album images wanted by a stream while already downloading.",
+    'image_cache_hits': "Album images read from the image cache without a request.",
+    'image_cache_revalidations': "Album images the CDN confirmed unchanged since cached.",
+    'image_cache_evictions': "Files evicted from the image cache.",
+    'color_extraction_failures': "Album images that could not be decoded.",
+    'color_cache_hits': "Album images whose dominant color was already cached.",
+    'color_cache_misses': "Album images whose dominant color had to be extracted.",
+    'track_cache_hits': "Playlist track listings served from the cache.",
+    'spotify_requests': "Spotify API requests sent, including retries.",
+    'spotify_retries': "Spotify API requests retried after a failure or rate limit.",
+    'spotify_rate_limited': "Spotify API responses asking the app to slow down.",
+}
+
+_spans = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    """
+    Add to a counter.
+
+    :param name: Name of the counter
+    :param amount: Amount to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name, seconds, count=1):
+    """
+    Record time spent in a stage that was timed elsewhere.
+
+    :param name: Name of the span
+    :param seconds: Time taken, in seconds
+    :param count: Number of items the time covers, such as images in a batch
+    """
+    with _lock:
+        total = _spans.setdefault(name, [0, 0.0])
+        total[0] += count
+        total[1] += seconds
+
+
+@contextmanager
+def span(name, **context):
+    """
+    Time a stage, logging how long it took and adding it to the stage's totals.
+
+    The time is recorded whether or not the stage succeeds.
+
+    :param name: Name of the span
+    :param context: Details of this instance of the stage, included in the log
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(name, elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            details = " ".join(f"{key}={value}" for key, value in context.items())
+            logger.debug("%s took %.3fs %s", name, elapsed, details)
+
+
+def snapshot():
+    """
+    Get the current totals of every span and counter.
+
+    :return: Dictionary with 'spans', mapping names to {'count', 'seconds'}, and
+        'counters', mapping names to values
+    """
+    with _lock:
+        spans = {name: {'count': count, 'seconds': seconds}
+                 for name, (count, seconds) in _spans.items()}
+        counters = dict(_counters)
+    for name in SPANS:
+        spans.setdefault(name, {'count': 0, 'seconds': 0.0})
+    for name in COUNTERS:
+        counters.setdefault(name, 0)
+    return {'spans': spans, 'counters': counters}
+
+
+def render_prometheus():
+    """
+    Format the current totals in the Prometheus text exposition format.
+
+    Spans become summaries, with a count and a sum in seconds, and counters become
+    counters with a _total suffix.
+
+    :return: Metrics text
+    """
+    totals = snapshot()
+    lines = []
+    for name, values in sorted(totals['spans'].items()):
+        metric = f"{PREFIX}_{name}_seconds"
+        lines.append(f"# HELP {metric} {SPANS.get(name, name)}")
+        lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_count {values['count']}")
+        lines.append(f"{metric}_sum {values['seconds']:.6f}")
+    for name, value in sorted(totals['counters'].items()):
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# HELP {metric} {COUNTERS.get(name, name)}")
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DominantColor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_url', models.URLField(max_length=500, unique=True)),
+                ('red', models.PositiveSmallIntegerField()),
+                ('green', models.PositiveSmallIntegerField()),
+                ('blue', models.PositiveSmallIntegerField()),
+                ('last_used', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlists', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RainbowPlaylist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=100)),
+                ('source_playlist_id', models.CharField(max_length=100)),
+                ('rainbow_playlist_id', models.CharField(max_length=100)),
+                ('snapshot_id', models.CharField(blank=True, max_length=200)),
+                ('tracks', models.JSONField(default=list)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user_id', 'source_playlist_id'), name='unique_rainbow_per_source')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlists', '0003_trackcolor_libraryindex'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dominantcolor',
+            name='palette',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='trackcolor',
+            name='palette',
+            field=models.JSONField(default=list),
+        ),
+    ]
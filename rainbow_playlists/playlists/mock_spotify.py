@@ -0,0 +1,272 @@
+"""
+A local stand-in for the Spotify Web API, accounts service and album art CDN.
+
+The benchmark_rainbowify management command runs rainbowify's full path against
+this server, so jobs can be timed end to end without a Spotify account, a network
+connection or rate limits other than the app's own. Playlists are made up on
+request: the ID ``bench<N>`` names a playlist of N tracks. Covers are synthetic
+JPEGs, each drawn from its album's number, so every run of the benchmark downloads
+the same images; like the CDN, covers are served with an ETag and Last-Modified
+date and answer conditional requests with 304 Not Modified. Every request can be
+delayed, to stand in for network and CDN latency, and requests are counted by kind.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+USER_ID = "benchmark"
+# sizes of the images Spotify lists for every album, largest first
+COVER_SIZES = (640, 300, 64)
+ACCESS_TOKEN_LIFETIME = 3600
+
+PLAYLIST_ID_PATTERN = re.compile(r"bench(\d+)$")
+TRACKS_PATH = re.compile(r"/v1/playlists/(\w+)/tracks$")
+FOLLOWERS_PATH = re.compile(r"/v1/playlists/(\w+)/followers(/contains)?$")
+PLAYLIST_PATH = re.compile(r"/v1/playlists/(\w+)$")
+COVER_PATH = re.compile(r"/img/(\d+)/(\d+)\.jpg$")
+# covers never change, so all share one modification date
+COVER_LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+@lru_cache(maxsize=4096)
+def make_cover(album, size):
+    """
+    Draw a synthetic album cover: a background with a few blocks of other colors.
+
+    :param album: Number of the album
+    :param size: Width and height of the cover, in pixels
+    :return: JPEG bytes of the cover
+    """
+    seed = int.from_bytes(hashlib.sha256(str(album).encode()).digest()[:8], 'big')
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (size, size), tuple(rng.integers(0, 256, 3).tolist()))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(1, 5)):
+        left, top = rng.integers(0, size, 2).tolist()
+        width, height = rng.integers(size // 8, size // 2, 2).tolist()
+        draw.rectangle((left, top, left + width, top + height),
+                       fill=tuple(rng.integers(0, 256, 3).tolist()))
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class MockSpotifyServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server holding the stand-in's settings and request counts.
+    """
+    daemon_threads = True
+    # a rainbowify job opens many connections at once, as the real CDN allows
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0.0, image_latency=0.0, tracks_per_album=1):
+        super().__init__(('127.0.0.1', port), MockSpotifyHandler)
+        self.latency = latency
+        self.image_latency = image_latency
+        self.tracks_per_album = max(1, tracks_per_album)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.created_playlists = 0
+
+    @property
+    def base_url(self):
+        """
+        Get the URL the server is listening on.
+
+        :return: URL without a trailing slash
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        """
+        threading.Thread(target=self.serve_forever, name='mock-spotify', daemon=True).start()
+
+    def count(self, kind, amount=1):
+        """
+        Count a request, or some bytes, of the given kind.
+
+        :param kind: Name of the counter
+        :param amount: Amount to add to it
+        """
+        with self.lock:
+            self.counts[kind] += amount
+
+    def take_counts(self):
+        """
+        Get the request counts so far, and start counting again from zero.
+
+        :return: Dictionary of counts by kind
+        """
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts.clear()
+        return counts
+
+    def new_playlist_id(self):
+        """
+        Make up an ID for a playlist created through the API.
+
+        :return: Playlist ID
+        """
+        with self.lock:
+            self.created_playlists += 1
+            return f"rainbow{self.created_playlists}"
+
+
+class MockSpotifyHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Spotify API, accounts service and CDN requests rainbowify makes.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, data, status=200):
+        """
+        Send a JSON response.
+
+        :param data: JSON-serializable body, or None for an empty one
+        :param status: HTTP status code
+        """
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_body(body, 'application/json', status)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        """
+        Send a response with the given body.
+
+        :param body: Bytes of the body
+        :param content_type: Content type of the body
+        :param status: HTTP status code
+        :param headers: Optional dictionary of extra response headers
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_cover(self, album, size):
+        """
+        Send an album cover, or 304 Not Modified if the client has it already.
+
+        :param album: Number of the album
+        :param size: Width and height of the cover, in pixels
+        """
+        cover = make_cover(album, size)
+        headers = {'ETag': f'"{hashlib.sha256(cover).hexdigest()[:16]}"',
+                   'Last-Modified': COVER_LAST_MODIFIED}
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self.server.count('images_not_modified')
+            return self.send_body(b"", 'image/jpeg', 304, headers)
+        self.server.count('image_bytes', len(cover))
+        return self.send_body(cover, 'image/jpeg', headers=headers)
+
+    def read_body(self):
+        """
+        Read the request body.
+
+        :return: Bytes of the body
+        """
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def delay(self, kind):
+        """
+        Count a request and hold it for the configured latency.
+
+        :param kind: 'api', 'token' or 'images'
+        """
+        self.server.count(kind)
+        time.sleep(self.server.image_latency if kind == 'images' else self.server.latency)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Answer a GET request.
+        """
+        url = urlsplit(self.path)
+        match = COVER_PATH.match(url.path)
+        if match:
+            self.delay('images')
+            return self.send_cover(int(match.group(1)), int(match.group(2)))
+
+        self.delay('api')
+        if url.path == '/v1/me':
+            return self.send_json({'id': USER_ID})
+        match = FOLLOWERS_PATH.match(url.path)
+        if match:
+            return self.send_json([True])
+        match = TRACKS_PATH.match(url.path)
+        if match:
+            query = parse_qs(url.query)
+            return self.send_playlist_page(match.group(1), int(query['offset'][0]),
+                                           int(query['limit'][0]))
+        match = PLAYLIST_PATH.match(url.path)
+        if match:
+            return self.send_json({'snapshot_id': f"{match.group(1)}-snapshot"})
+        return self.send_json({'error': {'status': 404, 'message': "Not found"}}, 404)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Answer a POST request.
+        """
+        self.read_body()
+        if self.path == '/api/token':
+            self.delay('token')
+            return self.send_json({'access_token': "benchmark-access-token",
+                                   'token_type': "Bearer",
+                                   'expires_in': ACCESS_TOKEN_LIFETIME})
+        self.delay('api')
+        if self.path == f"/v1/users/{USER_ID}/playlists":
+            return self.send_json({'id': self.server.new_playlist_id()}, 201)
+        if TRACKS_PATH.match(self.path):
+            return self.send_json({'snapshot_id': "benchmark-snapshot"}, 201)
+        return self.send_json({'error': {'status': 404, 'message': "Not found"}}, 404)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """
+        Answer a DELETE request.
+        """
+        self.read_body()
+        self.delay('api')
+        if FOLLOWERS_PATH.match(self.path) or TRACKS_PATH.match(self.path):
+            return self.send_json(None)
+        return self.send_json({'error': {'status': 404, 'message': "Not found"}}, 404)
+
+    def send_playlist_page(self, playlist_id, offset, limit):
+        """
+        Send a page of a made-up playlist's tracks.
+
+        :param playlist_id: ID of the playlist, naming its length
+        :param offset: Index of the first track of the page
+        :param limit: Most tracks to send
+        """
+        match = PLAYLIST_ID_PATTERN.match(playlist_id)
+        if not match:
+            return self.send_json({'error': {'status': 404, 'message': "Not found"}}, 404)
+        total = int(match.group(1))
+        items = []
+        for index in range(offset, min(total, offset + limit)):
+            album = index // self.server.tracks_per_album
+            images = [{'url': f"{self.server.base_url}/img/{album}/{size}.jpg",
+                       'width': size, 'height': size} for size in COVER_SIZES]
+            items.append({'track': {'id': f"{playlist_id}t{index}",
+                                    'uri': f"spotify:track:{playlist_id}t{index}",
+                                    'album': {'id': f"album{album}", 'images': images}}})
+        return self.send_json({'total': total, 'items': items})
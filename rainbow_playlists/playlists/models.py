@@ -1,3 +1,272 @@
+"""
+Models for the Rainbow Playlists Django application.
+"""
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+from .matching import color_ranks, get_ordering
+
+DEFAULT_COLOR_CACHE_SIZE = 50000
+# keeps each IN (...) lookup well under SQLite's bound parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+
+class PaletteManager(models.Manager):  # pylint: disable=too-few-public-methods
+    """
+    Manager providing batched lookups of the weighted palettes kept with colors.
+    """
+    # field the palettes are looked up by
+    key_field = None
+
+    def palettes(self, keys):
+        """
+        Look up the palettes stored for the given keys.
+
+        :param keys: Iterable of keys
+        :return: Dictionary mapping each key with a stored palette to the palette,
+            a list of [red, green, blue, weight] lists with the dominant color first
+        """
+        keys = list(dict.fromkeys(keys))
+        palettes = {}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start:start + LOOKUP_BATCH_SIZE]
+            rows = self.filter(**{f"{self.key_field}__in": batch}).values_list(
+                self.key_field, 'palette')
+            palettes.update((key, palette) for key, palette in rows if palette)
+        return palettes
+
+
+class DominantColorManager(PaletteManager):
+    """
+    Manager providing batched lookups and updates of the dominant color cache.
+    """
+    key_field = 'image_url'
+
+    def lookup(self, image_urls):
+        """
+        Look up the cached dominant colors of the given album images.
+
+        Every hit is marked as recently used, so it survives eviction.
+
+        :param image_urls: Iterable of album image URLs
+        :return: Dictionary mapping each cached image URL to its RGB tuple
+        """
+        image_urls = list(dict.fromkeys(image_urls))
+        cached = {}
+        for start in range(0, len(image_urls), LOOKUP_BATCH_SIZE):
+            batch = image_urls[start:start + LOOKUP_BATCH_SIZE]
+            rows = self.filter(image_url__in=batch).values_list(
+                'image_url', 'red', 'green', 'blue')
+            hits = {url: (red, green, blue) for url, red, green, blue in rows}
+            if hits:
+                self.filter(image_url__in=list(hits)).update(last_used=timezone.now())
+            cached.update(hits)
+        return cached
+
+    def remember(self, url_palettes):
+        """
+        Store newly extracted palettes and their dominant colors, then evict the
+        least recently used entries if the cache has grown past
+        RAINBOW_COLOR_CACHE_SIZE.
+
+        :param url_palettes: Dictionary mapping album image URLs to palettes, each a
+            list of [red, green, blue, weight] lists with the dominant color first
+        """
+        if not url_palettes:
+            return
+        now = timezone.now()
+        self.bulk_create(
+            # the dominant color is the palette's first entry
+            [self.model(image_url=url, red=palette[0][0], green=palette[0][1],
+                        blue=palette[0][2], palette=palette, last_used=now)
+             for url, palette in url_palettes.items()],
+            batch_size=LOOKUP_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['image_url'],
+            update_fields=['red', 'green', 'blue', 'palette', 'last_used'],
+        )
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries beyond the configured cache size.
+        """
+        max_size = getattr(settings, 'RAINBOW_COLOR_CACHE_SIZE', DEFAULT_COLOR_CACHE_SIZE)
+        if self.count() <= max_size:
+            return
+        stale = self.order_by('-last_used').values_list('pk', flat=True)[max_size:]
+        stale_ids = list(stale)
+        for start in range(0, len(stale_ids), LOOKUP_BATCH_SIZE):
+            self.filter(pk__in=stale_ids[start:start + LOOKUP_BATCH_SIZE]).delete()
+
+
+class DominantColor(models.Model):
+    """
+    The dominant color of an album cover, keyed by the cover's image URL.
+
+    Album art never changes for a given URL, so colors are computed once and reused
+    by every playlist that includes the album.
+    """
+    image_url = models.URLField(max_length=500, unique=True)
+    red = models.PositiveSmallIntegerField()
+    green = models.PositiveSmallIntegerField()
+    blue = models.PositiveSmallIntegerField()
+    # [[red, green, blue, weight], ...] dominant color first; empty for covers
+    # extracted before palettes were kept
+    palette = models.JSONField(default=list)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = DominantColorManager()
+
+    def __str__(self):
+        return f"{self.image_url} ({self.red}, {self.green}, {self.blue})"
+
+
+class RainbowPlaylist(models.Model):
+    """
+    A rainbow playlist made for a user from one of their playlists.
+
+    Records the source playlist's snapshot ID at the last run and the rainbow
+    playlist's tracks, in order, with their colors, so a rerun only has to process
+    the tracks added since.
+    """
+    user_id = models.CharField(max_length=100)
+    source_playlist_id = models.CharField(max_length=100)
+    rainbow_playlist_id = models.CharField(max_length=100)
+    snapshot_id = models.CharField(max_length=200, blank=True)
+    # [[track URI, [red, green, blue]], ...] in rainbow order
+    tracks = models.JSONField(default=list)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+    class Meta:  # pylint: disable=too-few-public-methods
+        """
+        Each source playlist has at most one rainbow playlist per user.
+        """
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'source_playlist_id'],
+                                    name='unique_rainbow_per_source'),
+        ]
+
+    def __str__(self):
+        return f"{self.source_playlist_id} -> {self.rainbow_playlist_id} ({self.user_id})"
+
+
+class TrackColorManager(PaletteManager):
+    """
+    Manager providing batched lookups and updates of the track color index.
+    """
+    key_field = 'track_id'
+
+    def lookup(self, track_ids):
+        """
+        Look up the indexed colors and rainbow ranks of the given tracks.
+
+        Ranks stored under a different ordering than the configured one are worked
+        out again from the colors, and saved.
+
+        :param track_ids: Iterable of Spotify track IDs
+        :return: Dictionary mapping each indexed track ID to a (RGB tuple, rank) tuple
+        """
+        track_ids = list(dict.fromkeys(track_ids))
+        ordering = get_ordering()
+        indexed = {}
+        stale = {}
+        for start in range(0, len(track_ids), LOOKUP_BATCH_SIZE):
+            rows = self.filter(track_id__in=track_ids[start:start + LOOKUP_BATCH_SIZE]) \
+                .values_list('track_id', 'red', 'green', 'blue', 'rank', 'ordering')
+            for track_id, red, green, blue, rank, row_ordering in rows:
+                indexed[track_id] = ((red, green, blue), rank)
+                if row_ordering != ordering:
+                    stale[track_id] = (red, green, blue)
+        if stale:
+            ranks = self.remember(stale)
+            indexed.update({track_id: (color, rank)
+                            for (track_id, color), rank in zip(stale.items(), ranks)})
+        return indexed
+
+    def remember(self, track_colors, track_palettes=None):
+        """
+        Store the colors of newly indexed tracks, ranked under the configured ordering.
+
+        :param track_colors: Dictionary mapping track IDs to RGB tuples
+        :param track_palettes: Dictionary mapping track IDs to the palettes of their
+            album art, or None to leave any stored palettes as they are
+        :return: List of the tracks' ranks, in the same order as track_colors
+        """
+        if not track_colors:
+            return []
+        ordering = get_ordering()
+        ranks = color_ranks(list(track_colors.values()), ordering).tolist()
+        update_fields = ['red', 'green', 'blue', 'rank', 'ordering']
+        if track_palettes is not None:
+            update_fields.append('palette')
+        self.bulk_create(
+            [self.model(track_id=track_id, red=color[0], green=color[1], blue=color[2],
+                        palette=(track_palettes or {}).get(track_id, []),
+                        rank=rank, ordering=ordering)
+             for (track_id, color), rank in zip(track_colors.items(), ranks)],
+            batch_size=LOOKUP_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['track_id'],
+            update_fields=update_fields,
+        )
+        return ranks
+
+
+class TrackColor(models.Model):
+    """
+    The dominant color of a track's album art, and the track's place in the rainbow.
+
+    One compact row per track, shared by every user whose library includes it, so a
+    rainbow of already indexed tracks is a lookup and a sort with no image work.
+    """
+    # Spotify track IDs; a track's URI is spotify:track:<track_id>
+    track_id = models.CharField(max_length=62, unique=True)
+    red = models.PositiveSmallIntegerField()
+    green = models.PositiveSmallIntegerField()
+    blue = models.PositiveSmallIntegerField()
+    # the album art's palette, as DominantColor keeps it
+    palette = models.JSONField(default=list)
+    rank = models.PositiveIntegerField()
+    # the rainbow ordering the rank was worked out under
+    ordering = models.CharField(max_length=16)
+
+    objects = TrackColorManager()
+
+    def __str__(self):
+        return f"{self.track_id} ({self.red}, {self.green}, {self.blue}) #{self.rank}"
+
+
+class LibraryIndex(models.Model):
+    """
+    The tracks in a user's library, as of the last time it was indexed.
+
+    Each playlist's tracks are kept with the snapshot ID they were read at, so
+    indexing again only fetches the playlists that have changed since.
+    """
+    user_id = models.CharField(max_length=100, unique=True)
+    # {playlist ID: {'snapshot_id': snapshot ID, 'tracks': [track ID, ...]}, ...}
+    playlists = models.JSONField(default=dict)
+    # IDs of the user's saved tracks
+    saved_tracks = models.JSONField(default=list)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+    def track_ids(self):
+        """
+        Get every track in the library once, saved tracks first.
+
+        :return: List of track IDs
+        """
+        track_ids = dict.fromkeys(self.saved_tracks)
+        for playlist in self.playlists.values():  # pylint: disable=no-member
+            track_ids.update(dict.fromkeys(playlist['tracks']))
+        return list(track_ids)
 
-# Create your models here.
+    def __str__(self):
+        return f"{self.user_id} ({len(self.playlists)} playlists)"
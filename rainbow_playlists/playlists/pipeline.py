@@ -0,0 +1,82 @@
+"""
+Streaming stages for the rainbowify pipeline.
+
+A stage is an ordinary generator. Wrapping one in ``prefetch`` runs it on its own
+thread, feeding a bounded queue, so it keeps working (fetching the next page of
+tracks, say) while the stages after it consume what it has already produced. The
+bound applies back-pressure: a fast stage can only get so far ahead of a slow one.
+"""
+
+import queue
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import close_old_connections
+
+DEFAULT_BUFFER_SIZE = 4
+# how often a blocked producer checks whether its consumer has gone away, in seconds
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+# wraps an exception raised by a stage, to be re-raised by its consumer
+StageError = namedtuple('StageError', ['error'])
+
+
+def get_buffer_size():
+    """
+    Get the number of items a stage may produce ahead of its consumer.
+
+    :return: Queue size
+    """
+    return getattr(settings, 'RAINBOW_PIPELINE_BUFFER', DEFAULT_BUFFER_SIZE)
+
+
+def prefetch(iterable, maxsize=None):
+    """
+    Run an iterable on a background thread, buffering its items in a bounded queue.
+
+    Exceptions raised by the iterable are re-raised to the consumer. If the consumer
+    stops early, the producer thread stops at its next item.
+
+    :param iterable: Iterable to run, typically a generator stage
+    :param maxsize: Maximum number of buffered items, defaults to RAINBOW_PIPELINE_BUFFER
+    :return: Generator of the iterable's items, in order
+    """
+    items = queue.Queue(maxsize or get_buffer_size())
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            put(StageError(error))
+        finally:
+            # stages may query the database, and this thread's connection would
+            # otherwise be left open
+            close_old_connections()
+
+    threading.Thread(target=produce, name='rainbowify-stage', daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, StageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,241 @@
+"""
+NumPy implementation of the modified median cut quantizer (MMCQ) used by ColorThief.
+
+ColorThief walks its colour boxes voxel by voxel in interpreted Python, which makes
+every box count and average cost up to 32x32x32 dictionary lookups. Here the pixels
+are binned into a dense 32x32x32 histogram with a single bincount, and box counts,
+averages and partial sums become array slices. The cutting rules and the order in
+which boxes are chosen follow ColorThief, so the dominant color matches its output.
+The same boxes give each cover's weighted palette at no extra cost.
+"""
+
+import numpy as np
+
+SIGBITS = 5
+RSHIFT = 8 - SIGBITS
+HISTO_SIZE = 1 << SIGBITS
+MAX_ITERATION = 1000
+FRACT_BY_POPULATIONS = 0.75
+PALETTE_SIZE = 5
+# returned for images with no usable pixels (fully transparent or white)
+EMPTY_COLOR = (255, 255, 255)
+
+
+class VBox:
+    """
+    Box in the quantized color space, with bounds inclusive on both ends.
+    """
+
+    def __init__(self, bounds, histo):
+        self.bounds = [int(bound) for bound in bounds]
+        self.histo = histo
+        self._count = None
+
+    def copy(self):
+        """
+        Get a copy of the box with the same bounds.
+
+        :return: VBox object
+        """
+        return VBox(self.bounds, self.histo)
+
+    def region(self):
+        """
+        Get the histogram cells covered by the box.
+
+        :return: 3-D NumPy array view of the histogram
+        """
+        r1, r2, g1, g2, b1, b2 = self.bounds
+        return self.histo[r1:r2 + 1, g1:g2 + 1, b1:b2 + 1]
+
+    @property
+    def count(self):
+        """
+        Number of pixels in the box.
+        """
+        if self._count is None:
+            self._count = int(self.region().sum())
+        return self._count
+
+    @property
+    def volume(self):
+        """
+        Number of histogram cells in the box.
+        """
+        r1, r2, g1, g2, b1, b2 = self.bounds
+        return (r2 - r1 + 1) * (g2 - g1 + 1) * (b2 - b1 + 1)
+
+    def average(self):
+        """
+        Get the average color of the pixels in the box.
+
+        :return: Tuple representing the RGB values of the average color
+        """
+        mult = 1 << RSHIFT
+        region = self.region()
+        total = region.sum()
+        channels = []
+        for axis in range(3):
+            low, high = self.bounds[2 * axis], self.bounds[2 * axis + 1]
+            if not total:
+                # empty box, use its centre
+                channels.append(int(mult * (low + high + 1) / 2))
+                continue
+            marginal = region.sum(axis=tuple(a for a in range(3) if a != axis))
+            centres = (np.arange(low, high + 1) + 0.5) * mult
+            channels.append(int(float(marginal @ centres) / total))
+        return tuple(channels)
+
+
+def get_histogram(pixels):
+    """
+    Bin pixels into the quantized color space.
+
+    :param pixels: (N, 3) uint8 array of RGB values
+    :return: (32, 32, 32) int64 array of pixel counts
+    """
+    quantized = (pixels >> RSHIFT).astype(np.intp)
+    index = (quantized[:, 0] << (2 * SIGBITS)) | (quantized[:, 1] << SIGBITS) | quantized[:, 2]
+    return np.bincount(index, minlength=HISTO_SIZE ** 3).reshape((HISTO_SIZE,) * 3)
+
+
+def median_cut(vbox):
+    """
+    Split a box in two along its longest side, at the median pixel.
+
+    :param vbox: VBox object to split
+    :return: Tuple of two VBox objects, where the second is None if no split was made
+    """
+    if vbox.count == 1:
+        return vbox.copy(), None
+
+    widths = [vbox.bounds[2 * axis + 1] - vbox.bounds[2 * axis] + 1 for axis in range(3)]
+    # ties prefer red, then green, then blue
+    axis = widths.index(max(widths))
+    low, high = vbox.bounds[2 * axis], vbox.bounds[2 * axis + 1]
+    other_axes = tuple(a for a in range(3) if a != axis)
+    partial = np.cumsum(vbox.region().sum(axis=other_axes))
+    total = partial[-1]
+
+    def partial_sum(i):
+        return partial[i - low] if low <= i <= high else 0
+
+    for i in range(low, high + 1):
+        if partial_sum(i) > total / 2:
+            left = i - low
+            right = high - i
+            if left <= right:
+                cut = min(high - 1, int(i + right / 2))
+            else:
+                cut = max(low, int(i - 1 - left / 2))
+            # avoid 0-count boxes
+            while not partial_sum(cut):
+                cut += 1
+            while total - partial_sum(cut) == 0 and partial_sum(cut - 1):
+                cut -= 1
+            vbox1 = vbox.copy()
+            vbox2 = vbox.copy()
+            vbox1.bounds[2 * axis + 1] = cut
+            vbox2.bounds[2 * axis] = cut + 1
+            return vbox1, vbox2
+    return None, None
+
+
+def split_boxes(queue, sort_key, target):
+    """
+    Keep splitting the top box of a queue until it holds the target number of colors.
+
+    The queue is kept sorted ascending by sort_key and popped from the end, exactly
+    like ColorThief's priority queue, so ties are broken the same way.
+
+    :param queue: List of VBox objects, modified in place
+    :param sort_key: Priority of a box
+    :param target: Number of colors to stop at
+    """
+    n_color = 1
+    for _ in range(MAX_ITERATION):
+        queue.sort(key=sort_key)
+        vbox = queue.pop()
+        if not vbox.count:
+            queue.append(vbox)
+            continue
+        vbox1, vbox2 = median_cut(vbox)
+        queue.append(vbox1)
+        if vbox2:
+            queue.append(vbox2)
+            n_color += 1
+        if n_color >= target:
+            return
+
+
+def get_palette_boxes(pixels, color_count=PALETTE_SIZE):
+    """
+    Quantize pixels into boxes, in ColorThief's palette order.
+
+    :param pixels: (N, 3) uint8 array of RGB values, N > 0
+    :param color_count: Maximum number of colors
+    :return: List of VBox objects, the dominant color's box first
+    """
+    histo = get_histogram(pixels)
+    quantized = pixels >> RSHIFT
+    lows, highs = quantized.min(axis=0), quantized.max(axis=0)
+    queue = [VBox((lows[0], highs[0], lows[1], highs[1], lows[2], highs[2]), histo)]
+
+    # first set of colors, sorted by population
+    split_boxes(queue, lambda box: box.count, FRACT_BY_POPULATIONS * color_count)
+    # then split by the product of population and size in color space, starting from
+    # the boxes in the order ColorThief pops them off its population queue
+    queue.sort(key=lambda box: box.count)
+    queue.reverse()
+    split_boxes(queue, lambda box: box.count * box.volume, color_count - len(queue))
+
+    queue.sort(key=lambda box: box.count * box.volume)
+    return queue[::-1]
+
+
+def get_valid_pixels(image, quality=1):
+    """
+    Sample the pixels of an image that ColorThief would consider.
+
+    Every quality-th pixel is taken, skipping mostly transparent and near-white ones.
+
+    :param image: PIL Image object
+    :param quality: Sampling stride, 1 examines every pixel
+    :return: (N, 3) uint8 array of RGB values
+    """
+    rgba = np.asarray(image.convert('RGBA')).reshape(-1, 4)[::quality]
+    opaque = rgba[:, 3] >= 125
+    white = (rgba[:, :3] > 250).all(axis=1)
+    return np.ascontiguousarray(rgba[opaque & ~white, :3])
+
+
+def get_palette(image, quality=1, color_count=PALETTE_SIZE):
+    """
+    Get a small weighted palette of an image, in ColorThief's palette order.
+
+    The dominant color comes first and is the one ColorThief.get_color would give.
+    Each color is weighted by the share of the sampled pixels its box holds, and
+    boxes left with no pixels are dropped.
+
+    :param image: PIL Image object
+    :param quality: Sampling stride, 1 examines every pixel
+    :param color_count: Maximum number of colors
+    :return: List of [red, green, blue, weight] lists
+    """
+    pixels = get_valid_pixels(image, quality)
+    if pixels.size == 0:
+        return [[*EMPTY_COLOR, 1.0]]
+    boxes = get_palette_boxes(pixels, color_count)
+    return [[*box.average(), round(box.count / len(pixels), 4)]
+            for box in boxes if box.count]
+
+
+def get_palettes(images, quality=1):
+    """
+    Get the weighted palette of each of a batch of images.
+
+    :param images: Iterable of PIL Image objects
+    :param quality: Sampling stride, 1 examines every pixel
+    :return: List of palettes get_palette returns, in the same order as the images
+    """
+    return [get_palette(image, quality) for image in images]
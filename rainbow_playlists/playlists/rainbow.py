@@ -0,0 +1,300 @@
+"""
+Rainbow playlist logic shared by the synchronous views and the async views.
+
+Both sets of views make the same Spotify requests and keep their results under the
+same cache keys; only how they wait on the I/O differs. Everything that does not
+wait on I/O is here: the cache keys, the batches and request bodies that build and
+edit a playlist, how the responses are read and reported, which covers still need
+coloring, and how a rainbow playlist changes when its source does.
+"""
+
+import heapq
+import logging
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+
+from .matching import color_palette, color_ranks, get_ordering, path_insertion_keys
+from .metrics import span
+from .tracks import TRACK_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# the Spotify API returns, and accepts, at most 100 playlist tracks per request
+PAGE_SIZE = 100
+# a snapshot of a playlist never changes, so its tracks can be kept for a long time
+TRACKS_CACHE_TIMEOUT = 24 * 60 * 60
+DEFAULT_PLAYLISTS_CACHE_TIMEOUT = 300
+PLAYLIST_NAME = "Your Rainbow Playlist"
+
+
+def get_tracks_cache_key(playlist_id, snapshot_id):
+    """
+    Get the cache key holding the tracks of a snapshot of a playlist.
+
+    :param playlist_id: ID of the playlist
+    :param snapshot_id: Snapshot ID of the playlist
+    :return: Cache key string
+    """
+    return f"playlist-track-records:{playlist_id}:{snapshot_id}"
+
+
+def get_user_playlists_cache_key(user_id):
+    """
+    Get the cache key holding a user's playlist listing.
+
+    :param user_id: Spotify user ID
+    :return: Cache key string
+    """
+    return f"user-playlists:{user_id}"
+
+
+def get_playlists_cache_timeout():
+    """
+    Get how long a user's playlist listing is reused before it is fetched again.
+
+    :return: Timeout in seconds
+    """
+    return getattr(settings, 'RAINBOW_PLAYLISTS_CACHE_TIMEOUT', DEFAULT_PLAYLISTS_CACHE_TIMEOUT)
+
+
+def get_tracks_path(playlist_id):
+    """
+    Get the Web API path listing, adding and removing a playlist's tracks.
+
+    :param playlist_id: ID of the playlist
+    :return: Path relative to the Web API
+    """
+    return f"/playlists/{playlist_id}/tracks"
+
+
+def get_page_params(offset):
+    """
+    Get the query parameters requesting a page of a playlist's tracks.
+
+    :param offset: Index of the first track of the page
+    :return: Dictionary of query parameters
+    """
+    return {"offset": offset, "limit": PAGE_SIZE, "fields": TRACK_FIELDS}
+
+
+def get_batches(items):
+    """
+    Split a list into batches of at most PAGE_SIZE, the most the API accepts at once.
+
+    :param items: List of items, such as track URIs
+    :return: List of lists, in order
+    """
+    return [items[start:start + PAGE_SIZE] for start in range(0, len(items), PAGE_SIZE)]
+
+
+def get_playlist_data(name):
+    """
+    Get the request body creating a rainbow playlist.
+
+    :param name: Name of the playlist
+    :return: Dictionary to send as JSON
+    """
+    return {"name": name, "description": "Made with Python", "public": False}
+
+
+def get_removal_data(uris):
+    """
+    Get the request body removing every occurrence of some tracks from a playlist.
+
+    :param uris: List of at most PAGE_SIZE track URIs
+    :return: Dictionary to send as JSON
+    """
+    return {"tracks": [{"uri": uri} for uri in uris]}
+
+
+def get_insert_runs(tracks, inserted):
+    """
+    Work out the requests inserting new tracks into a playlist at their positions in
+    the given order.
+
+    Each run of consecutive new tracks is inserted with one request (or one per
+    PAGE_SIZE tracks). The runs are in playlist order and must be sent one after
+    another, so that every position is already final when it is used.
+
+    :param tracks: List of [track URI, color] pairs in the playlist's intended order,
+        of which every track not marked as inserted is already in the playlist
+    :param inserted: List of booleans, True for each of the tracks to insert
+    :return: List of (position, list of track URIs) tuples
+    """
+    runs = []
+    position = 0
+    while position < len(tracks):
+        if not inserted[position]:
+            position += 1
+            continue
+        run = []
+        while (position + len(run) < len(tracks) and len(run) < PAGE_SIZE
+               and inserted[position + len(run)]):
+            run.append(tracks[position + len(run)][0])
+        runs.append((position, run))
+        position += len(run)
+    return runs
+
+
+def report_population(playlist_id, uris, error=None):
+    """
+    Log the outcome of populating a rainbow playlist.
+
+    :param playlist_id: ID of the playlist
+    :param uris: List of the track URIs added to the playlist
+    :param error: SpotifyError that stopped the tracks being added, if any
+    :return: True if every track was added
+    """
+    if error is not None:
+        logger.error("Failed to add tracks. Status code: %s, Response: %s",
+                     error.status_code, error)
+        return False
+    logger.info("%d tracks added to playlist %s", len(uris), playlist_id)
+    return True
+
+
+def check_following_error(error):
+    """
+    Read a failed check of whether the user follows a playlist.
+
+    Spotify answers 403 or 404 for a playlist that has been deleted or made private,
+    which the user can no longer be following either.
+
+    :param error: SpotifyError the check failed with
+    :return: False, if the playlist has gone
+    :raises SpotifyError: if the check failed for any other reason
+    """
+    if error.status_code in (403, 404):
+        return False
+    raise error
+
+
+def find_uncolored(image_urls, colors, requested):
+    """
+    Find the covers that still have to be downloaded and colored.
+
+    :param image_urls: List of the album image URLs of some tracks
+    :param colors: Dictionary of the colors already known, keyed by image URL
+    :param requested: Container of the image URLs already being colored
+    :return: List of distinct image URLs, in order
+    """
+    return [url for url in dict.fromkeys(image_urls)
+            if url not in colors and url not in requested]
+
+
+def get_replaced_uris(rainbow, current_uris):
+    """
+    Find the tracks a rainbow playlist now holds more copies of than its source.
+
+    The API removes every copy of a track at once, so these lose them all, and
+    whatever copies the source still has are put back as new tracks.
+
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param current_uris: List of the URIs of every track now in the source, with a
+        track listed once per copy
+    :return: List of distinct track URIs, in playlist order
+    """
+    known = Counter(uri for uri, _ in rainbow.tracks)
+    current = Counter(current_uris)
+    return [uri for uri, count in known.items() if current[uri] < count]
+
+
+def find_new_uris(rainbow, current_uris):
+    """
+    Mark the tracks of a source that its rainbow playlist does not have yet.
+
+    Copies are counted, so each copy of a track beyond those already in the
+    playlist is new, as is every copy of a replaced track.
+
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param current_uris: List of the URIs of every track now in the source, with a
+        track listed once per copy
+    :return: List of booleans, True for each of the URIs that is new
+    """
+    known = Counter(uri for uri, _ in rainbow.tracks)
+    for uri in get_replaced_uris(rainbow, current_uris):
+        del known[uri]
+    new = []
+    for uri in current_uris:
+        new.append(known[uri] == 0)
+        if known[uri]:
+            known[uri] -= 1
+    return new
+
+
+def find_new_tracks(rainbow, tracks):
+    """
+    Find the tracks of a source playlist that its rainbow playlist does not have yet.
+
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param tracks: List of Track objects now in the source playlist
+    :return: List of Track objects, in the same order
+    """
+    new = find_new_uris(rainbow, [track.uri for track in tracks])
+    return [track for track, is_new in zip(tracks, new) if is_new]
+
+
+def plan_rainbow_changes(rainbow, current_uris, added, palettes=None):
+    """
+    Work out how a rainbow playlist changes to bring it up to date.
+
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param current_uris: List of the URIs of every track now in the source, with a
+        track listed once per copy
+    :param added: List of [track URI, color] pairs to add, in rainbow order, as
+        find_new_tracks picks them
+    :param palettes: Dictionary mapping track URIs to the stored palettes of their
+        album art, as merge_sorted_tracks takes it
+    :return: Tuple of the list of [track URI, color] pairs the playlist will have, in
+        order, the list of track URIs to remove from it, and a list of booleans
+        marking which of the pairs are to be inserted
+    """
+    removed = get_replaced_uris(rainbow, current_uris)
+    gone = set(removed)
+    kept = [[uri, color] for uri, color in rainbow.tracks if uri not in gone]
+    merged = merge_sorted_tracks(kept, added, palettes)
+    # the merge keeps the existing pairs, in order, so they are found by identity
+    inserted = []
+    position = 0
+    for track in merged:
+        is_kept = position < len(kept) and track is kept[position]
+        position += is_kept
+        inserted.append(not is_kept)
+    return merged, removed, inserted
+
+
+def merge_sorted_tracks(kept, added, palettes=None):
+    """
+    Merge newly added tracks into a rainbow playlist's existing order.
+
+    The existing tracks keep their order, and each new track goes in before the
+    first existing track that ranks after it. Under the 'path' ordering, each new
+    track instead goes straight after the existing track whose palette is nearest
+    to its own. The palettes are the stored ones the path was first built from,
+    and a track with none stored stands for its dominant color alone.
+
+    :param kept: List of [track URI, color] pairs already in the playlist, in order
+    :param added: List of [track URI, color] pairs to add, in rainbow order
+    :param palettes: Dictionary mapping track URIs to the stored palettes of their
+        album art, only used under the 'path' ordering
+    :return: List of [track URI, color] pairs in the merged order
+    """
+    palettes = palettes or {}
+    with span('matching', tracks=len(added)):
+        if get_ordering() == 'path':
+            kept_keys, added_keys = path_insertion_keys(
+                [palettes.get(uri) or color_palette(color) for uri, color in kept],
+                [palettes.get(uri) or color_palette(color) for uri, color in added])
+            # new tracks that go in at the same place keep their order
+            added_order = np.argsort(added_keys, kind='stable')
+            kept_keys = kept_keys.tolist()
+            added_keys = added_keys[added_order].tolist()
+            added = [added[index] for index in added_order]
+        else:
+            kept_keys = color_ranks([color for _, color in kept]).tolist()
+            added_keys = color_ranks([color for _, color in added]).tolist()
+        merged = heapq.merge(zip(kept_keys, kept), zip(added_keys, added),
+                             key=lambda item: item[0])
+        return [track for _, track in merged]
@@ -0,0 +1,323 @@
+"""
+Shared Spotify Web API client for the Rainbow Playlists application.
+
+Every API call goes through one pooled, keep-alive requests session and a
+process-wide token bucket, so concurrent jobs share the process's rate budget
+instead of each tripping it. The bucket is not shared between processes, so each
+server worker process gets RAINBOW_SPOTIFY_RATE to itself. Rate-limited (429) and
+transient server errors are retried, honouring Spotify's Retry-After header, before
+a SpotifyError is raised; requests that are not idempotent, such as creating a
+playlist, are only retried when Spotify cannot have acted on them. Requests, retries
+and rate limiting are timed and counted in the metrics module.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from functools import lru_cache
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "https://api.spotify.com/v1"
+DEFAULT_ACCOUNTS_URL = "https://accounts.spotify.com"
+DEFAULT_RATE = 10       # sustained requests per second
+DEFAULT_BURST = 20      # requests allowed in a single burst
+DEFAULT_LOW_PRIORITY_RATE = 2   # of DEFAULT_RATE, for low-priority clients
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 30        # seconds
+MAX_RETRY_AFTER = 60    # seconds; a longer Retry-After fails the request instead
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+class SpotifyError(Exception):
+    """
+    Raised when a Spotify API request fails, after any retries.
+    """
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the rate of API requests.
+
+    Threads wait for a token with ``acquire`` and coroutines with ``aacquire``, so
+    the synchronous and asynchronous clients share one budget.
+
+    A rate-limited response pauses the whole bucket, so every caller backs off
+    together rather than each discovering the limit separately.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token if one is available, without waiting.
+
+        :return: 0 if a request may be sent now, otherwise how many seconds to wait
+            before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while wait := self.reserve():
+            time.sleep(wait)
+
+    async def aacquire(self):
+        """
+        Wait, without blocking the event loop, until a request may be sent.
+        """
+        while wait := self.reserve():
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hold back every request for the given number of seconds.
+
+        :param seconds: How long to pause for
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    """
+    Get the token bucket shared by every Spotify client in the process.
+
+    :return: TokenBucket object
+    """
+    return TokenBucket(getattr(settings, 'RAINBOW_SPOTIFY_RATE', DEFAULT_RATE),
+                       getattr(settings, 'RAINBOW_SPOTIFY_BURST', DEFAULT_BURST))
+
+
+@lru_cache(maxsize=None)
+def get_low_priority_rate_limiter():
+    """
+    Get the token bucket low-priority clients draw on as well as the shared one, so
+    together they take at most RAINBOW_LOW_PRIORITY_SPOTIFY_RATE of the rate budget.
+
+    :return: TokenBucket object
+    """
+    rate = getattr(settings, 'RAINBOW_LOW_PRIORITY_SPOTIFY_RATE', DEFAULT_LOW_PRIORITY_RATE)
+    return TokenBucket(rate, max(1, rate))
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """
+    Get the pooled requests session shared by every Spotify client in the process.
+
+    :return: requests.Session object
+    """
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_api_url(path):
+    """
+    Get the full URL of a Spotify Web API endpoint.
+
+    :param path: Endpoint path, such as '/me'
+    :return: Full endpoint URL
+    """
+    return getattr(settings, 'RAINBOW_SPOTIFY_API_URL', DEFAULT_API_URL) + path
+
+
+def get_accounts_url(path):
+    """
+    Get the full URL of a Spotify accounts service endpoint.
+
+    :param path: Endpoint path, such as '/api/token'
+    :return: Full endpoint URL
+    """
+    return getattr(settings, 'RAINBOW_SPOTIFY_ACCOUNTS_URL', DEFAULT_ACCOUNTS_URL) + path
+
+
+def get_retry_delay(response, attempt):
+    """
+    Work out how long to wait before retrying a failed request.
+
+    :param response: Response object, or None if the request never completed
+    :param attempt: Number of attempts made so far
+    :return: Delay in seconds
+    """
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return int(response.headers['Retry-After'])
+    return min(MAX_BACKOFF, 0.5 * 2 ** attempt)
+
+
+def can_retry(method, status_code=None, sent=True):
+    """
+    Check whether a failed request may be sent again.
+
+    Idempotent requests are retried after any transient failure. Others, such as
+    creating a playlist or exchanging an authorization code, are only retried when
+    Spotify cannot have acted on them: when they were rate limited, or never reached
+    it at all.
+
+    :param method: HTTP method
+    :param status_code: Status of the failed response, or None if there was none
+    :param sent: False if the request is known never to have reached Spotify
+    :return: True if the request may be retried
+    """
+    if status_code is not None and status_code not in RETRY_STATUSES:
+        return False
+    return method.upper() in IDEMPOTENT_METHODS or status_code == 429 or not sent
+
+
+def was_sent(error):
+    """
+    Check whether a request that raised an exception may have reached Spotify.
+
+    :param error: requests.RequestException the request failed with
+    :return: False if the connection was never made, otherwise True
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    # covers connections refused or failing to resolve, as well as timing out
+    return not isinstance(reason, ConnectTimeoutError)
+
+
+def plan_retry(method, url, attempt, response=None, error=None):
+    """
+    Log and count a retry, and work out how long to wait before making it.
+
+    A rate-limited response pauses the shared token bucket for the whole delay
+    instead, so every request waits it out together and the caller need not. A
+    Retry-After longer than MAX_RETRY_AFTER is not waited out at all, since pausing
+    the bucket for it would hold up every request in the process.
+
+    :param method: HTTP method
+    :param url: Full URL
+    :param attempt: Number of attempts made so far
+    :param response: Response to retry, or None if the request never completed
+    :param error: Exception the request failed with, if it never completed
+    :return: Seconds to sleep before retrying
+    """
+    delay = get_retry_delay(response, attempt)
+    if delay > MAX_RETRY_AFTER:
+        raise SpotifyError(f"{method} {url} failed with status {response.status_code}: "
+                           f"retry requested after {delay}s", response.status_code)
+    metrics.increment('spotify_retries')
+    if response is None:
+        logger.warning("%s %s failed (%s), retrying in %.1fs", method, url, error, delay)
+        return delay
+    logger.warning("%s %s returned status %s, retrying in %.1fs",
+                   method, url, response.status_code, delay)
+    if response.status_code == 429:
+        metrics.increment('spotify_rate_limited')
+        get_rate_limiter().pause(delay)
+        return 0
+    return delay
+
+
+class SpotifyClient:
+    """
+    Client for the Spotify Web API, authenticated with a user's access token.
+
+    The token may be a fixed string, or a callable returning a current access token
+    on each request, such as a UserToken that refreshes itself. A low-priority
+    client, for work no user is waiting on, is held to a smaller slice of the rate
+    budget, leaving the rest for everyone else's requests.
+    """
+
+    def __init__(self, access_token=None, low_priority=False):
+        self.access_token = access_token
+        self.low_priority = low_priority
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request to Spotify, retrying rate-limited and transient failures.
+
+        :param method: HTTP method
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to requests
+        :return: Decoded JSON body of the response, or None if it has no body
+        """
+        if url.startswith('/'):
+            url = get_api_url(url)
+        headers = kwargs.pop('headers', {})
+        access_token = self.access_token() if callable(self.access_token) else self.access_token
+        if access_token:
+            headers['Authorization'] = f"Bearer {access_token}"
+        kwargs.setdefault('timeout', 10)
+
+        limiter = get_rate_limiter()
+        with metrics.span('spotify_request', method=method, url=url):
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                if self.low_priority:
+                    get_low_priority_rate_limiter().acquire()
+                limiter.acquire()
+                metrics.increment('spotify_requests')
+                try:
+                    response = get_session().request(method, url, headers=headers, **kwargs)
+                except requests.RequestException as error:
+                    if attempt == MAX_ATTEMPTS or not can_retry(method, sent=was_sent(error)):
+                        raise SpotifyError(f"{method} {url} failed: {error}") from error
+                    time.sleep(plan_retry(method, url, attempt, error=error))
+                    continue
+
+                if attempt == MAX_ATTEMPTS or not can_retry(method, response.status_code):
+                    break
+                time.sleep(plan_retry(method, url, attempt, response))
+
+        if not response.ok:
+            raise SpotifyError(f"{method} {url} failed with status {response.status_code}: "
+                               f"{response.text}", response.status_code)
+        return response.json() if response.content else None
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request to Spotify.
+
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to requests
+        :return: Decoded JSON body of the response
+        """
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Send a POST request to Spotify.
+
+        :param url: Full URL, or a path relative to the Web API
+        :param kwargs: Extra arguments passed on to requests
+        :return: Decoded JSON body of the response
+        """
+        return self.request('POST', url, **kwargs)
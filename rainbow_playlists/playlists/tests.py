@@ -1,3 +1,519 @@
-from django.test import TestCase
+"""
+Tests for the Rainbow Playlists application.
 
-# Create your tests here.
+None of them touch Spotify or its CDN: the HTTP sessions are replaced with mocks,
+and the album art is drawn by the mock_spotify module.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from io import BytesIO
+from unittest import mock
+
+import requests
+from colorthief import ColorThief
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+
+from . import downloads, image_cache
+from .extraction import decode_image, get_image_palettes
+from .mock_spotify import make_cover
+from .quantize import EMPTY_COLOR, PALETTE_SIZE
+from .rainbow import PAGE_SIZE, find_new_uris, merge_sorted_tracks, plan_rainbow_changes
+from .spotify import MAX_ATTEMPTS, MAX_RETRY_AFTER, SpotifyClient, SpotifyError
+from .tracks import parse_tracks
+from .views import apply_rainbow_changes, insert_playlist_tracks
+
+RED, GREEN, BLUE = [255, 0, 0], [0, 255, 0], [0, 0, 255]
+
+
+def make_response(status_code, body=b"", headers=None):
+    """
+    Build a response as the requests session would return it.
+
+    :param status_code: HTTP status code
+    :param body: Bytes of the body
+    :param headers: Dictionary of response headers
+    :return: requests.Response object
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = body  # pylint: disable=protected-access
+    return response
+
+
+class MergeSortedTracksTests(SimpleTestCase):
+    """
+    Merging new tracks into an existing rainbow playlist's order.
+    """
+
+    def test_existing_order_is_kept(self):
+        """
+        Tracks already in the playlist stay in their order.
+        """
+        kept = [["a", BLUE], ["b", RED]]
+        merged = merge_sorted_tracks(kept, [["c", GREEN]])
+        self.assertEqual([uri for uri, _ in merged if uri in ("a", "b")], ["a", "b"])
+        self.assertEqual(len(merged), 3)
+
+    @override_settings(RAINBOW_ORDERING='hue')
+    def test_duplicates_are_all_kept(self):
+        """
+        A track listed more than once keeps every copy.
+        """
+        kept = [["a", RED], ["b", GREEN], ["b", GREEN], ["c", BLUE]]
+        added = [["d", RED], ["d", RED], ["b", GREEN]]
+        merged = merge_sorted_tracks(kept, added)
+        # equal colors keep the existing tracks first, then the new ones in order
+        self.assertEqual(merged, [["a", RED], ["d", RED], ["d", RED], ["b", GREEN],
+                                  ["b", GREEN], ["b", GREEN], ["c", BLUE]])
+
+    @override_settings(RAINBOW_ORDERING='path')
+    def test_duplicates_are_all_kept_on_the_path(self):
+        """
+        A track listed more than once keeps every copy under the 'path' ordering.
+        """
+        kept = [["a", RED], ["b", GREEN], ["c", BLUE]]
+        added = [["d", GREEN], ["d", GREEN], ["a", RED]]
+        merged = merge_sorted_tracks(kept, added)
+        self.assertEqual(sorted(uri for uri, _ in merged), ["a", "a", "b", "c", "d", "d"])
+        self.assertEqual([uri for uri, _ in merged if uri in ("b", "c")], ["b", "c"])
+        # new tracks go in straight after the existing track nearest in color
+        self.assertEqual([uri for uri, _ in merged][merged.index(["b", GREEN]):][:3],
+                         ["b", "d", "d"])
+
+    @override_settings(RAINBOW_ORDERING='path')
+    def test_stored_palettes_place_new_tracks(self):
+        """
+        Under the 'path' ordering, new tracks are placed by their stored palettes.
+        """
+        grey = [128, 128, 128]
+        kept = [["a", grey], ["b", grey]]
+        palettes = {"a": [[*grey, 0.5], [*RED, 0.5]], "b": [[*grey, 0.5], [*BLUE, 0.5]],
+                    "c": [[*grey, 0.6], [*BLUE, 0.4]]}
+        merged = merge_sorted_tracks(kept, [["c", grey]], palettes)
+        self.assertEqual([uri for uri, _ in merged], ["a", "b", "c"])
+
+
+class InsertPlaylistTracksTests(SimpleTestCase):
+    """
+    Inserting new tracks into a playlist at their positions.
+    """
+
+    def insert(self, tracks, new_uris):
+        """
+        Insert tracks with a mocked client, applying each request to a playlist.
+
+        :param tracks: List of [track URI, color] pairs in the intended order
+        :param new_uris: Set of the URIs of the tracks to insert
+        :return: Tuple of the list of requests sent, as (position, URIs) tuples, and
+            the playlist's track URIs afterwards
+        """
+        inserted = [uri in new_uris for uri, _ in tracks]
+        playlist = [uri for uri, _ in tracks if uri not in new_uris]
+        client = mock.Mock()
+        insert_playlist_tracks(client, "rainbow", tracks, inserted)
+        sent = []
+        for call in client.post.call_args_list:
+            self.assertEqual(call.args, ("/playlists/rainbow/tracks",))
+            data = call.kwargs['json']
+            self.assertLessEqual(len(data["uris"]), PAGE_SIZE)
+            playlist[data["position"]:data["position"]] = data["uris"]
+            sent.append((data["position"], data["uris"]))
+        return sent, playlist
+
+    def test_runs_go_in_at_their_positions(self):
+        """
+        Each run of new tracks is inserted with one request at its final position.
+        """
+        tracks = [[uri, RED] for uri in ["n1", "a", "b", "n2", "n3", "c", "n4"]]
+        sent, playlist = self.insert(tracks, {"n1", "n2", "n3", "n4"})
+        self.assertEqual(sent, [(0, ["n1"]), (3, ["n2", "n3"]), (6, ["n4"])])
+        self.assertEqual(playlist, [uri for uri, _ in tracks])
+
+    def test_long_runs_are_batched(self):
+        """
+        A run longer than a page is split across requests.
+        """
+        new = [f"n{index}" for index in range(2 * PAGE_SIZE + 50)]
+        tracks = [["a", RED]] + [[uri, RED] for uri in new] + [["b", RED]]
+        sent, playlist = self.insert(tracks, set(new))
+        self.assertEqual([(position, len(uris)) for position, uris in sent],
+                         [(1, PAGE_SIZE), (1 + PAGE_SIZE, PAGE_SIZE), (1 + 2 * PAGE_SIZE, 50)])
+        self.assertEqual(playlist, [uri for uri, _ in tracks])
+
+    def test_nothing_new_sends_nothing(self):
+        """
+        No requests are sent when there is nothing to insert.
+        """
+        sent, _ = self.insert([["a", RED], ["b", GREEN]], set())
+        self.assertEqual(sent, [])
+
+
+class PlaylistClient:
+    """
+    Stand-in for a SpotifyClient, editing one playlist's tracks as the API does.
+    """
+
+    def __init__(self, uris):
+        self.uris = list(uris)
+
+    def post(self, url, json):  # pylint: disable=unused-argument
+        """
+        Add tracks at a position, or at the end.
+        """
+        position = json.get("position", len(self.uris))
+        self.uris[position:position] = json["uris"]
+
+    def request(self, method, url, json):  # pylint: disable=unused-argument
+        """
+        Remove every copy of some tracks.
+        """
+        removed = {track["uri"] for track in json["tracks"]}
+        self.uris = [uri for uri in self.uris if uri not in removed]
+
+
+class IncrementalUpdateTests(SimpleTestCase):
+    """
+    Bringing a rainbow playlist up to date with a changed source playlist.
+    """
+
+    colors = {"a": RED, "b": GREEN, "c": BLUE}
+
+    def update(self, tracks, current_uris):
+        """
+        Apply a source's changes to a rainbow playlist as the views do.
+
+        :param tracks: List of [track URI, color] pairs the rainbow playlist holds
+        :param current_uris: List of the URIs now in the source
+        :return: Tuple of the RainbowPlaylist stand-in afterwards, the playlist's track
+            URIs on Spotify, and the number of tracks added
+        """
+        rainbow = mock.Mock(tracks=tracks, rainbow_playlist_id="rainbow")
+        client = PlaylistClient(uri for uri, _ in tracks)
+        new = find_new_uris(rainbow, current_uris)
+        added = sorted(([uri, self.colors[uri]] for uri, is_new in zip(current_uris, new)
+                        if is_new), key=lambda track: list(self.colors).index(track[0]))
+        changes = plan_rainbow_changes(rainbow, current_uris, added)
+        apply_rainbow_changes(client, rainbow, "snapshot", changes)
+        self.assertEqual(Counter(client.uris), Counter(current_uris))
+        self.assertEqual(client.uris, [uri for uri, _ in rainbow.tracks])
+        return rainbow, client.uris, len(added)
+
+    def test_added_copy_is_inserted(self):
+        """
+        A second copy of a track already in the playlist is inserted.
+        """
+        _, uris, added = self.update([["a", RED], ["b", GREEN], ["c", BLUE]],
+                                     ["a", "b", "c", "b"])
+        self.assertEqual((uris, added), (["a", "b", "b", "c"], 1))
+
+    def test_removed_copy_is_removed(self):
+        """
+        Removing one of two copies of a track leaves one in the playlist.
+        """
+        _, uris, _ = self.update([["a", RED], ["b", GREEN], ["b", GREEN], ["c", BLUE]],
+                                 ["a", "b", "c"])
+        self.assertEqual(uris, ["a", "b", "c"])
+
+    def test_removed_track_is_removed(self):
+        """
+        A track gone from the source, with every copy, is removed.
+        """
+        _, uris, added = self.update([["a", RED], ["b", GREEN], ["b", GREEN], ["c", BLUE]],
+                                     ["c", "a"])
+        self.assertEqual((uris, added), (["a", "c"], 0))
+
+    def test_unchanged_copies_are_left_alone(self):
+        """
+        Nothing is sent for a source whose copies of each track are unchanged.
+        """
+        rainbow, uris, added = self.update([["a", RED], ["b", GREEN], ["b", GREEN]],
+                                           ["b", "a", "b"])
+        self.assertEqual((uris, added, rainbow.snapshot_id), (["a", "b", "b"], 0, "snapshot"))
+
+
+class SpotifyClientTests(SimpleTestCase):
+    """
+    Retries and rate limiting in the Spotify client.
+    """
+
+    def setUp(self):
+        self.request = self.patch('playlists.spotify.get_session').return_value.request
+        self.limiter = self.patch('playlists.spotify.get_rate_limiter').return_value
+        self.sleep = self.patch('playlists.spotify.time.sleep')
+
+    def patch(self, target):
+        """
+        Replace an object with a mock for the rest of the test.
+
+        :param target: Dotted path of the object
+        :return: The mock
+        """
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_transient_errors_are_retried(self):
+        """
+        A server error is retried after a backoff.
+        """
+        self.request.side_effect = [
+            make_response(503), make_response(200, b'{"id": "me"}')]
+        self.assertEqual(SpotifyClient("token").get("/me"), {"id": "me"})
+        self.assertEqual(self.request.call_count, 2)
+        self.sleep.assert_called_once()
+        self.limiter.pause.assert_not_called()
+
+    def test_retries_give_up(self):
+        """
+        A request failing every attempt raises SpotifyError.
+        """
+        self.request.return_value = make_response(502)
+        with self.assertRaises(SpotifyError) as raised:
+            SpotifyClient("token").get("/me")
+        self.assertEqual(raised.exception.status_code, 502)
+        self.assertEqual(self.request.call_count, MAX_ATTEMPTS)
+
+    def test_retry_after_pauses_every_request(self):
+        """
+        A rate-limited response pauses the shared bucket for its Retry-After.
+        """
+        self.request.side_effect = [
+            make_response(429, headers={'Retry-After': '3'}), make_response(200, b'{}')]
+        self.assertEqual(SpotifyClient("token").get("/me"), {})
+        self.limiter.pause.assert_called_once_with(3)
+        # the paused bucket does the waiting, rather than the request itself
+        self.sleep.assert_called_once_with(0)
+
+    def test_long_retry_after_fails(self):
+        """
+        A Retry-After over the cap fails the request without pausing the bucket.
+        """
+        self.request.return_value = make_response(
+            429, headers={'Retry-After': str(MAX_RETRY_AFTER + 1)})
+        with self.assertRaises(SpotifyError) as raised:
+            SpotifyClient("token").get("/me")
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(self.request.call_count, 1)
+        self.limiter.pause.assert_not_called()
+        self.sleep.assert_not_called()
+
+    def test_post_is_not_retried_after_server_error(self):
+        """
+        A POST that reached Spotify is not sent again after a server error.
+        """
+        self.request.return_value = make_response(503)
+        with self.assertRaises(SpotifyError):
+            SpotifyClient("token").post("/users/me/playlists", json={})
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_post_is_not_retried_after_read_timeout(self):
+        """
+        A POST that may have reached Spotify is not sent again after a timeout.
+        """
+        self.request.side_effect = requests.ReadTimeout()
+        with self.assertRaises(SpotifyError):
+            SpotifyClient("token").post("/users/me/playlists", json={})
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_post_is_retried_if_never_sent(self):
+        """
+        A POST is sent again if it never connected, or was rate limited.
+        """
+        self.request.side_effect = [
+            requests.ConnectTimeout(), make_response(429), make_response(201, b'{"id": "p"}')]
+        result = SpotifyClient("token").post("/users/me/playlists", json={})
+        self.assertEqual(result, {"id": "p"})
+        self.assertEqual(self.request.call_count, 3)
+
+
+def to_file(image):
+    """
+    Save a decoded image losslessly, for ColorThief to open.
+
+    :param image: PIL Image object
+    :return: File-like object holding the image as a PNG
+    """
+    buffer = BytesIO()
+    image.save(buffer, 'PNG')
+    buffer.seek(0)
+    return buffer
+
+
+class ParseTracksTests(SimpleTestCase):
+    """
+    Picking out the playlist items with album art to sort by.
+    """
+
+    def test_items_without_album_art_are_skipped(self):
+        """
+        Episodes, local files and removed tracks are left out.
+        """
+        image = {"url": "https://i.scdn.co/image/cover", "width": 300, "height": 300}
+        track = {"id": "t", "uri": "spotify:track:t", "album": {"id": "a", "images": [image]}}
+        items = [{"track": {"id": "e", "uri": "spotify:episode:e", "type": "episode"}},
+                 {"track": {"id": None, "uri": "spotify:local:x", "album": {"images": []}}},
+                 {"track": None}, {}, {"track": track}]
+        tracks = parse_tracks(items)
+        self.assertEqual([(item.id, item.image_url) for item in tracks], [("t", image["url"])])
+
+
+class ImageCacheTests(SimpleTestCase):
+    """
+    Revalidating and evicting covers in the on-disk image cache.
+    """
+
+    url = "https://i.scdn.co/image/cover"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings = override_settings(RAINBOW_IMAGE_CACHE_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        patcher = mock.patch('playlists.downloads.get_session')
+        self.get = patcher.start().return_value.get
+        self.addCleanup(patcher.stop)
+
+    def respond(self, status_code, content=b"", headers=None):
+        """
+        Make the mocked session answer the next image request.
+
+        :param status_code: HTTP status code
+        :param content: Bytes of the image
+        :param headers: Dictionary of response headers
+        """
+        response = mock.Mock(status_code=status_code, headers=headers or {})
+        response.iter_content.return_value = [content]
+        self.get.return_value = response
+
+    def test_fresh_cover_is_not_requested(self):
+        """
+        A fresh cached cover is used without asking the CDN.
+        """
+        self.respond(200, b"cover", {'Cache-Control': 'max-age=3600'})
+        self.assertEqual(downloads.fetch_image(self.url).content, b"cover")
+        self.assertEqual(downloads.fetch_image(self.url).content, b"cover")
+        self.assertEqual(self.get.call_count, 1)
+
+    def test_stale_cover_is_revalidated(self):
+        """
+        A stale cover is revalidated, and a 304 reuses the cached copy.
+        """
+        self.respond(200, b"cover", {'ETag': '"v1"', 'Cache-Control': 'max-age=0'})
+        downloads.fetch_image(self.url)
+
+        self.respond(304, headers={'Cache-Control': 'max-age=3600'})
+        result = downloads.fetch_image(self.url)
+        self.assertEqual(result.content, b"cover")
+        headers = self.get.call_args.kwargs['headers']
+        self.assertEqual(headers, {'If-None-Match': '"v1"'})
+        # the 304 kept the old ETag and made the cover fresh again
+        cached = image_cache.lookup(self.url)
+        self.assertEqual(cached.etag, '"v1"')
+        self.assertTrue(image_cache.is_fresh(cached))
+
+    def test_changed_cover_is_replaced(self):
+        """
+        A stale cover the CDN has changed is downloaded and cached again.
+        """
+        self.respond(200, b"cover", {'ETag': '"v1"', 'Cache-Control': 'no-cache'})
+        downloads.fetch_image(self.url)
+        self.respond(200, b"new cover", {'ETag': '"v2"'})
+        self.assertEqual(downloads.fetch_image(self.url).content, b"new cover")
+        cached = image_cache.lookup(self.url)
+        self.assertEqual((cached.etag, image_cache.read(cached)), ('"v2"', b"new cover"))
+
+    def test_uncacheable_cover_is_not_stored(self):
+        """
+        A cover the CDN marks no-store is not cached.
+        """
+        self.respond(200, b"cover", {'Cache-Control': 'no-store'})
+        downloads.fetch_image(self.url)
+        self.assertIsNone(image_cache.lookup(self.url))
+
+    def test_least_recently_used_covers_are_evicted(self):
+        """
+        Eviction deletes the least recently used covers until the cache fits.
+        """
+        urls = [f"{self.url}/{index}" for index in range(4)]
+        for index, url in enumerate(urls):
+            image_cache.store(url, bytes([index]) * 1000, {'Cache-Control': 'max-age=3600'})
+        # age the covers in order, then use the oldest again
+        for age, url in enumerate(reversed(urls), start=1):
+            cached = image_cache.lookup(url)
+            for path in (image_cache.get_blob_path(self.directory, cached.sha256),
+                         image_cache.get_record_path(self.directory, url)):
+                os.utime(path, (time.time() - age * 60,) * 2)
+        image_cache.read(image_cache.lookup(urls[0]))
+
+        with override_settings(RAINBOW_IMAGE_CACHE_SIZE=3000):
+            self.assertGreater(image_cache.evict(), 0)
+            total = sum(size for _, size, _ in image_cache.list_files(self.directory))
+            self.assertLessEqual(total, 3000 * image_cache.EVICTION_TARGET)
+        kept = [url for url in urls
+                if (cached := image_cache.lookup(url)) and image_cache.read(cached)]
+        self.assertEqual(kept, [urls[0], urls[3]])
+
+
+class QuantizeTests(SimpleTestCase):
+    """
+    The vectorized median cut against the ColorThief library, which it ports.
+    """
+
+    def assert_matches_colorthief(self, image, quality):
+        """
+        Check the numpy engine's palette against ColorThief's for an image.
+
+        ColorThief also lists the boxes that ended up with no pixels, which the
+        weighted palette leaves out, so the palette is the start of ColorThief's.
+
+        :param image: PIL Image object
+        :param quality: Sampling stride over the pixels
+        """
+        [palette] = get_image_palettes([image], 'numpy', quality)
+        expected = ColorThief(to_file(image)).get_palette(PALETTE_SIZE, quality)
+        self.assertEqual([tuple(color[:3]) for color in palette], expected[:len(palette)])
+        self.assertAlmostEqual(sum(color[3] for color in palette), 1, places=3)
+
+    def test_matches_colorthief(self):
+        """
+        The palettes match ColorThief's at several sampling strides.
+        """
+        for album in range(12):
+            image = decode_image(BytesIO(make_cover(album, 300)), 64)
+            for quality in (1, 3, 10):
+                with self.subTest(album=album, quality=quality):
+                    self.assert_matches_colorthief(image, quality)
+
+    def test_matches_colorthief_at_full_size(self):
+        """
+        The palettes match ColorThief's for a cover decoded at full size.
+        """
+        self.assert_matches_colorthief(decode_image(BytesIO(make_cover(7, 300)), 0), 1)
+
+    def test_engines_agree(self):
+        """
+        The 'numpy' and 'colorthief' engines give the same weighted palettes.
+        """
+        images = [decode_image(BytesIO(make_cover(album, 300)), 64) for album in range(12)]
+        self.assertEqual(get_image_palettes(images, 'numpy', 1),
+                         get_image_palettes(images, 'colorthief', 1))
+
+    def test_blank_image(self):
+        """
+        An image with no usable pixels, which ColorThief cannot quantize, gives
+        EMPTY_COLOR from both engines.
+        """
+        image = Image.new('RGB', (64, 64), (255, 255, 255))
+        with self.assertRaises(Exception):
+            ColorThief(to_file(image)).get_palette(PALETTE_SIZE, 1)
+        expected = [[[255, 255, 255, 1.0]]]
+        self.assertEqual(EMPTY_COLOR, (255, 255, 255))
+        self.assertEqual(get_image_palettes([image], 'numpy', 1), expected)
+        self.assertEqual(get_image_palettes([image], 'colorthief', 1), expected)
@@ -0,0 +1,71 @@
+"""
+Compact track records for the rainbowify pipeline.
+
+Spotify describes each playlist item with a few kilobytes of JSON, but rainbowify
+only needs a track's ID, URI and album, and the URL of the one album image it sorts
+by. Playlist pages are requested with just those fields, and each item is parsed
+straight into a Track, a small ``__slots__`` record, so the JSON can be dropped as
+soon as a page is read. The record also carries the track's color and rank once the
+pipeline has worked them out.
+"""
+
+from django.conf import settings
+
+from .extraction import DEFAULT_COVER_MIN_SIZE, select_album_image
+
+# only the parts of each playlist item that a Track is made from
+TRACK_FIELDS = "total,items(track(id,uri,album(id,images(url,width))))"
+
+
+class Track:
+    """
+    A track in the rainbowify pipeline.
+    """
+    __slots__ = ('id', 'uri', 'album_id', 'image_url', 'color', 'rank')
+
+    def __init__(self, track_id, uri, album_id, image_url, color=None, rank=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.id = track_id
+        self.uri = uri
+        self.album_id = album_id
+        self.image_url = image_url
+        self.color = color
+        self.rank = rank
+
+    def __repr__(self):
+        return f"Track({self.id!r}, {self.uri!r}, {self.album_id!r}, {self.image_url!r})"
+
+    # records are kept in Django's cache, which pickles them
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def is_sortable(item):
+    """
+    Check whether a playlist or saved track item has album art to sort by; local
+    files, unavailable tracks and podcast episodes, which have no album, do not.
+
+    :param item: JSON result of a playlist track or saved track
+    :return: True if the item is a track with album art
+    """
+    track = item.get("track") or {}
+    album = track.get("album") or {}
+    return bool(track.get("id") and album.get("images"))
+
+
+def parse_tracks(items):
+    """
+    Parse playlist or saved track items into track records, leaving out the items
+    with no album art to sort by.
+
+    :param items: List of JSON results of playlist tracks or saved tracks
+    :return: List of Track objects, in the same order
+    """
+    min_size = getattr(settings, 'RAINBOW_COVER_MIN_SIZE', DEFAULT_COVER_MIN_SIZE)
+    return [Track(item["track"]["id"], item["track"]["uri"], item["track"]["album"].get("id"),
+                  select_album_image(item["track"]["album"]["images"], min_size))
+            for item in items if is_sortable(item)]
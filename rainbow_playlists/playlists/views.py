@@ -3,27 +3,54 @@ This module contains views and helper functions for the Rainbow Playlists Django
 The application allows users to log in with their Spotify account, view their playlists,
 and create a new playlist where tracks are sorted based on the dominant colors of their album art.
 """
+# pylint: disable=too-many-lines
 
+import hashlib
+import logging
 import os
-import json
-import shutil
-import requests
-from django.http import HttpResponse
-from django.shortcuts import render, redirect
-from dotenv import load_dotenv
-from colorthief import ColorThief
-from requests import post, get
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 import numpy as np
-from .colors import colors
-
-# load environment variables
-load_dotenv()
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse, Http404
+from django.shortcuts import render, redirect
+from django.utils import timezone
+from django.views.decorators.http import require_POST
+from .auth import CLIENT_ID, UserToken
+from .downloads import stream_images
+from .extraction import get_batch_size, palette_color, submit_extraction
+from .jobs import submit_job, get_job_status
+from .matching import color_palette, color_ranks, get_ordering, path_order
+from .metrics import increment, render_prometheus, span
+from .models import DominantColor, LibraryIndex, RainbowPlaylist, TrackColor
+from .pipeline import prefetch
+from .rainbow import (PAGE_SIZE, PLAYLIST_NAME, TRACKS_CACHE_TIMEOUT, check_following_error,
+                      find_new_tracks, find_new_uris, find_uncolored, get_batches, get_insert_runs,
+                      get_page_params, get_playlist_data, get_playlists_cache_timeout,
+                      get_removal_data, get_tracks_cache_key, get_tracks_path,
+                      get_user_playlists_cache_key, plan_rainbow_changes, report_population)
+from .spotify import SpotifyClient, SpotifyError
+from .tracks import parse_tracks
 
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 REDIRECT_URI = "http://localhost:8000/callback" # must be registered in spotify app
 SCOPES = "user-library-read playlist-read-private playlist-modify-public playlist-modify-private"
 
+# the API returns at most 50 saved tracks, or playlists, per request
+LIBRARY_PAGE_SIZE = 50
+# stands in for a source playlist ID in the record of a whole-library rainbow
+LIBRARY_SOURCE_ID = "library"
+LIBRARY_PLAYLIST_NAME = "Your Rainbow Library"
+# how often a user's library is indexed again, in seconds
+DEFAULT_LIBRARY_INDEX_INTERVAL = 24 * 60 * 60
+# longest an indexing job is expected to run, in seconds; another is not started
+# for the same user in the meantime
+LIBRARY_INDEX_LOCK_TIMEOUT = 30 * 60
+
+logger = logging.getLogger(__name__)
+
 def index(request):
     """
     Render the index page.
@@ -64,27 +91,16 @@ def callback(request):
     if not auth_code:
         return HttpResponse("No code provided", status=400)
 
-    url = "https://accounts.spotify.com/api/token"
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
-    data = {
-        "grant_type": "authorization_code",
-        "code": auth_code,
-        "redirect_uri": REDIRECT_URI,
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-    }
-    response = post(url, headers=headers, data=data, timeout=10)
-    response_data = response.json()
-
-    # Debugging: print the entire response data
-    print(response_data)
+    try:
+        token = UserToken.from_authorization_code(auth_code, REDIRECT_URI)
+    except SpotifyError as error:
+        return HttpResponse(f"Spotify login failed: {error}", status=502)
 
     ## storing values across the session.
-    request.session['access_token'] = response_data['access_token']
-    request.session['refresh_token'] = response_data['refresh_token']
-    return redirect(playlists)
+    token.save(request.session)
+    # a new login may be a different user, so forget any cached identity
+    request.session.pop('user_id', None)
+    return redirect('playlists')
 
 
 def playlists(request):
@@ -95,242 +111,1021 @@ def playlists(request):
     :return: HttpResponse object rendering 'playlists.html' with the user's playlists
     """
     # now that the token values are session-wide, they can be accessed
-    access_token = request.session.get('access_token')
-    headers = {'Authorization': f'Bearer {access_token}'}
-    url = "https://api.spotify.com/v1/me/playlists"
-    response = get(url=url, headers=headers, timeout=10)
-    json_result = json.loads(response.content)["items"]
+    token = UserToken.from_session(request.session)
+    if not token:
+        return redirect('login')
+    try:
+        client = SpotifyClient(token)
+        user_id = get_session_user_id(request, client)
+        json_result = get_user_playlists(client, user_id)
+    except SpotifyError as error:
+        return playlists_error_response(error)
+    finally:
+        # keep any refreshed token for the user's next request
+        token.save(request.session)
+    # keep the user's library index fresh, so a whole-library rainbow is quick
+    schedule_library_index(token, user_id)
     return render(request, 'playlists.html', {'playlists': json_result})
 
 
+def playlists_error_response(error):
+    """
+    Get the response for a playlist listing that Spotify refused.
+
+    :param error: SpotifyError the listing failed with
+    :return: HttpResponse object, redirecting to 'login' if the user must log in again
+    """
+    # a rejected token, or a refresh token that has been revoked
+    if error.status_code in (400, 401):
+        return redirect('login')
+    return HttpResponse(f"Could not load playlists: {error}", status=502)
+
+
 def rainbowify(request):
     """
-    Create a new playlist with tracks sorted by the dominant colors of their album art.
+    Start creating a new playlist with tracks sorted by the dominant colors of their
+    album art.
+
+    The work runs as a background job; the loading page polls its status until done.
 
     :param request: HttpRequest object
-    :return: HttpResponse object redirecting to the playlists view
+    :return: HttpResponse object rendering 'loading.html' for the queued job
     """
     # get the ID of the chosen playlist
     playlist_id = request.POST.get('playlist_id')
-    # get the access token
-    access_token = request.session.get('access_token')
+    # get the user's token; the job refreshes it itself if it runs past its expiry
+    token = UserToken.from_session(request.session)
+    if not token:
+        return redirect('login')
+    user_id = request.session.get('user_id')
+
+    job_id = submit_job(rainbowify_playlist, playlist_id, token, user_id)
+    return render(request, 'loading.html', {'job_id': job_id})
+
+
+@require_POST
+def library_rainbowify(request):
+    """
+    Start creating, or updating, a playlist of the user's whole library in rainbow
+    order.
+
+    :param request: HttpRequest object
+    :return: HttpResponse object rendering 'loading.html' for the queued job
+    """
+    token = UserToken.from_session(request.session)
+    if not token:
+        return redirect('login')
+    user_id = request.session.get('user_id')
+
+    job_id = submit_job(rainbowify_library, token, user_id)
+    return render(request, 'loading.html',
+                  {'job_id': job_id, 'message': "Your library is being rainbowified"})
+
 
-    # get the tracks within the chosen playlist
-    tracks_json_result = get_playlist_tracks(playlist_id, access_token)
+def rainbowify_status(request, job_id): # pylint: disable=unused-argument
+    """
+    Report the progress of a rainbowify job.
 
-    # set images directory and reset
-    reset_directory('art_images/')
+    :param request: HttpRequest object
+    :param job_id: ID of the job
+    :return: JsonResponse object with the job's stage and percent complete
+    """
+    status = get_job_status(job_id)
+    if status is None:
+        raise Http404("Unknown rainbowify job")
+    return JsonResponse(status)
 
-    # download the album images for the given tracks
-    download_album_images(tracks_json_result)
 
-    # extract the dominant colours from the album images
-    dominant_colors = extract_dominant_colors()
+def complete(request):
+    """
+    Render the page shown once a playlist has been rainbowified.
 
-    # find predefined colour closest to each dominant colour using euclidean distances
-    track_color_indices = []
-    for filename, dominant_color in dominant_colors.items():
-        closest_color_index = find_closest_predefined_color_index(dominant_color)
-        track_color_indices.append((filename, closest_color_index))
+    :param request: HttpRequest object
+    :return: HttpResponse object rendering 'complete.html'
+    """
+    return render(request, 'complete.html')
 
-    # sort the tracks based on the colour indices
-    track_color_indices.sort(key=lambda item: item[1])
 
-    # sorted album covers contains (filname, dominant_color) tuples
-    filename_to_track = {track['track']['id'] + "_image.png": track for track in tracks_json_result}
+def metrics(request): # pylint: disable=unused-argument
+    """
+    Report this process's timing spans and counters in the Prometheus text format.
 
-    # uris
-    uris = []
-    for filename, _ in track_color_indices:
-        track = filename_to_track.get(filename)
-        if track:
-            uris.append(track["track"]["uri"])
+    :param request: HttpRequest object
+    :return: HttpResponse object with the metrics
+    """
+    if not getattr(settings, 'RAINBOW_METRICS_ENABLED', True):
+        raise Http404("Metrics are disabled")
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4")
 
-    # get the user's user id (for playlist creation)
-    user_id = get_user_name(access_token)
 
-    # create the new, 'rainbowified' playlist (function returns playlist id)
-    new_playlist_id = create_user_playlist(access_token, user_id)
+def rainbowify_playlist(playlist_id, access_token, user_id=None, progress=None):
+    """
+    Make or bring up to date the rainbow playlist for one of the user's playlists.
+
+    The first run creates a new rainbow playlist. Later runs update that playlist in
+    place, processing only the tracks added since, and do nothing at all if the
+    source playlist has not changed.
+
+    The playlist's snapshot ID is always looked up from Spotify when the job runs,
+    never taken from the (possibly cached) playlist listing, so the tracks cache is
+    only read for the playlist as it is now, and only once Spotify has shown the
+    user can read it.
+
+    :param playlist_id: ID of the playlist to rainbowify
+    :param access_token: Spotify access token, or a callable such as a UserToken
+        returning a current one
+    :param user_id: Spotify user ID, if already known
+    :param progress: Optional callable taking a stage name and percent complete
+    :return: Number of tracks processed
+    """
+    progress = progress or (lambda stage, percent: None)
+    client = SpotifyClient(access_token)
+    user_id = user_id or get_user_name(client)
+
+    with span('rainbowify', playlist=playlist_id):
+        previous = RainbowPlaylist.objects.filter(
+            user_id=user_id, source_playlist_id=playlist_id).first()
+        # a rainbow playlist the user has since removed from their library is not reused
+        if previous and is_following_playlist(client, previous.rainbow_playlist_id, user_id):
+            tracks = update_rainbow_playlist(client, previous, progress)
+        else:
+            snapshot_id = get_playlist_snapshot_id(client, playlist_id)
+            tracks = create_rainbow_from_playlist(client, playlist_id, user_id, snapshot_id,
+                                                  progress)
+    logger.info("Rainbowified playlist %s for %s: %d tracks", playlist_id, user_id, tracks)
+    return tracks
+
+
+def create_rainbow_from_playlist(client, playlist_id, user_id, snapshot_id, progress):
+    """
+    Create a new playlist with tracks sorted by the dominant colors of their album art.
+
+    The work streams: covers from the first page of tracks are downloaded and
+    extracted while later pages are still being fetched, and the new playlist is
+    created alongside, so the job takes about as long as its slowest stage rather
+    than the sum of them all.
+
+    :param client: SpotifyClient object
+    :param playlist_id: ID of the playlist to rainbowify
+    :param user_id: Spotify user ID
+    :param snapshot_id: Snapshot ID of the playlist
+    :param progress: Callable taking a stage name and percent complete
+    :return: Number of tracks in the new playlist
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the new playlist does not depend on the tracks, so create it straight away
+        playlist_future = executor.submit(create_rainbow_playlist, client, user_id)
+        try:
+            # each run gets its own scratch space (or none at all when images are kept
+            # in memory), so concurrent rainbowify requests never see each other's covers
+            progress('processing tracks', 0)
+            with image_workspace() as images_directory:
+                tracks, colors = stream_track_colors(
+                    playlist_id, client, snapshot_id, images_directory)
+
+            # order the tracks by the colour of their album art
+            progress('sorting', 80)
+            sorted_tracks = sort_tracks(tracks, colors)
+        except Exception:
+            discard_playlist(client, playlist_future)
+            raise
+        progress('creating playlist', 85)
+        user_id, new_playlist_id = playlist_future.result()
+
+    # the user's playlist listing now includes the new playlist
+    cache.delete(get_user_playlists_cache_key(user_id))
+
     # and populate the new playlist with the sorted songs
-    if new_playlist_id:
-        populate_rainbow_playlist(access_token, new_playlist_id, uris)
+    progress('adding tracks', 90)
+    if populate_rainbow_playlist(client, new_playlist_id, [uri for uri, _ in sorted_tracks]):
+        RainbowPlaylist.objects.update_or_create(
+            user_id=user_id, source_playlist_id=playlist_id,
+            defaults={'rainbow_playlist_id': new_playlist_id, 'snapshot_id': snapshot_id,
+                      'tracks': sorted_tracks})
+    return len(sorted_tracks)
 
-    return redirect('playlists')
+
+def update_rainbow_playlist(client, rainbow, progress):
+    """
+    Bring an existing rainbow playlist up to date with its source playlist.
+
+    Only the tracks added to the source since the last run are colored. Tracks
+    that have gone are removed, and the new ones are inserted at their places in
+    the rainbow, leaving the rest of the playlist as it is. Copies of a track are
+    counted, so adding or removing a copy is picked up too. Nothing is done if the
+    source's current snapshot ID, fetched from Spotify, is the one last recorded.
+
+    :param client: SpotifyClient object
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param progress: Callable taking a stage name and percent complete
+    :return: Number of tracks added
+    """
+    snapshot_id = get_playlist_snapshot_id(client, rainbow.source_playlist_id)
+    if snapshot_id == rainbow.snapshot_id:
+        return 0
+
+    progress('fetching tracks', 0)
+    tracks = get_playlist_tracks(rainbow.source_playlist_id, client, snapshot_id)
+    new_tracks = find_new_tracks(rainbow, tracks)
+
+    progress('processing new tracks', 10)
+    with image_workspace() as images_directory:
+        added = sort_tracks(new_tracks, get_track_colors(new_tracks, images_directory))
+
+    progress('updating playlist', 80)
+    changes = plan_rainbow_changes(rainbow, [track.uri for track in tracks], added,
+                                   get_track_palettes(tracks))
+    apply_rainbow_changes(client, rainbow, snapshot_id, changes)
+    return len(added)
+
+
+def get_track_palettes(tracks):
+    """
+    Look up the stored palettes of tracks' album art, which the 'path' ordering
+    places new tracks by.
+
+    :param tracks: List of Track objects
+    :return: Dictionary mapping track URIs to palettes, empty under other orderings
+    """
+    if get_ordering() != 'path':
+        return {}
+    palettes = DominantColor.objects.palettes(track.image_url for track in tracks)
+    return {track.uri: palettes[track.image_url]
+            for track in tracks if track.image_url in palettes}
+
+
+def get_indexed_palettes(track_ids):
+    """
+    Look up the palettes of tracks in the track color index, which the 'path'
+    ordering places new tracks by.
+
+    :param track_ids: List of track IDs
+    :return: Dictionary mapping track URIs to palettes, empty under other orderings
+    """
+    if get_ordering() != 'path':
+        return {}
+    return {f"spotify:track:{track_id}": palette
+            for track_id, palette in TrackColor.objects.palettes(track_ids).items()}
+
+
+def apply_rainbow_changes(client, rainbow, snapshot_id, changes):
+    """
+    Remove the tracks that have gone from a rainbow playlist and insert new ones at
+    their places in the rainbow, then record the result.
+
+    :param client: SpotifyClient object
+    :param rainbow: RainbowPlaylist object recording the last run
+    :param snapshot_id: Snapshot ID of the source the playlist is now up to date with
+    :param changes: Tuple of the tracks the playlist will have, the URIs to remove and
+        the tracks to insert, as plan_rainbow_changes returns it
+    """
+    merged, removed, inserted = changes
+    with span('playlist_update', playlist=rainbow.rainbow_playlist_id):
+        remove_playlist_tracks(client, rainbow.rainbow_playlist_id, removed)
+        insert_playlist_tracks(client, rainbow.rainbow_playlist_id, merged, inserted)
+
+    rainbow.snapshot_id = snapshot_id
+    rainbow.tracks = merged
+    rainbow.save()
+
+
+def index_library(access_token, user_id=None, progress=None):
+    """
+    Index the tracks in a user's playlists and saved tracks, with the colors of
+    their album art, so that rainbows of them need no image work.
+
+    :param access_token: Spotify access token, or a callable such as a UserToken
+        returning a current one
+    :param user_id: Spotify user ID, if already known
+    :param progress: Optional callable taking a stage name and percent complete
+    :return: LibraryIndex object
+    """
+    progress = progress or (lambda stage, percent: None)
+    # nobody is waiting on the index, so it leaves most of the rate budget to others
+    client = SpotifyClient(access_token, low_priority=True)
+    return build_library_index(client, user_id or get_user_name(client), progress)
+
+
+def build_library_index(client, user_id, progress):
+    """
+    Bring a user's library index up to date.
+
+    Playlists whose snapshot ID has not changed since the last indexing are not
+    fetched again, and only tracks missing from the track color index have their
+    album art looked up in the color cache, or downloaded and extracted.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID
+    :param progress: Callable taking a stage name and percent complete
+    :return: LibraryIndex object
+    """
+    library_index, _ = LibraryIndex.objects.get_or_create(user_id=user_id)
+    progress('listing playlists', 0)
+    library_playlists = get_library_playlists(client, user_id)
+
+    indexed_playlists = {}
+    with image_workspace() as images_directory:
+        for number, playlist in enumerate(library_playlists):
+            progress('indexing playlists', 80 * number // len(library_playlists))
+            previous = library_index.playlists.get(playlist['id'])
+            if previous and previous['snapshot_id'] == playlist['snapshot_id']:
+                indexed_playlists[playlist['id']] = previous
+                continue
+            tracks = get_playlist_tracks(playlist['id'], client, playlist['snapshot_id'])
+            index_tracks(tracks, images_directory)
+            indexed_playlists[playlist['id']] = {
+                'snapshot_id': playlist['snapshot_id'],
+                'tracks': [track.id for track in tracks]}
+
+        progress('indexing saved tracks', 80)
+        saved_tracks = get_saved_tracks(client)
+        index_tracks(saved_tracks, images_directory)
+
+    library_index.playlists = indexed_playlists
+    library_index.saved_tracks = [track.id for track in saved_tracks]
+    library_index.save()
+    logger.info("Indexed the library of %s: %d playlists, %d tracks",
+                user_id, len(indexed_playlists), len(library_index.track_ids()))
+    return library_index
+
+
+def index_tracks(tracks, images_directory=None):
+    """
+    Add any tracks missing from the track color index to it.
+
+    :param tracks: List of Track objects
+    :param images_directory: Directory to also write downloaded images to, or None
+        to keep them in memory only
+    :return: Number of tracks added to the index
+    """
+    indexed = TrackColor.objects.lookup(track.id for track in tracks)
+    new_tracks = list({track.id: track for track in tracks if track.id not in indexed}.values())
+    if not new_tracks:
+        return 0
+    colors = get_track_colors(new_tracks, images_directory)
+    colored = [(track, color) for track, color in zip(new_tracks, colors) if color is not None]
+    palettes = DominantColor.objects.palettes(track.image_url for track, _ in colored)
+    TrackColor.objects.remember(
+        {track.id: color for track, color in colored},
+        {track.id: palettes.get(track.image_url, []) for track, _ in colored})
+    return len(colored)
+
+
+def is_index_stale(library_index):
+    """
+    Check whether a library index is due to be brought up to date.
+
+    :param library_index: LibraryIndex object
+    :return: True if the index is older than RAINBOW_LIBRARY_INDEX_INTERVAL
+    """
+    interval = getattr(settings, 'RAINBOW_LIBRARY_INDEX_INTERVAL',
+                       DEFAULT_LIBRARY_INDEX_INTERVAL)
+    return (timezone.now() - library_index.updated).total_seconds() > interval
+
+
+def schedule_library_index(access_token, user_id):
+    """
+    Start indexing a user's library in the background, if RAINBOW_LIBRARY_INDEXING
+    is enabled, unless it was indexed recently or is being indexed already.
+
+    The job runs on the low-priority job pool and is held to the low-priority share
+    of the Spotify request rate. Its image downloads and color extraction are not
+    deprioritized, though: they share the download pool and the extraction process
+    pool with rainbowify jobs.
+
+    :param access_token: Spotify access token, or a callable such as a UserToken
+        returning a current one
+    :param user_id: Spotify user ID
+    :return: ID of the indexing job, or None if none was started
+    """
+    if not getattr(settings, 'RAINBOW_LIBRARY_INDEXING', False):
+        return None
+    library_index = LibraryIndex.objects.filter(user_id=user_id).first()
+    if library_index and not is_index_stale(library_index):
+        return None
+    if not cache.add(f"library-index:{user_id}", True, LIBRARY_INDEX_LOCK_TIMEOUT):
+        return None
+    return submit_job(index_library, access_token, user_id, low_priority=True)
+
+
+def rainbowify_library(access_token, user_id=None, progress=None):
+    """
+    Make or bring up to date a playlist of the user's whole library in rainbow order.
+
+    The order comes from the library index, indexing the library first only if it
+    is out of date, so it takes a lookup of each track's rank and a sort.
+
+    :param access_token: Spotify access token, or a callable such as a UserToken
+        returning a current one
+    :param user_id: Spotify user ID, if already known
+    :param progress: Optional callable taking a stage name and percent complete
+    :return: Number of tracks added to the playlist
+    """
+    progress = progress or (lambda stage, percent: None)
+    client = SpotifyClient(access_token)
+    user_id = user_id or get_user_name(client)
+
+    with span('rainbowify', playlist=LIBRARY_SOURCE_ID):
+        library_index = LibraryIndex.objects.filter(user_id=user_id).first()
+        if library_index is None or is_index_stale(library_index):
+            library_index = build_library_index(client, user_id, progress)
+        progress('sorting', 80)
+        sorted_tracks = sort_indexed_tracks(library_index.track_ids())
+        tracks = publish_library_rainbow(client, user_id, sorted_tracks, progress)
+    logger.info("Rainbowified the library of %s: %d tracks", user_id, tracks)
+    return tracks
+
+
+def sort_indexed_tracks(track_ids):
+    """
+    Sort tracks by their ranks in the track color index.
+
+    Tracks that are not in the index, such as those whose album art could not be
+    downloaded, are left out.
+
+    :param track_ids: List of track IDs
+    :return: List of [track URI, dominant color] pairs in rainbow order
+    """
+    with span('matching', tracks=len(track_ids)):
+        indexed = TrackColor.objects.lookup(track_ids)
+        track_ids = [track_id for track_id in track_ids if track_id in indexed]
+        if get_ordering() == 'path':
+            palettes = TrackColor.objects.palettes(track_ids)
+            ranked = [track_ids[index] for index in path_order(
+                [palettes.get(track_id) or color_palette(indexed[track_id][0])
+                 for track_id in track_ids])]
+        else:
+            ranked = sorted(track_ids, key=lambda track_id: indexed[track_id][1])
+        return [[f"spotify:track:{track_id}", list(indexed[track_id][0])]
+                for track_id in ranked]
+
+
+def publish_library_rainbow(client, user_id, sorted_tracks, progress):
+    """
+    Update the user's whole-library rainbow playlist, or create it if they have none.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID
+    :param sorted_tracks: List of [track URI, dominant color] pairs in rainbow order
+    :param progress: Callable taking a stage name and percent complete
+    :return: Number of tracks added to the playlist
+    """
+    uris = [uri for uri, _ in sorted_tracks]
+    # stands in for a snapshot ID: it changes whenever the library's tracks do
+    snapshot_id = hashlib.sha256("\n".join(sorted(uris)).encode()).hexdigest()
+
+    previous = RainbowPlaylist.objects.filter(
+        user_id=user_id, source_playlist_id=LIBRARY_SOURCE_ID).first()
+    if previous and is_following_playlist(client, previous.rainbow_playlist_id, user_id):
+        if previous.snapshot_id == snapshot_id:
+            return 0
+        progress('updating playlist', 85)
+        new = find_new_uris(previous, uris)
+        added = [track for track, is_new in zip(sorted_tracks, new) if is_new]
+        changes = plan_rainbow_changes(previous, uris, added, get_indexed_palettes(
+            [uri.rsplit(':', 1)[1] for uri in uris]))
+        apply_rainbow_changes(client, previous, snapshot_id, changes)
+        return len(added)
+
+    progress('creating playlist', 85)
+    user_id, playlist_id = create_rainbow_playlist(client, user_id, LIBRARY_PLAYLIST_NAME)
+    cache.delete(get_user_playlists_cache_key(user_id))
+    progress('adding tracks', 90)
+    if populate_rainbow_playlist(client, playlist_id, uris):
+        RainbowPlaylist.objects.update_or_create(
+            user_id=user_id, source_playlist_id=LIBRARY_SOURCE_ID,
+            defaults={'rainbow_playlist_id': playlist_id, 'snapshot_id': snapshot_id,
+                      'tracks': sorted_tracks})
+    return len(sorted_tracks)
 
 
 # Helper Functions
-def get_auth_header(token):
+def images_in_memory():
     """
-    Get the authorization header for Spotify API requests.
+    Check whether album images should be kept in memory instead of written to disk.
 
-    :param token: Spotify access token
-    :return: Dictionary containing the authorization header
+    :return: True if the in-memory image pipeline is enabled
     """
-    return {"Authorization": "Bearer " + token}
+    return getattr(settings, 'RAINBOW_IN_MEMORY_IMAGES', True)
 
 
-def download_image(image_url, filename):
+@contextmanager
+def image_workspace():
     """
-    Download an image from a URL.
+    Provide a private images directory for a single rainbowify run.
 
-    :param image_url: URL of the image
-    :param filename: Name of the file to save the image as
+    The directory is created under RAINBOW_WORKSPACE_ROOT (the system temporary
+    directory by default) and removed, along with its contents, on exit.
+
+    :return: Context manager yielding the directory path, or None when images are
+        kept in memory
     """
-    response = requests.get(image_url, stream=True, timeout=10)
-    with open(f"art_images/{filename}", "wb") as file:
-        for chunk in response.iter_content(chunk_size=1024): # ref1
-            if chunk: # filter out keep-alive new chunks
-                file.write(chunk)
+    if images_in_memory():
+        yield None
+        return
+    root = getattr(settings, 'RAINBOW_WORKSPACE_ROOT', None)
+    with tempfile.TemporaryDirectory(prefix='rainbowify-', dir=root) as dirname:
+        yield dirname
 
 
-def reset_directory(dirname):
+def save_image(content, path):
     """
-    Reset a directory by deleting and recreating it.
+    Save downloaded image bytes to a file.
 
-    :param dirname: Name of the directory to reset
+    :param content: Bytes of the image
+    :param path: Path of the file to save the image as
     """
-    # before adding images, first make sure the working directory is empty:
-    if os.path.exists(dirname):
-        shutil.rmtree(dirname)
-    # recreate the directory:
-    os.makedirs(dirname)
+    with open(path, "wb") as file:
+        file.write(content)
 
 
-def get_dominant_color(image):
+def iter_playlist_pages(playlist_id, client, snapshot_id=None):
     """
-    Get the dominant color from an image.
+    Retrieve the tracks of a given playlist a page at a time.
+
+    The first page gives the playlist's total, after which the remaining pages are
+    fetched in parallel and yielded in playlist order as soon as each is ready. Only
+    tracks with album art to sort by are included.
+
+    When the playlist's snapshot ID is given, the tracks are cached against it; any
+    change to the playlist gives it a new snapshot ID, so a cached snapshot is never
+    stale. The cache is shared between users, so the snapshot ID must have just been
+    fetched from Spotify with the user's own token, which also shows they can read
+    the playlist.
 
-    :param image: Name of the image file
-    :return: Tuple representing the RGB values of the dominant color
+    :param playlist_id: ID of the playlist
+    :param client: SpotifyClient object
+    :param snapshot_id: Snapshot ID of the playlist, or None to skip the cache
+    :return: Generator of lists of Track objects
+    """
+    cache_key = get_tracks_cache_key(playlist_id, snapshot_id)
+    if snapshot_id:
+        cached_tracks = cache.get(cache_key)
+        if cached_tracks is not None:
+            increment('track_cache_hits')
+            yield cached_tracks
+            return
+
+    url = get_tracks_path(playlist_id)
+
+    def get_page(offset):
+        with span('track_fetch', playlist=playlist_id, offset=offset):
+            page = client.get(url, params=get_page_params(offset))
+        return page["total"], parse_tracks(page["items"])
+
+    total, page = get_page(0)
+    tracks = list(page)
+    yield page
+    offsets = range(PAGE_SIZE, total, PAGE_SIZE)
+    if offsets:
+        workers = min(getattr(settings, 'RAINBOW_PAGE_WORKERS', 4), len(offsets))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _, page in executor.map(get_page, offsets):
+                tracks.extend(page)
+                yield page
+
+    if snapshot_id:
+        cache.set(cache_key, tracks, TRACKS_CACHE_TIMEOUT)
+
+
+def get_saved_tracks(client):
+    """
+    Retrieve the tracks saved in the user's library.
+
+    :param client: SpotifyClient object
+    :return: List of Track objects for the saved tracks with album art to sort by
     """
-    ct = ColorThief(f"art_images/{image}")
-    most_dominant_color = ct.get_color(quality=1)
-    return most_dominant_color
+    tracks = []
+    url = f"/me/tracks?limit={LIBRARY_PAGE_SIZE}"
+    while url:
+        with span('track_fetch', playlist='saved'):
+            page = client.get(url)
+        tracks.extend(parse_tracks(page["items"]))
+        url = page.get("next")
+    return tracks
 
 
-def calculate_euclidean_distance(color1, color2):
+def get_playlist_tracks(playlist_id, client, snapshot_id=None):
     """
-    Calculate the Euclidean distance between two colors.
+    Retrieve all the tracks of a given playlist.
+
+    :param playlist_id: ID of the playlist
+    :param client: SpotifyClient object
+    :param snapshot_id: Snapshot ID of the playlist, or None to skip the cache
+    :return: List of Track objects
+    """
+    return [track for page in iter_playlist_pages(playlist_id, client, snapshot_id)
+            for track in page]
+
+
+def get_track_colors(tracks, images_directory=None):
+    """
+    Get the dominant colors of the album images for the given tracks.
+
+    Colors are looked up in the persistent color cache first. Only the covers that
+    miss are downloaded and extracted, once per distinct image URL, and the results
+    are added to the cache.
 
-    :param color1: Tuple representing the RGB values of the first color
-    :param color2: Tuple representing the RGB values of the second color
-    :return: Euclidean distance between the two colors
+    :param tracks: List of Track objects
+    :param images_directory: Directory to also write the downloaded images to, or
+        None to keep them in memory only
+    :return: List of the tracks' dominant colors, in the same order, with None for
+        any track whose cover could not be colored
     """
-    return np.sqrt(sum((a - b) ** 2 for a, b in zip(color1, color2)))
+    return stream_colors([tracks], images_directory)
 
-def get_playlist_tracks(playlist_id, access_token):
+
+def stream_track_colors(playlist_id, client, snapshot_id=None, images_directory=None):
     """
-    Retrieve the tracks of a given playlist.
+    Fetch a playlist's tracks and the dominant colors of their album images together.
+
+    Pages of tracks are fetched on one thread, checked against the color cache on
+    another, and their uncached covers downloaded and extracted as they turn up.
 
     :param playlist_id: ID of the playlist
-    :param access_token: Spotify access token
-    :return: JSON result of the tracks
+    :param client: SpotifyClient object
+    :param snapshot_id: Snapshot ID of the playlist, or None to skip the tracks cache
+    :param images_directory: Directory to also write the downloaded images to, or
+        None to keep them in memory only
+    :return: Tuple of the list of Track objects, and the list of their dominant
+        colors in the same order, with None for any track whose cover could not be
+        colored
     """
-    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    headers = get_auth_header(access_token)
-    result = get(url, headers=headers, timeout=10)
-    return result.json()["items"]
+    tracks = []
+
+    def pages():
+        for page in prefetch(iter_playlist_pages(playlist_id, client, snapshot_id)):
+            tracks.extend(page)
+            yield page
 
+    return tracks, stream_colors(pages(), images_directory)
 
-def download_album_images(tracks_json_result):
+
+def stream_colors(pages, images_directory=None):
+    """
+    Get the dominant colors of the album images for pages of tracks as they arrive.
+
+    Each page is looked up in the persistent color cache as soon as it arrives, and
+    the covers that miss start downloading straight away; covers that were already
+    seen on an earlier page are not fetched again. New colors are added to the cache
+    once every page has been processed.
+
+    :param pages: Iterable of lists of Track objects
+    :param images_directory: Directory to also write the downloaded images to, or
+        None to keep them in memory only
+    :return: List of the dominant colors of every track on the pages, in order, with
+        None for any track whose cover could not be colored
+    """
+    image_urls = []
+    url_colors = {}
+    requested = set()
+
+    def uncached_urls():
+        for page in pages:
+            page_urls = [track.image_url for track in page]
+            image_urls.extend(page_urls)
+            cached = DominantColor.objects.lookup(page_urls)
+            url_colors.update(cached)
+            missing = find_uncolored(page_urls, url_colors, requested)
+            requested.update(missing)
+            increment('color_cache_hits', len(cached))
+            increment('color_cache_misses', len(missing))
+            yield from missing
+
+    new_palettes = extract_palettes(
+        download_album_images(prefetch(uncached_urls()), images_directory))
+    DominantColor.objects.remember(new_palettes)
+    url_colors.update((url, palette_color(palette)) for url, palette in new_palettes.items())
+
+    # one color per track, so a track listed twice is sorted twice
+    return [url_colors.get(image_url) for image_url in image_urls]
+
+
+def download_album_images(image_urls, images_directory=None):
     """
-    Download the album images for the given tracks.
+    Download album images concurrently, yielding each one as soon as it arrives.
 
-    :param tracks_json_result: JSON result of the tracks
+    A failed download is reported and skipped, leaving its tracks out of the sort
+    rather than aborting the whole job.
+
+    :param image_urls: Iterable of album image URLs, which may still be being produced
+    :param images_directory: Directory to also write the images to, or None to keep
+        them in memory only
+    :return: Generator of (image URL, image bytes) tuples, in completion order
     """
-    images_directory = 'art_images/'
-    reset_directory(images_directory)
+    results = {}
+    for result in stream_images(image_urls):
+        results[result.url] = result
+        if result.error is not None:
+            continue
+        if images_directory is not None:
+            filename = os.path.basename(urlsplit(result.url).path) or "image"
+            save_image(result.content, os.path.join(images_directory, filename))
+        yield result.url, result.content
 
-    for track in tracks_json_result:
-        track_id = track['track']['id']
-        album_image_url = track['track']['album']['images'][-1]['url']
-        download_image(album_image_url, f"{track_id}_image.png")
+    report_downloads(results)
 
 
-def extract_dominant_colors():
+def report_downloads(results):
     """
-    Extract the dominant colors from the downloaded album images.
+    Log a summary of a batch of image downloads, including any failures.
 
-    :return: Dictionary mapping filenames to dominant colors
+    :param results: Dictionary mapping image URLs to their DownloadResult
     """
-    dominant_colors = {}
-    for file in os.listdir('art_images/'):
-        dominant_color = get_dominant_color(file)
-        dominant_colors[file] = dominant_color
-    return dominant_colors
+    failures = [result for result in results.values() if result.error is not None]
+    timings = sorted(result.elapsed for result in results.values())
+    if timings:
+        logger.info("Downloaded %d/%d images, median %.3fs, slowest %.3fs",
+                    len(timings) - len(failures), len(timings),
+                    timings[len(timings) // 2], timings[-1])
+    for result in failures:
+        logger.warning("Image download failed: %s (%s)", result.url, result.error)
 
 
-def find_closest_predefined_color_index(dominant_color):
+def extract_palettes(images):
     """
-    Find the index of the predefined color closest to the given dominant color.
+    Extract the weighted palettes of album images on the extraction process pool.
+
+    Images are sent to the pool in batches of RAINBOW_EXTRACTION_BATCH_SIZE as they
+    are yielded, so extraction overlaps with the downloads still in flight. Images
+    that cannot be decoded are reported and skipped.
 
-    :param dominant_color: Tuple representing the RGB values of the dominant color
-    :param colors: List of predefined colors
-    :return: Index of the closest predefined color
+    :param images: Iterable of (image URL, image bytes) tuples
+    :return: Dictionary mapping image URLs to palettes, each a list of [red, green,
+        blue, weight] lists with the dominant color first
+    """
+    batch_size = get_batch_size()
+    pending = []
+    batch = []
+    for url, content in images:
+        batch.append((url, content))
+        if len(batch) == batch_size:
+            pending.append((batch, submit_extraction([content for _, content in batch])))
+            batch = []
+    if batch:
+        pending.append((batch, submit_extraction([content for _, content in batch])))
+
+    palettes = {}
+    for batch, future in pending:
+        for (url, _), palette in zip(batch, future.result()):
+            if palette is None:
+                increment('color_extraction_failures')
+                logger.warning("Color extraction failed: %s (image could not be decoded)", url)
+            else:
+                palettes[url] = palette
+    return palettes
+
+
+def sort_tracks(tracks, colors):
     """
-    distances = [calculate_euclidean_distance(
-        dominant_color, predefined_color) for predefined_color in colors]
-    min_distance_index = distances.index(min(distances))
-    return min_distance_index
+    Sort the tracks by where their album art's dominant color falls in the rainbow.
 
+    Each track record is given its color and its rank in the rainbow. Under the
+    'path' ordering, the ranks instead follow a path through the palettes of the
+    tracks' album art, as kept in the color cache. Tracks without a color are left
+    out.
 
-def get_user_name(token):
+    :param tracks: List of Track objects
+    :param colors: List of the tracks' dominant colors, in the same order, with None
+        for any track left uncolored
+    :return: List of [track URI, dominant color] pairs in rainbow order
     """
-    Get the Spotify user ID of the authenticated user.
+    with span('matching', tracks=len(tracks)):
+        colored = []
+        for track, color in zip(tracks, colors):
+            if color is not None:
+                track.color = color
+                colored.append(track)
+
+        if get_ordering() == 'path':
+            palettes = DominantColor.objects.palettes(track.image_url for track in colored)
+            order = path_order([palettes.get(track.image_url) or color_palette(track.color)
+                                for track in colored])
+            # a track's rank is its position on the path
+            ranks = np.argsort(order)
+        else:
+            # rank every dominant colour under the configured ordering, for all tracks
+            # at once; a stable sort keeps tracks of equal rank in playlist order
+            ranks = color_ranks([track.color for track in colored])
+            order = np.argsort(ranks, kind='stable')
+        for track, rank in zip(colored, ranks.tolist()):
+            track.rank = rank
+        return [[colored[index].uri, list(colored[index].color)] for index in order.tolist()]
+
+
+def get_session_user_id(request, client):
+    """
+    Get the Spotify user ID of the logged in user, looking it up only once per login.
 
-    :param token: Spotify access token
+    :param request: HttpRequest object
+    :param client: SpotifyClient object
     :return: User ID of the authenticated user
     """
-    url = "https://api.spotify.com/v1/me"
-    headers = get_auth_header(token)
-    result = get(url, headers=headers, timeout=10)
-    json_result = json.loads(result.content)["id"]
+    if 'user_id' not in request.session:
+        request.session['user_id'] = get_user_name(client)
+    return request.session['user_id']
+
+
+def get_user_playlists(client, user_id):
+    """
+    Get the user's playlists, from the cache if they were listed recently.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID
+    :return: JSON result of the playlists
+    """
+    cache_key = get_user_playlists_cache_key(user_id)
+    json_result = cache.get(cache_key)
+    if json_result is None:
+        json_result = client.get("/me/playlists")["items"]
+        cache.set(cache_key, json_result, get_playlists_cache_timeout())
     return json_result
 
 
-def create_user_playlist(token, user_id):
+def get_library_playlists(client, user_id):
+    """
+    Get every playlist in the user's library, excluding the rainbow playlists made
+    by this app.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID
+    :return: List of JSON results of the playlists
+    """
+    rainbow_ids = set(RainbowPlaylist.objects.filter(user_id=user_id)
+                      .values_list('rainbow_playlist_id', flat=True))
+    library = []
+    url = f"/me/playlists?limit={LIBRARY_PAGE_SIZE}"
+    while url:
+        page = client.get(url)
+        library.extend(playlist for playlist in page["items"]
+                       if playlist and playlist["id"] not in rainbow_ids)
+        url = page.get("next")
+    return library
+
+
+def get_owned_playlists(client, user_id):
+    """
+    Get every playlist the user owns, excluding the rainbow playlists made from them.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID
+    :return: List of JSON results of the playlists
+    """
+    return [playlist for playlist in get_library_playlists(client, user_id)
+            if playlist["owner"]["id"] == user_id]
+
+
+def get_user_name(client):
+    """
+    Get the Spotify user ID of the authenticated user.
+
+    :param client: SpotifyClient object
+    :return: User ID of the authenticated user
+    """
+    return client.get("/me")["id"]
+
+
+def create_user_playlist(client, user_id, name=PLAYLIST_NAME):
     """
     Create a new playlist for the user.
 
-    :param token: Spotify access token
+    :param client: SpotifyClient object
     :param user_id: Spotify user ID
+    :param name: Name of the playlist
     :return: ID of the created playlist, or None if the creation failed
     """
-    url = f"https://api.spotify.com/v1/users/{user_id}/playlists"
-    headers = get_auth_header(token)
-    data = {
-        "name": "Your Rainbow Playlist",
-        "description": "Made with Python",
-        "public": False
-    }
+    url = f"/users/{user_id}/playlists"
+    data = get_playlist_data(name)
+
+    logger.debug("Creating playlist for %s with %s", user_id, data)
+    try:
+        with span('playlist_create', user=user_id):
+            result = client.post(url, json=data)
+    except SpotifyError as error:
+        logger.error("Playlist creation error. Code: %s, Response: %s",
+                     error.status_code, error)
+        return None
+    logger.info("Playlist %s created for %s", result["id"], user_id)
+    # returns the playlist ID upon successful creation
+    return result["id"]
+
+
+def create_rainbow_playlist(client, user_id=None, name=PLAYLIST_NAME):
+    """
+    Create the new, 'rainbowified' playlist for the user.
+
+    :param client: SpotifyClient object
+    :param user_id: Spotify user ID, looked up if not known
+    :param name: Name of the playlist
+    :return: Tuple of the user ID and the ID of the created playlist
+    """
+    user_id = user_id or get_user_name(client)
+    playlist_id = create_user_playlist(client, user_id, name)
+    if not playlist_id:
+        raise RuntimeError("The rainbow playlist could not be created")
+    return user_id, playlist_id
 
-    result = post(url=url, headers=headers, json=data, timeout=10)
-    print(f"Executing.. with {data}")
-    if result.status_code == 201:
-        print("Playlist created successfully.")
-        # returns the playlist ID upon successful creation
-        return result.json()["id"]
-    print(f"Playlist creation error. Code: {result.status_code}, Response: {result.json()}")
-    return None
 
+def discard_playlist(client, playlist_future):
+    """
+    Remove a playlist created for a rainbowify run that then failed.
+
+    Spotify playlists cannot be deleted, only unfollowed, which takes them out of
+    the user's library.
 
-def populate_rainbow_playlist(token, playlist_id, uris):
+    :param client: SpotifyClient object
+    :param playlist_future: Future resolving to the (user ID, playlist ID) tuple
+        returned by create_rainbow_playlist
+    """
+    if playlist_future.exception() is not None:
+        return
+    _, playlist_id = playlist_future.result()
+    try:
+        client.request('DELETE', f"/playlists/{playlist_id}/followers")
+    except SpotifyError as error:
+        logger.warning("Could not remove playlist %s: %s", playlist_id, error)
+
+
+def populate_rainbow_playlist(client, playlist_id, uris):
     """
     Populate the playlist with the given URIs.
 
-    :param token: Spotify access token
+    Tracks are added in batches of 100, the most the API accepts per request. The
+    batches are sent one after another so the playlist keeps the given order, and
+    adding stops at the first failed batch.
+
+    :param client: SpotifyClient object
     :param playlist_id: ID of the playlist to populate
     :param uris: List of track URIs to add to the playlist
+    :return: True if every track was added
+    """
+    with span('playlist_populate', playlist=playlist_id, tracks=len(uris)):
+        for batch in get_batches(uris):
+            try:
+                client.post(get_tracks_path(playlist_id), json={"uris": batch})
+            except SpotifyError as error:
+                return report_population(playlist_id, uris, error)
+    return report_population(playlist_id, uris)
+
+
+def insert_playlist_tracks(client, playlist_id, tracks, inserted):
+    """
+    Insert new tracks into a playlist at their positions in the given order.
+
+    Each run of consecutive new tracks is inserted with one request (or one per 100
+    tracks), working from the start of the playlist so that every position is
+    already final when it is used.
+
+    :param client: SpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param tracks: List of [track URI, color] pairs in the playlist's intended order,
+        of which every track not marked as inserted is already in the playlist
+    :param inserted: List of booleans, True for each of the tracks to insert
+    """
+    for position, run in get_insert_runs(tracks, inserted):
+        client.post(get_tracks_path(playlist_id), json={"uris": run, "position": position})
+    logger.info("%d tracks inserted into playlist %s", sum(inserted), playlist_id)
+
+
+def remove_playlist_tracks(client, playlist_id, uris):
+    """
+    Remove every occurrence of the given tracks from a playlist.
+
+    :param client: SpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param uris: List of track URIs to remove
     """
-    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    headers = get_auth_header(token)
-    data = {"uris": uris}
+    for batch in get_batches(uris):
+        client.request('DELETE', get_tracks_path(playlist_id), json=get_removal_data(batch))
+    if uris:
+        logger.info("%d tracks removed from playlist %s", len(uris), playlist_id)
+
 
-    result = post(url=url, headers=headers, json=data, timeout=10)
-    if result.status_code == 201:
-        print("Tracks added successfully.")
-    else:
-        print(f"Failed to add tracks. Status code: {result.status_code}, Response: {result.json()}")
+def get_playlist_snapshot_id(client, playlist_id):
+    """
+    Get the current snapshot ID of a playlist.
+
+    :param client: SpotifyClient object
+    :param playlist_id: ID of the playlist
+    :return: Snapshot ID of the playlist
+    """
+    return client.get(f"/playlists/{playlist_id}", params={"fields": "snapshot_id"})["snapshot_id"]
+
+
+def is_following_playlist(client, playlist_id, user_id):
+    """
+    Check whether a playlist is still in the user's library.
+
+    :param client: SpotifyClient object
+    :param playlist_id: ID of the playlist
+    :param user_id: Spotify user ID
+    :return: True if the user follows the playlist
+    """
+    url = f"/playlists/{playlist_id}/followers/contains"
+    try:
+        result = client.get(url, params={"ids": user_id})
+    except SpotifyError as error:
+        return check_following_error(error)
+    return bool(result and result[0])
 
-# ref1: https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests
 # note: docstrings written by generative AI.
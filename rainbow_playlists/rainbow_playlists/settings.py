@@ -78,6 +78,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # background jobs write from several threads at once: take the write lock
+        # when a transaction starts, and wait for it rather than failing (Django 5.1+)
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
     }
 }
 
@@ -122,3 +125,107 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+# https://docs.djangoproject.com/en/5.0/topics/logging/
+
+# the app logs its progress and any problems to the console; at DEBUG level it also
+# logs the time taken by every timed stage, down to single image downloads
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'playlists': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+
+# Rainbow Playlists
+
+# album art downloads: total concurrent downloads, and the limit for any one host
+RAINBOW_DOWNLOAD_WORKERS = 16
+RAINBOW_DOWNLOAD_PER_HOST = 8
+
+# album art is cached on disk in RAINBOW_IMAGE_CACHE_DIR (None disables the cache),
+# shared by every worker process and kept under RAINBOW_IMAGE_CACHE_SIZE bytes by
+# evicting the least recently used covers
+RAINBOW_IMAGE_CACHE_DIR = BASE_DIR / 'image_cache'
+RAINBOW_IMAGE_CACHE_SIZE = 256 * 1024 * 1024
+
+# background threads running rainbowify jobs in each worker process, and low-priority
+# jobs nobody is waiting on, such as library indexing
+RAINBOW_JOB_WORKERS = 4
+RAINBOW_LOW_PRIORITY_JOB_WORKERS = 1
+
+# serve the playlists and rainbowify pages with the async views in
+# playlists/async_views.py, which make their Spotify and album art requests with an
+# async HTTP client and run rainbowify jobs as tasks on the event loop instead of on
+# RAINBOW_JOB_WORKERS threads. Needs an ASGI server, such as
+# `uvicorn rainbow_playlists.asgi:application`.
+RAINBOW_ASYNC_VIEWS = False
+
+# Spotify Web API requests allowed per second, and in a single burst, across every
+# job in a worker process. The limit is per process, not global: N server worker
+# processes can send up to N times this rate, so divide the app's budget by them
+RAINBOW_SPOTIFY_RATE = 10
+RAINBOW_SPOTIFY_BURST = 20
+# the most of that rate low-priority jobs may use between them
+RAINBOW_LOW_PRIORITY_SPOTIFY_RATE = 2
+
+# seconds before a user's Spotify access token expires that it is refreshed
+RAINBOW_TOKEN_REFRESH_MARGIN = 300
+
+# seconds a user's playlist listing is reused before it is fetched again
+RAINBOW_PLAYLISTS_CACHE_TIMEOUT = 300
+
+# concurrent requests used to fetch the remaining pages of a large playlist
+RAINBOW_PAGE_WORKERS = 4
+# pages of tracks, and batches of cover URLs, a rainbowify stage may get ahead of the
+# stage consuming them
+RAINBOW_PIPELINE_BUFFER = 4
+
+# keep downloaded album art in memory; when disabled, each rainbowify run writes its
+# covers to a private temporary directory under RAINBOW_WORKSPACE_ROOT (None uses the
+# system temporary directory), which is removed once the run finishes
+RAINBOW_IN_MEMORY_IMAGES = True
+RAINBOW_WORKSPACE_ROOT = None
+
+# dominant colour extraction: album covers are requested at the smallest size of at
+# least RAINBOW_COVER_MIN_SIZE pixels, decoded to at most RAINBOW_EXTRACTION_MAX_SIZE
+# pixels a side (0 keeps the full size), and every RAINBOW_EXTRACTION_QUALITY-th pixel
+# is quantized by RAINBOW_COLOR_ENGINE, either 'numpy' or the much slower
+# 'colorthief'. Compare settings with `python manage.py benchmark_extraction`.
+RAINBOW_COLOR_ENGINE = 'numpy'
+RAINBOW_COVER_MIN_SIZE = 64
+RAINBOW_EXTRACTION_MAX_SIZE = 64
+RAINBOW_EXTRACTION_QUALITY = 1
+# worker processes extracting colours; None uses one per CPU, 0 extracts in-process
+RAINBOW_EXTRACTION_PROCESSES = None
+# covers sent to an extraction worker at a time
+RAINBOW_EXTRACTION_BATCH_SIZE = 8
+
+# how tracks are put in rainbow order: 'hue' orders their colours by perceptual (CIE
+# LCh) hue, then greys by lightness; 'palette' ranks them by the closest entry of the
+# hand-ordered palette in playlists/colors.py; 'path' follows a smooth path through
+# the colour palettes of the album art, so covers with two strong colours sit between
+# the tracks they resemble
+RAINBOW_ORDERING = 'hue'
+
+# index the tracks of a user's playlists and saved tracks, with their colors, in the
+# background when they view their playlists, at most once every
+# RAINBOW_LIBRARY_INDEX_INTERVAL seconds, so that a rainbow of their whole library
+# needs no image work. Off by default, since it fetches every playlist in the
+# library; without it, 'Rainbowify my whole library' indexes the library itself
+RAINBOW_LIBRARY_INDEXING = False
+RAINBOW_LIBRARY_INDEX_INTERVAL = 24 * 60 * 60
+
+# serve each worker process's timing spans and counters, in the Prometheus text
+# format, at /metrics/
+RAINBOW_METRICS_ENABLED = True
+
+# maximum number of album covers kept in the dominant colour cache; the least
+# recently used covers are evicted first
+RAINBOW_COLOR_CACHE_SIZE = 50000
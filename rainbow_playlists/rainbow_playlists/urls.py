@@ -14,15 +14,23 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
-from playlists import views
+from playlists import async_views, views
+
+# the async views need an ASGI server, whose event loop runs their rainbowify jobs
+page_views = async_views if getattr(settings, 'RAINBOW_ASYNC_VIEWS', False) else views
 
 urlpatterns = [
     #path('admin/', admin.site.urls),
     path('', views.index, name='index'),
     path('login/', views.login, name='login'),
     path('callback/', views.callback, name='callback'),
-    path('playlists/', views.playlists, name='playlists'),
-    path('rainbowify/', views.rainbowify, name='rainbowify'),
+    path('playlists/', page_views.playlists, name='playlists'),
+    path('rainbowify/', page_views.rainbowify, name='rainbowify'),
+    path('rainbowify/library/', views.library_rainbowify, name='library_rainbowify'),
+    path('rainbowify/<str:job_id>/status/', views.rainbowify_status, name='rainbowify_status'),
+    path('complete/', views.complete, name='complete'),
+    path('metrics/', views.metrics, name='metrics'),
 ]